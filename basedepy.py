@@ -1,22 +1,3 @@
-
-
-
-""" BP_COMENTARIOS - Sistema de Respuesta Automática a Comentarios Versión: 5.0 - Unificado con Anti-bucle + Posts Detection + 100% Supabase =========================================================================== CARACTERÍSTICAS: - Sistema anti-bucle completo (previene responder a propios comen
-
-pasted
-
-
-Hay una parte de mi código en donde reconoce las publicaciones, aqui toma la info y crea la regla, neecsito que no la cree, sino que rescate los datos y los mande como tarea para revisar por el dueño de la marca, en donde se activará un flujo que le manda un wsp al dueño con "se detectó nueva publicación, entrar al siguiente link para revisar su base de datos".
-
-Aqui ingresará a su sistema que ya existe, y verá la tarea asignada, que será confirmación de nueva regla, entonces aqui la persona confirma si o no a la regla o la puede modificar. 
-
-
-
-Contenido pegado
-79.14 KB •1,981 líneas
-•
-El formato puede ser inconsistente con la fuente
-
 """
 BP_COMENTARIOS - Sistema de Respuesta Automática a Comentarios
 Versión: 5.0 - Unificado con Anti-bucle + Posts Detection + 100% Supabase
@@ -46,14 +27,31 @@ RUTAS:
 import os
 import requests
 import json
+import logging
+import queue
+import sys
 import time
-from flask import Blueprint, redirect, request, session, url_for, render_template, flash, jsonify
-from datetime import datetime, timedelta
-from collections import Counter, defaultdict
+import uuid
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import Blueprint, redirect, request, session, url_for, render_template, flash, jsonify, Response, g
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict, defaultdict, deque
 import calendar
+import csv
+import io
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import cProfile
+import atexit
 import base64
+import bisect
+import functools
 import hmac
 import hashlib
+import random
+import re
+import sqlite3
+import threading
 
 # Supabase
 from supabase import create_client, Client
@@ -84,11 +82,14 @@ comentarios_bp = Blueprint(
 VERIFY_TOKEN = os.getenv('VERIFY_TOKEN')
 APP_ID = os.getenv('APP_ID_COMENTARIOS')
 APP_SECRET = os.getenv('APP_SECRET_COMENTARIOS')
+# Exigir X-Hub-Signature-256 en el webhook (solo posible si hay APP_SECRET)
+WEBHOOK_SIGNATURE_REQUIRED = os.getenv('WEBHOOK_SIGNATURE_REQUIRED', 'true').lower() != 'false'
 REDIRECT_URI = os.getenv('REDIRECT_URI_COMENTARIOS', 'https://mrkt21-pbezama.pythonanywhere.com/comentarios/facebook_callback')
 
 # OpenAI
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')  # None = API oficial; permite apuntar a un stand-in local
+openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL) if OPENAI_API_KEY else None
 
 # Google Sheets (fallback)
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
@@ -109,72 +110,911 @@ except Exception as e:
     print(f"[SHEETS] No se pudo inicializar Google Sheets: {e}")
     sheet = None
 
+# Base local SQLite (estado persistente de workflows)
+LOCAL_DB_PATH = os.getenv(
+    'COMENTARIOS_LOCAL_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comentarios_local.db')
+)
+_local_db_state = threading.local()
+
+
+def utc_now_iso():
+    """Fecha actual en UTC con zona (mismo formato comparable que escribe el frontend)"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def parse_utc(valor):
+    """Parsea un timestamp ISO de Supabase ('Z', offset o sin zona = UTC)"""
+    fecha = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+
+
+def get_local_db():
+    """Devuelve la conexión SQLite local del hilo actual (modo WAL, autocommit)"""
+    conn = getattr(_local_db_state, 'conn', None)
+    if conn is None or getattr(_local_db_state, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(LOCAL_DB_PATH, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local_db_state.conn = conn
+        _local_db_state.pid = os.getpid()
+    return conn
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Métricas (formato Prometheus)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class Metrics:
+    """
+    Registro de métricas en memoria (por proceso): histogramas de latencia,
+    contadores y gauges calculados al momento de exportar.
+    Cada evento cuesta un bisect y una suma bajo lock; los timers además
+    agregan un span a la traza activa (ver Tracer).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.familias = {}
+        self.help = {
+            "comentarios_stage_seconds": ("histogram", "Latencia por etapa del pipeline"),
+            "comentarios_errors_total": ("counter", "Errores por etapa"),
+            "comentarios_cache_requests_total": ("counter", "Consultas a caches (hit/miss)"),
+            "comentarios_webhook_events_total": ("counter", "Eventos de webhook recibidos por campo"),
+            "comentarios_queue_depth": ("gauge", "Elementos pendientes por cola"),
+            "comentarios_log_dropped_total": ("counter", "Registros de log descartados por cola llena"),
+            "comentarios_webhook_signature_failures_total": ("counter", "POST al webhook rechazados por firma ausente o inválida"),
+            "comentarios_debounce_groups_total": ("counter", "Grupos de comentarios procesados tras la ventana de agrupación"),
+            "comentarios_openai_batch_items_total": ("counter", "Comentarios generados por modo (lote, individual, fallback)"),
+            "comentarios_intent_templates_total": ("counter", "Comentarios de marcas con plantillas: respondidos por plantilla o enviados al LLM"),
+            "comentarios_scheduler_queue_depth": ("gauge", "Trabajos pendientes en el planificador por marca y clase"),
+            "comentarios_scheduler_wait_seconds": ("histogram", "Espera en cola del planificador por clase de prioridad"),
+            "comentarios_scheduler_jobs_total": ("counter", "Trabajos ejecutados por el planificador por clase y resultado"),
+            "comentarios_load_shedding_level": ("gauge", "Nivel de degradación (0 normal, 1 sin DM, 2 sin LLM, 3 escrituras diferidas)"),
+            "comentarios_load_shedding_transitions_total": ("counter", "Cambios de nivel de degradación por nivel de destino"),
+            "comentarios_load_shedding_actions_total": ("counter", "DMs diferidos u omitidos, fallbacks y escrituras diferidas por carga"),
+            "comentarios_surge_active_media": ("gauge", "Publicaciones en modo oleada"),
+            "comentarios_surge_transitions_total": ("counter", "Entradas y salidas del modo oleada"),
+            "comentarios_surge_replies_total": ("counter", "Comentarios en oleada respondidos por el LLM o con respuesta rotada"),
+            "comentarios_surge_batched_writes_total": ("counter", "Filas escritas en lote durante oleadas por destino"),
+            "comentarios_token_invalid": ("gauge", "Tokens de página marcados como inválidos"),
+            "comentarios_token_health_total": ("counter", "Validaciones, renovaciones y eventos descartados por token inválido"),
+            "comentarios_export_rows_total": ("counter", "Filas de logs_comentarios exportadas por formato"),
+            "comentarios_speculative_replies_total": ("counter", "Comentarios en publicaciones precalentadas: respondidos con variante pregenerada (hit) o no"),
+        }
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        idx = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            hist[0][idx] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] += value
+
+    def gauge(self, name, funcion, **labels):
+        """Registra un gauge cuyo valor se calcula con funcion() al exportar"""
+        self.gauges[self._key(name, labels)] = funcion
+
+    def gauge_family(self, name, funcion):
+        """Registra un gauge con labels dinámicas: funcion() devuelve [(labels, valor), ...] al exportar"""
+        self.familias[name] = funcion
+
+    def error(self, stage):
+        self.inc("comentarios_errors_total", stage=stage)
+
+    def cache(self, cache, hit):
+        self.inc("comentarios_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    def timer(self, stage):
+        """Context manager que mide la etapa y cuenta excepciones como errores"""
+        return _StageTimer(self, stage)
+
+    def timed(self, stage):
+        """Decorador equivalente a timer()"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pares = list(labels) + list(extra)
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pares) + "}"
+
+    def render(self):
+        """Exporta todas las métricas en formato de texto de Prometheus"""
+        with self._lock:
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+            counters = dict(self.counters)
+        gauges = {}
+        for key, funcion in list(self.gauges.items()):
+            try:
+                gauges[key] = float(funcion())
+            except Exception:
+                continue
+        for name, funcion in list(self.familias.items()):
+            try:
+                for labels, valor in funcion():
+                    gauges[self._key(name, labels)] = float(valor)
+            except Exception:
+                continue
+
+        series = defaultdict(list)
+        for (name, labels), (buckets, total, count) in histograms.items():
+            acumulado = 0
+            for limite, n in zip(self.BUCKETS + ("+Inf",), buckets):
+                acumulado += n
+                series[name].append(f"{name}_bucket{self._labels(labels, [('le', limite)])} {acumulado}")
+            series[name].append(f"{name}_sum{self._labels(labels)} {total}")
+            series[name].append(f"{name}_count{self._labels(labels)} {count}")
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            series[name].append(f"{name}{self._labels(labels)} {value}")
+
+        lineas = []
+        for name in sorted(series):
+            tipo, descripcion = self.help.get(name, ("untyped", name))
+            lineas.append(f"# HELP {name} {descripcion}")
+            lineas.append(f"# TYPE {name} {tipo}")
+            lineas.extend(series[name])
+        return "\n".join(lineas) + "\n"
+
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "inicio")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duracion = time.perf_counter() - self.inicio
+        self.metrics.observe("comentarios_stage_seconds", duracion, stage=self.stage)
+        if exc_type is not None:
+            self.metrics.error(self.stage)
+        tracer.record_span(self.stage, self.inicio, duracion, exc_type is not None)
+        return False
+
+# Instancia global
+metrics = Metrics()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# LOGGING ESTRUCTURADO (JSON lines, escritura en segundo plano)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Fracción de mensajes INFO/DEBUG que se conservan por categoría (WARNING y ERROR siempre se emiten)
+LOG_SAMPLING = {
+    categoria.strip().upper(): float(tasa)
+    for categoria, tasa in (
+        par.split('=', 1) for par in os.getenv('LOG_SAMPLING', 'WEBHOOK=0.1,ADMIN=0.1,LOCK=0.25').split(',') if '=' in par
+    )
+}
+
+
+class JsonLineFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, cat, msg y los campos extra"""
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "cat": getattr(record, 'categoria', record.name),
+            "msg": record.getMessage()
+        }
+        data.update(getattr(record, 'campos', None) or {})
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Encola los registros en una cola acotada; un QueueListener los escribe
+    (por defecto en stdout) desde otro hilo. Si la cola está llena el registro se descarta.
+    """
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE, destino=None):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.destino = destino
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self.destino:
+                salida = self.destino()
+            else:
+                salida = logging.StreamHandler(sys.stdout)
+                salida.setFormatter(JsonLineFormatter())
+            self._listener = QueueListener(self.queue, salida)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._listener.stop)
+
+    def prepare(self, record):
+        # Mismo proceso: se pasa el registro tal cual, el formato JSON se hace en el listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("comentarios_log_dropped_total")
+
+
+class StructuredLogger:
+    """log.info("LOCK", "Lock adquirido", comment_id=...) → JSON line con muestreo por categoría"""
+
+    def __init__(self, nombre):
+        self.logger = logging.getLogger(nombre)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        self.logger.propagate = False
+        if not any(isinstance(h, AsyncLogHandler) for h in self.logger.handlers):
+            self.logger.addHandler(AsyncLogHandler())
+
+    def _log(self, nivel, categoria, mensaje, exc_info=False, campos=None):
+        if not self.logger.isEnabledFor(nivel):
+            return
+        if nivel < logging.WARNING:
+            tasa = LOG_SAMPLING.get(categoria)
+            if tasa is not None and random.random() >= tasa:
+                return
+        traza = _current_trace.get()
+        if traza is not None:
+            campos = dict(campos or {}, trace_id=traza.trace_id)
+        self.logger.log(nivel, mensaje, exc_info=exc_info, extra={'categoria': categoria, 'campos': campos})
+
+    def debug(self, categoria, mensaje, **campos):
+        self._log(logging.DEBUG, categoria, mensaje, campos=campos)
+
+    def info(self, categoria, mensaje, **campos):
+        self._log(logging.INFO, categoria, mensaje, campos=campos)
+
+    def warning(self, categoria, mensaje, **campos):
+        self._log(logging.WARNING, categoria, mensaje, campos=campos)
+
+    def error(self, categoria, mensaje, exc_info=False, **campos):
+        self._log(logging.ERROR, categoria, mensaje, exc_info=exc_info, campos=campos)
+
+# Instancia global
+log = StructuredLogger('comentarios')
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TRAZAS (un trace por change del webhook, spans por llamada externa)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+TRACE_FILE = os.getenv(
+    'TRACE_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comentarios_traces.jsonl')
+)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv('TRACE_BACKUPS', '5'))
+
+_current_trace = contextvars.ContextVar('comentarios_trace', default=None)
+
+
+class Trace:
+    """Traza en curso: id, atributos y spans (etapa, offset, duración, error)"""
+    __slots__ = ("trace_id", "name", "attrs", "inicio", "inicio_ts", "spans")
+
+    def __init__(self, name, attrs):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.inicio = time.perf_counter()
+        self.inicio_ts = time.time()
+        self.spans = []
+
+
+class Tracer:
+    """
+    Crea trazas con `with tracer.trace(nombre, **attrs)`. Los timers de `metrics`
+    agregan un span a la traza activa del contexto; al cerrar, la traza se
+    escribe como una línea JSON en TRACE_FILE (rotativo, escritura en segundo plano).
+    """
+
+    def __init__(self, archivo=TRACE_FILE, sample_rate=TRACE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.logger = logging.getLogger('comentarios.traces')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            self.logger.addHandler(AsyncLogHandler(destino=lambda: self._file_handler(archivo)))
+
+    @staticmethod
+    def _file_handler(archivo):
+        handler = RotatingFileHandler(archivo, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        return handler
+
+    def trace(self, name, **attrs):
+        return _TraceScope(self, name, attrs)
+
+    def record_span(self, stage, inicio, duracion, error=False):
+        traza = _current_trace.get()
+        if traza is not None:
+            traza.spans.append((stage, inicio - traza.inicio, duracion, error))
+
+    def export(self, traza, error=False):
+        duracion = time.perf_counter() - traza.inicio
+        registro = {
+            "trace_id": traza.trace_id,
+            "name": traza.name,
+            "start": datetime.fromtimestamp(traza.inicio_ts).isoformat(timespec='milliseconds'),
+            "duration_ms": round(duracion * 1000, 2),
+            "error": error,
+            "attrs": traza.attrs,
+            "spans": [
+                {"stage": stage, "offset_ms": round(offset * 1000, 2), "ms": round(ms * 1000, 2), "error": err}
+                for stage, offset, ms, err in traza.spans
+            ]
+        }
+        self.logger.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+
+class _TraceScope:
+    __slots__ = ("tracer", "name", "attrs", "traza", "token")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.traza = None
+        self.token = None
+
+    def __enter__(self):
+        # Trazas anidadas se registran como spans de la traza externa
+        if _current_trace.get() is None and random.random() < self.tracer.sample_rate:
+            self.traza = Trace(self.name, self.attrs)
+            self.token = _current_trace.set(self.traza)
+        return self.traza
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.traza is not None:
+            _current_trace.reset(self.token)
+            self.tracer.export(self.traza, error=exc_type is not None)
+        return False
+
+# Instancia global
+tracer = Tracer()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PROFILING BAJO DEMANDA
+# ═══════════════════════════════════════════════════════════════════════════════
+
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')  # Header X-Comentarios-Profile para perfilar una request puntual
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))  # Fracción de llamadas al webhook
+PROFILE_FORMAT = os.getenv('PROFILE_FORMAT', 'speedscope')  # speedscope (muestreo) | pstats (cProfile)
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '2'))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+PROFILE_DIR = os.getenv(
+    'PROFILE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comentarios_profiles')
+)
+
+
+class StackSampler:
+    """
+    Profiler de muestreo para un hilo: un hilo auxiliar lee el stack del hilo
+    objetivo cada `intervalo` segundos (sys._current_frames) y acumula las muestras.
+    """
+
+    def __init__(self, thread_id, intervalo=PROFILE_INTERVAL_MS / 1000, max_segundos=PROFILE_MAX_SECONDS):
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.max_segundos = max_segundos
+        self.frames = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="comentarios-profiler", daemon=True)
+
+    def start(self):
+        self.inicio = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duracion = time.perf_counter() - self.inicio
+
+    def _run(self):
+        ultimo = time.perf_counter()
+        while not self._stop.wait(self.intervalo):
+            ahora = time.perf_counter()
+            if ahora - self.inicio > self.max_segundos:
+                break
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                clave = (code.co_name, code.co_filename, code.co_firstlineno)
+                stack.append(self.frames.setdefault(clave, len(self.frames)))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.samples.append(stack)
+                self.weights.append(round((ahora - ultimo) * 1000, 3))
+            ultimo = ahora
+
+    def to_speedscope(self, nombre):
+        frames = [None] * len(self.frames)
+        for (name, archivo, linea), idx in self.frames.items():
+            frames[idx] = {"name": name, "file": archivo, "line": linea}
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": nombre,
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": round(self.duracion * 1000, 3),
+                "samples": self.samples,
+                "weights": self.weights
+            }],
+            "exporter": "comentarios-profiler"
+        }
+
+
+class RequestProfiler:
+    """
+    Perfila requests del blueprint bajo demanda: con el header
+    X-Comentarios-Profile = PROFILE_TOKEN, o para una fracción aleatoria de las
+    llamadas al webhook. Cada captura se guarda en PROFILE_DIR (se conservan las
+    últimas PROFILE_KEEP).
+    """
+
+    HEADER = 'X-Comentarios-Profile'
+
+    def __init__(self, directorio=PROFILE_DIR, formato=PROFILE_FORMAT):
+        self.directorio = directorio
+        self.formato = formato
+        self.lock = threading.Lock()
+
+    def is_authorized(self, req):
+        valor = req.headers.get(self.HEADER)
+        return bool(PROFILE_TOKEN and valor) and hmac.compare_digest(valor.encode('utf-8', 'ignore'),
+                                                                     PROFILE_TOKEN.encode())
+
+    def should_profile(self, req):
+        if req.endpoint in ('comentarios.diagnostico_perfiles', 'comentarios.descargar_perfil'):
+            return False
+        if self.is_authorized(req):
+            return True
+        return (
+            req.endpoint == 'comentarios.webhook' and req.method == 'POST'
+            and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+        )
+
+    def start(self):
+        if self.formato == 'pstats':
+            perfil = cProfile.Profile()
+            perfil.enable()
+            return perfil
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        return sampler
+
+    def stop(self, captura, endpoint):
+        nombre = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{endpoint or 'request'}"
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            if isinstance(captura, cProfile.Profile):
+                captura.disable()
+                ruta = os.path.join(self.directorio, f"{nombre}.pstats")
+                captura.dump_stats(ruta)
+            else:
+                captura.stop()
+                ruta = os.path.join(self.directorio, f"{nombre}.speedscope.json")
+                with open(ruta, 'w', encoding='utf-8') as f:
+                    json.dump(captura.to_speedscope(nombre), f)
+            self._rotate()
+            log.info("PROFILER", "Captura guardada", archivo=os.path.basename(ruta))
+        except Exception as e:
+            log.error("PROFILER", f"No se pudo guardar la captura: {e}")
+
+    def _rotate(self):
+        with self.lock:
+            capturas = self.list_captures(limite=None)
+            for captura in capturas[PROFILE_KEEP:]:
+                try:
+                    os.remove(os.path.join(self.directorio, captura["archivo"]))
+                except OSError:
+                    pass
+
+    def list_captures(self, limite=20):
+        """Capturas más recientes primero"""
+        if not os.path.isdir(self.directorio):
+            return []
+        capturas = []
+        for archivo in os.listdir(self.directorio):
+            if not archivo.endswith(('.speedscope.json', '.pstats')):
+                continue
+            info = os.stat(os.path.join(self.directorio, archivo))
+            capturas.append({
+                "archivo": archivo,
+                "bytes": info.st_size,
+                "fecha": datetime.fromtimestamp(info.st_mtime).isoformat(timespec='seconds')
+            })
+        capturas.sort(key=lambda c: c["archivo"], reverse=True)
+        return capturas[:limite] if limite else capturas
+
+    def path_for(self, archivo):
+        """Ruta de una captura existente (None si el nombre no es válido)"""
+        if archivo != os.path.basename(archivo) or not archivo.endswith(('.speedscope.json', '.pstats')):
+            return None
+        ruta = os.path.join(self.directorio, archivo)
+        return ruta if os.path.isfile(ruta) else None
+
+# Instancia global
+profiler = RequestProfiler()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Estado compartido anti-bucle
+# ═══════════════════════════════════════════════════════════════════════════════
+
+ANTILOOP_BACKEND = os.getenv('ANTILOOP_BACKEND', 'sqlite').lower()  # sqlite | redis | memory
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+OWN_ACCOUNTS_REFRESH_SECONDS = int(os.getenv('OWN_ACCOUNTS_REFRESH_SECONDS', '300'))
+
+
+class MemoryStateBackend:
+    """Estado en memoria del proceso (no se comparte entre workers)"""
+
+    CLEANUP_EVERY = 1000
+
+    def __init__(self):
+        self.data = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.agregadas = 0
+
+    def add(self, namespace, key, ttl):
+        """Agrega la clave si no existe (o expiró). True si se agregó"""
+        ahora = time.time()
+        with self.lock:
+            claves = self.data[namespace]
+            if claves.get(key, 0) > ahora:
+                return False
+            claves[key] = ahora + ttl
+            self.agregadas += 1
+        if self.agregadas % self.CLEANUP_EVERY == 0:
+            self.cleanup()
+        return True
+
+    def contains(self, namespace, key):
+        return self.data[namespace].get(key, 0) > time.time()
+
+    def count(self, namespace):
+        ahora = time.time()
+        return sum(1 for expira in list(self.data[namespace].values()) if expira > ahora)
+
+    def cleanup(self):
+        ahora = time.time()
+        eliminadas = 0
+        with self.lock:
+            for claves in self.data.values():
+                expiradas = [k for k, expira in claves.items() if expira <= ahora]
+                for k in expiradas:
+                    del claves[k]
+                eliminadas += len(expiradas)
+        return eliminadas
+
+
+class SQLiteStateBackend:
+    """Estado en la base SQLite local (WAL): compartido entre los workers de la máquina"""
+
+    def __init__(self):
+        self._tabla_lista = False
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS antibucle_estado (
+                namespace TEXT NOT NULL,
+                clave TEXT NOT NULL,
+                expira REAL NOT NULL,
+                PRIMARY KEY (namespace, clave)
+            ) WITHOUT ROWID
+        """)
+        self._tabla_lista = True
+
+    def add(self, namespace, key, ttl):
+        self._init_table()
+        ahora = time.time()
+        # Inserta, o reemplaza solo si la entrada existente ya expiró (atómico)
+        return get_local_db().execute("""
+            INSERT INTO antibucle_estado (namespace, clave, expira) VALUES (?, ?, ?)
+            ON CONFLICT (namespace, clave) DO UPDATE SET expira = excluded.expira
+            WHERE antibucle_estado.expira <= ?
+        """, (namespace, key, ahora + ttl, ahora)).rowcount == 1
+
+    def contains(self, namespace, key):
+        self._init_table()
+        return get_local_db().execute(
+            "SELECT 1 FROM antibucle_estado WHERE namespace = ? AND clave = ? AND expira > ?",
+            (namespace, key, time.time())
+        ).fetchone() is not None
+
+    def count(self, namespace):
+        self._init_table()
+        return get_local_db().execute(
+            "SELECT COUNT(*) FROM antibucle_estado WHERE namespace = ? AND expira > ?", (namespace, time.time())
+        ).fetchone()[0]
+
+    def cleanup(self):
+        self._init_table()
+        return get_local_db().execute("DELETE FROM antibucle_estado WHERE expira <= ?", (time.time(),)).rowcount
+
+
+class RedisStateBackend:
+    """Estado en Redis (o cualquier servidor compatible): compartido entre máquinas"""
+
+    def __init__(self, client, prefijo='comentarios'):
+        self.client = client
+        self.prefijo = prefijo
+
+    def _key(self, namespace, key):
+        return f"{self.prefijo}:{namespace}:{key}"
+
+    def add(self, namespace, key, ttl):
+        return bool(self.client.set(self._key(namespace, key), 1, nx=True, ex=int(ttl)))
+
+    def contains(self, namespace, key):
+        return bool(self.client.exists(self._key(namespace, key)))
+
+    def count(self, namespace):
+        return sum(1 for _ in self.client.scan_iter(match=f"{self.prefijo}:{namespace}:*", count=1000))
+
+    def cleanup(self):
+        return 0  # Redis expira las claves solo
+
+
+def create_state_backend(tipo=ANTILOOP_BACKEND):
+    """Crea el backend configurado; si Redis no está disponible usa SQLite local"""
+    if tipo == 'memory':
+        return MemoryStateBackend()
+    if tipo == 'redis':
+        try:
+            import redis
+            client = redis.Redis.from_url(REDIS_URL, socket_timeout=2)
+            client.ping()
+            return RedisStateBackend(client)
+        except Exception as e:
+            log.error("ANTI-LOOP", f"Redis no disponible, usando SQLite local: {e}")
+    return SQLiteStateBackend()
+
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # CLASE: Sistema Anti-Bucle
 # ═══════════════════════════════════════════════════════════════════════════════
 
 class AntiLoopSystem:
-    """Previene que el bot responda a sus propios comentarios o procese duplicados"""
+    """
+    Previene que el bot responda a sus propios comentarios o procese duplicados.
+    Los comentarios procesados y las respuestas del bot viven en un backend
+    compartido (ver create_state_backend) para que todos los workers los vean.
+
+    `own_account_ids` es un frozenset por proceso que se reemplaza completo en
+    cada refresco: cada OWN_ACCOUNTS_REFRESH_SECONDS se consultan en segundo
+    plano solo las filas posteriores a la última vista, paginando por
+    (fecha_actualizacion, id) para no perder filas con la misma fecha.
+    """
 
-    def __init__(self):
-        self.processed_comments = {}
-        self.bot_sent_replies = set()
-        self.own_account_ids = set()
-        self.CACHE_EXPIRY = 3600  # 1 hora
+    CACHE_EXPIRY = 3600  # 1 hora
+    BOT_REPLY_EXPIRY = 7 * 24 * 3600
+    ACTION_EXPIRY = 24 * 3600
+    REFRESH_PAGE = 1000
+
+    def __init__(self, backend=None, refresh_interval=OWN_ACCOUNTS_REFRESH_SECONDS):
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self.own_account_ids = frozenset()
+        self._cuentas = {}  # page_id -> (instagram_id, page_id) de cuentas activas
+        self._manuales = set()
+        self._marca_agua = None  # (fecha_actualizacion, id) de la última fila vista
+        self._ultimo_refresco = 0.0
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def state(self):
+        # Creación diferida: el backend puede depender de get_local_db / redis
+        if self.backend is None:
+            self.backend = create_state_backend()
+        return self.backend
 
     def load_own_account_ids(self):
-        """Carga los IDs de las cuentas propias desde Supabase"""
+        """Carga completa de los IDs de las cuentas propias desde Supabase"""
         if not supabase:
             return
         try:
             response = supabase.table("cuentas_instagram")\
-                .select("instagram_id, page_id")\
+                .select("id, instagram_id, page_id, fecha_actualizacion")\
                 .eq("activo", True)\
                 .execute()
 
-            for account in response.data:
-                if account.get('instagram_id'):
-                    self.own_account_ids.add(str(account['instagram_id']))
-                if account.get('page_id'):
-                    self.own_account_ids.add(str(account['page_id']))
+            self._cuentas = {}
+            self._manuales = set()
+            self._marca_agua = None
+            self._aplicar(response.data, completo=True)
+            log.info("ANTI-LOOP", f"Cargados {len(self.own_account_ids)} IDs de cuentas propias")
+        except Exception as e:
+            log.error("ANTI-LOOP", f"Error cargando IDs: {e}")
+        self._ultimo_refresco = time.time()
+
+    def refresh_own_account_ids(self):
+        """Refresco incremental: solo filas actualizadas desde la última marca de agua"""
+        if not supabase:
+            return 0
+        if self._marca_agua is None:
+            self.load_own_account_ids()
+            return len(self._cuentas)
 
-            print(f"[ANTI-LOOP] ✅ Cargados {len(self.own_account_ids)} IDs de cuentas propias")
+        cambios = 0
+        try:
+            while True:
+                # Keyset sobre (fecha_actualizacion, id): primero el resto de filas con la
+                # misma fecha que la marca, después las de fechas posteriores
+                fecha, ultimo_id = self._marca_agua
+                mismas = self._pagina_cuentas(lambda q: q.eq("fecha_actualizacion", fecha).gt("id", ultimo_id))
+                posteriores = [] if len(mismas) == self.REFRESH_PAGE else \
+                    self._pagina_cuentas(lambda q: q.gt("fecha_actualizacion", fecha))
+                cambios += self._aplicar(mismas + posteriores)
+                if len(mismas) < self.REFRESH_PAGE and len(posteriores) < self.REFRESH_PAGE:
+                    break
+            if cambios:
+                log.info("ANTI-LOOP", "Cuentas propias actualizadas", cambios=cambios, total=len(self.own_account_ids))
         except Exception as e:
-            print(f"[ANTI-LOOP] ❌ Error cargando IDs: {e}")
+            log.error("ANTI-LOOP", f"Error refrescando IDs: {e}")
+        self._ultimo_refresco = time.time()
+        return cambios
+
+    def _pagina_cuentas(self, filtro):
+        return filtro(supabase.table("cuentas_instagram")
+                      .select("id, instagram_id, page_id, activo, fecha_actualizacion"))\
+            .order("fecha_actualizacion")\
+            .order("id")\
+            .limit(self.REFRESH_PAGE)\
+            .execute().data or []
+
+    def _aplicar(self, filas, completo=False):
+        """Aplica filas de cuentas_instagram y reemplaza el set de IDs de una vez"""
+        cambios = 0
+        cuentas = dict(self._cuentas)
+        for fila in filas:
+            page_id = str(fila.get('page_id') or '')
+            clave = page_id or f"ig:{fila.get('instagram_id')}"
+            fecha = fila.get('fecha_actualizacion')
+            if fecha and fila.get('id') is not None:
+                # Se compara como fecha con zona: Python y el frontend escriben formatos distintos
+                marca = (parse_utc(fecha), fila['id'])
+                if self._marca_agua is None or marca > (parse_utc(self._marca_agua[0]), self._marca_agua[1]):
+                    self._marca_agua = (fecha, fila['id'])
+            if completo or fila.get('activo', True):
+                valor = (str(fila['instagram_id']) if fila.get('instagram_id') else None, page_id or None)
+                if cuentas.get(clave) != valor:
+                    cuentas[clave] = valor
+                    cambios += 1
+            elif cuentas.pop(clave, None) is not None:
+                cambios += 1
+
+        ids = set(self._manuales)
+        for instagram_id, page_id in cuentas.values():
+            ids.update(i for i in (instagram_id, page_id) if i)
+        self._cuentas = cuentas
+        self.own_account_ids = frozenset(ids)
+        return cambios
+
+    def maybe_refresh(self):
+        """Lanza el refresco incremental en segundo plano si el set está vencido"""
+        if time.time() - self._ultimo_refresco < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        def _run():
+            try:
+                self.refresh_own_account_ids()
+            finally:
+                self._refresh_lock.release()
+
+        self._ultimo_refresco = time.time()
+        threading.Thread(target=_run, name="comentarios-cuentas-propias", daemon=True).start()
 
     def is_own_account(self, user_id):
         """Verifica si un user_id es de una cuenta propia"""
+        self.maybe_refresh()
         return str(user_id) in self.own_account_ids
 
     def is_comment_duplicate(self, comment_id):
-        """Verifica si un comentario ya fue procesado"""
-        return comment_id in self.processed_comments
+        """Verifica si un comentario ya fue procesado (en cualquier worker)"""
+        return self.state.contains('procesados', str(comment_id))
 
     def mark_comment_processed(self, comment_id):
         """Marca un comentario como procesado"""
-        self.processed_comments[comment_id] = time.time()
-        self._cleanup_old_entries()
+        self.state.add('procesados', str(comment_id), self.CACHE_EXPIRY)
+
+    def claim_comment(self, comment_id):
+        """Marca el comentario como procesado; False si otro worker ya lo había marcado"""
+        return self.state.add('procesados', str(comment_id), self.CACHE_EXPIRY)
 
     def mark_bot_reply(self, reply_id):
         """Marca una respuesta como enviada por el bot"""
-        self.bot_sent_replies.add(str(reply_id))
+        self.state.add('respuestas_bot', str(reply_id), self.BOT_REPLY_EXPIRY)
 
     def is_bot_reply(self, comment_id):
         """Verifica si un comentario es una respuesta del bot"""
-        return str(comment_id) in self.bot_sent_replies
+        return self.state.contains('respuestas_bot', str(comment_id))
+
+    def action_done(self, accion, comment_id):
+        """True si la acción ('respuesta', 'dm') ya se ejecutó para el comentario (p. ej. en un intento anterior)"""
+        return self.state.contains('acciones', f"{accion}:{comment_id}")
+
+    def mark_action_done(self, accion, comment_id):
+        """Registra una escritura en Graph ya hecha, para que un reintento no la repita"""
+        self.state.add('acciones', f"{accion}:{comment_id}", self.ACTION_EXPIRY)
 
     def add_own_account(self, account_id):
         """Añade un ID a la lista de cuentas propias"""
-        self.own_account_ids.add(str(account_id))
+        self._manuales.add(str(account_id))
+        self.own_account_ids = self.own_account_ids | {str(account_id)}
+
+    def cleanup(self):
+        """Elimina entradas expiradas del backend"""
+        return self.state.cleanup()
 
-    def _cleanup_old_entries(self):
-        """Limpia entradas antiguas del cache"""
-        current_time = time.time()
-        expired = [k for k, v in self.processed_comments.items()
-                   if current_time - v > self.CACHE_EXPIRY]
-        for k in expired:
-            del self.processed_comments[k]
+    def get_stats(self):
+        return {
+            "backend": type(self.state).__name__,
+            "comentarios_procesados": self.state.count('procesados'),
+            "respuestas_bot": self.state.count('respuestas_bot'),
+            "cuentas_marca_agua": list(self._marca_agua) if self._marca_agua else None,
+            "cuentas_ultimo_refresco": datetime.fromtimestamp(self._ultimo_refresco).isoformat(timespec='seconds')
+            if self._ultimo_refresco else None
+        }
 
 # Instancia global
 anti_loop = AntiLoopSystem()
@@ -185,13 +1025,20 @@ anti_loop = AntiLoopSystem()
 # ═══════════════════════════════════════════════════════════════════════════════
 
 class ConversationHistory:
-    """Mantiene historial de conversaciones para respuestas contextuales en DMs"""
+    """
+    Mantiene historial de conversaciones para respuestas contextuales en DMs.
+    Los turnos antiguos se comprimen en un resumen por usuario (ver
+    schedule_dm_summary) y se eliminan del historial al aplicarlo.
+    """
 
     def __init__(self, max_messages=20, expiry_minutes=60):
         self.histories = defaultdict(list)
         self.last_activity = {}
+        self.summaries = {}
         self.max_messages = max_messages
         self.expiry_minutes = expiry_minutes
+        self._resumiendo = set()
+        self._lock = threading.Lock()
 
     def add_message(self, user_id, role, content):
         self._cleanup_expired(user_id)
@@ -213,6 +1060,32 @@ class ConversationHistory:
             del self.histories[user_id]
         if user_id in self.last_activity:
             del self.last_activity[user_id]
+        self.summaries.pop(user_id, None)
+
+    def get_summary(self, user_id):
+        return self.summaries.get(user_id)
+
+    def messages_to_summarize(self, user_id, conservar):
+        """Mensajes más antiguos que los últimos `conservar`"""
+        history = self.get_history(user_id)
+        return list(history[:-conservar]) if len(history) > conservar else []
+
+    def begin_summary(self, user_id):
+        """Reserva el resumen del usuario (uno a la vez); False si ya hay uno en curso"""
+        with self._lock:
+            if user_id in self._resumiendo:
+                return False
+            self._resumiendo.add(user_id)
+            return True
+
+    def end_summary(self, user_id):
+        with self._lock:
+            self._resumiendo.discard(user_id)
+
+    def apply_summary(self, user_id, resumen, hasta):
+        """Guarda el resumen y descarta los mensajes que cubre (timestamp <= hasta)"""
+        self.summaries[user_id] = resumen
+        self.histories[user_id] = [m for m in self.histories.get(user_id, []) if m["timestamp"] > hasta]
 
     def _cleanup_expired(self, user_id):
         if user_id in self.last_activity:
@@ -238,13 +1111,13 @@ def login_usuario_supabase(usuario, contrasena):
             .execute()
 
         if not result.data:
-            print(f"[LOGIN] Usuario no encontrado: {usuario}")
+            log.info("LOGIN", f"Usuario no encontrado: {usuario}")
             return None
 
         user = result.data[0]
 
         if user['contrasena'] != contrasena:
-            print(f"[LOGIN] Contraseña incorrecta: {usuario}")
+            log.info("LOGIN", f"Contraseña incorrecta: {usuario}")
             return None
 
         # Actualizar último login
@@ -252,11 +1125,11 @@ def login_usuario_supabase(usuario, contrasena):
             'ultimo_login': datetime.now().isoformat()
         }).eq('id', user['id']).execute()
 
-        print(f"[LOGIN] ✅ Login exitoso: {user['nombre']} ({usuario})")
+        log.info("LOGIN", f"Login exitoso: {user['nombre']} ({usuario})")
         return user
 
     except Exception as e:
-        print(f"[LOGIN] Error: {e}")
+        log.error("LOGIN", f"Error: {e}")
         return None
 
 
@@ -277,7 +1150,7 @@ def get_users_from_sheet():
                 users[username] = {'id': user_id, 'password': password}
         return users
     except Exception as e:
-        print(f"[SHEETS] Error obteniendo usuarios: {e}")
+        log.error("SHEETS", f"Error obteniendo usuarios: {e}")
         return {}
 
 
@@ -312,10 +1185,11 @@ def get_user_accounts_supabase(user_id, id_marca=None):
         return accounts
 
     except Exception as e:
-        print(f"[SUPABASE] Error obteniendo cuentas: {e}")
+        log.error("SUPABASE", f"Error obteniendo cuentas: {e}")
         return []
 
 
+@metrics.timed('account_lookup')
 def get_account_by_page_id(page_id):
     """Busca cuenta por page_id en Supabase"""
     if not supabase:
@@ -328,10 +1202,12 @@ def get_account_by_page_id(page_id):
             .execute()
         return response.data[0] if response.data else None
     except Exception as e:
-        print(f"[SUPABASE] Error buscando cuenta por page_id: {e}")
+        log.error("SUPABASE", f"Error buscando cuenta por page_id: {e}")
+        metrics.error('account_lookup')
         return None
 
 
+@metrics.timed('account_lookup')
 def get_account_by_instagram_id(instagram_id):
     """Busca cuenta por instagram_id en Supabase"""
     if not supabase:
@@ -344,10 +1220,12 @@ def get_account_by_instagram_id(instagram_id):
             .execute()
         return response.data[0] if response.data else None
     except Exception as e:
-        print(f"[SUPABASE] Error buscando cuenta por instagram_id: {e}")
+        log.error("SUPABASE", f"Error buscando cuenta por instagram_id: {e}")
+        metrics.error('account_lookup')
         return None
 
 
+@metrics.timed('account_save')
 def save_account_to_supabase(user_id, page_id, page_name, instagram_id, page_access_token, instagram_name=""):
     """Guarda o actualiza cuenta en Supabase"""
     if not supabase:
@@ -366,7 +1244,7 @@ def save_account_to_supabase(user_id, page_id, page_name, instagram_id, page_acc
             'page_access_token': page_access_token,
             'instagram_name': instagram_name,
             'activo': True,
-            'fecha_actualizacion': datetime.now().isoformat()
+            'fecha_actualizacion': utc_now_iso()
         }
 
         if existing.data:
@@ -374,11 +1252,11 @@ def save_account_to_supabase(user_id, page_id, page_name, instagram_id, page_acc
                 .update(data)\
                 .eq("page_id", str(page_id))\
                 .execute()
-            print(f"[SUPABASE] ✅ Cuenta actualizada: {page_name}")
+            log.info("SUPABASE", f"Cuenta actualizada: {page_name}")
         else:
-            data['fecha_conexion'] = datetime.now().isoformat()
+            data['fecha_conexion'] = utc_now_iso()
             supabase.table("cuentas_instagram").insert(data).execute()
-            print(f"[SUPABASE] ✅ Cuenta creada: {page_name}")
+            log.info("SUPABASE", f"Cuenta creada: {page_name}")
 
             # Crear prompt default para nueva marca
             if instagram_id:
@@ -386,7 +1264,7 @@ def save_account_to_supabase(user_id, page_id, page_name, instagram_id, page_acc
 
         return True
     except Exception as e:
-        print(f"[SUPABASE] ❌ Error guardando cuenta: {e}")
+        log.error("SUPABASE", f"Error guardando cuenta: {e}")
         return False
 
 
@@ -411,9 +1289,9 @@ def crear_prompt_default(instagram_id, nombre_marca):
                 "valor": f"Somos el equipo de atención al cliente de {nombre_marca}. Respondemos de forma cálida, cercana y profesional. Nuestro objetivo es generar interés y confianza, indicando que nos pondremos en contacto por inbox para dar más información.",
                 "prioridad": 1
             }).execute()
-            print(f"[SUPABASE] ✅ Prompt default creado para: {nombre_marca}")
+            log.info("SUPABASE", f"Prompt default creado para: {nombre_marca}")
     except Exception as e:
-        print(f"[SUPABASE] Error creando prompt default: {e}")
+        log.error("SUPABASE", f"Error creando prompt default: {e}")
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -423,8 +1301,19 @@ def crear_prompt_default(instagram_id, nombre_marca):
 # Configuración de WhatsApp Business API (Meta)
 WHATSAPP_ACCESS_TOKEN = os.getenv('WHATSAPP_ACCESS_TOKEN')
 WHATSAPP_PHONE_NUMBER_ID = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
-WHATSAPP_API_URL = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/messages" if WHATSAPP_PHONE_NUMBER_ID else None
+WHATSAPP_API_URL = os.getenv('WHATSAPP_API_URL') or (
+    f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/messages" if WHATSAPP_PHONE_NUMBER_ID else None
+)
+
+# Outbox: segundos mínimos entre mensajes al mismo número y ventana de resumen (0 = sin resumen)
+WHATSAPP_MIN_INTERVAL = float(os.getenv('WHATSAPP_MIN_INTERVAL', '6'))
+WHATSAPP_DIGEST_WINDOW = float(os.getenv('WHATSAPP_DIGEST_WINDOW', '0'))
+
+# Sesión HTTP reutilizada para todos los envíos a WhatsApp
+whatsapp_session = requests.Session()
+whatsapp_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=10))
 
+@metrics.timed('admin_lookup')
 def get_admin_phone_by_marca(instagram_id):
     """
     Obtiene el teléfono del administrador (tipo_usuario='adm')
@@ -440,13 +1329,11 @@ def get_admin_phone_by_marca(instagram_id):
             .eq("activo", True)\
             .execute()
 
-        print(f"[ADMIN] Buscando admin para instagram_id: {instagram_id}")
-        print(f"[ADMIN] Cuenta encontrada: {cuenta.data}")
+        log.info("ADMIN", "Buscando admin", brand=instagram_id, cuentas=len(cuenta.data or []))
 
         # OPCIÓN 1: Si cuentas_instagram tiene user_id, buscar directamente por ID
         if cuenta.data and cuenta.data[0].get('user_id'):
             user_id = cuenta.data[0]['user_id']
-            print(f"[ADMIN] Intentando buscar por user_id: {user_id}")
 
             resultado = supabase.table("usuarios")\
                 .select("id, nombre, telefono, id_marca, nombre_marca")\
@@ -454,11 +1341,11 @@ def get_admin_phone_by_marca(instagram_id):
                 .eq("activo", True)\
                 .execute()
 
-            print(f"[ADMIN] Resultado por user_id: {resultado.data}")
+            log.info("ADMIN", "Resultado por user_id", user_id=user_id, usuarios=len(resultado.data or []))
 
             if resultado.data and resultado.data[0].get('telefono'):
                 admin = resultado.data[0]
-                print(f"[ADMIN] ✅ Encontrado por user_id: {admin['nombre']} - Tel: {admin['telefono']}")
+                log.info("ADMIN", "Admin encontrado por user_id", brand=instagram_id, admin_id=admin['id'])
                 return {
                     'id': admin['id'],
                     'nombre': admin['nombre'],
@@ -472,7 +1359,6 @@ def get_admin_phone_by_marca(instagram_id):
         if cuenta.data and cuenta.data[0].get('page_id'):
             buscar_ids.append(str(cuenta.data[0]['page_id']))
 
-        print(f"[ADMIN] Buscando por id_marca en: {buscar_ids}")
 
         for id_marca in buscar_ids:
             resultado = supabase.table("usuarios")\
@@ -482,13 +1368,13 @@ def get_admin_phone_by_marca(instagram_id):
                 .eq("id_marca", id_marca)\
                 .execute()
 
-            print(f"[ADMIN] Resultado para id_marca={id_marca}: {len(resultado.data) if resultado.data else 0} usuarios")
+            log.info("ADMIN", "Resultado por id_marca", id_marca=id_marca, usuarios=len(resultado.data or []))
 
             # Buscar el PRIMER admin que tenga teléfono
             if resultado.data:
                 for admin in resultado.data:
                     if admin.get('telefono'):
-                        print(f"[ADMIN] ✅ Encontrado: {admin['nombre']} - Tel: {admin['telefono']}")
+                        log.info("ADMIN", "Admin encontrado por id_marca", brand=instagram_id, admin_id=admin['id'])
                         return {
                             'id': admin['id'],
                             'nombre': admin['nombre'],
@@ -496,26 +1382,25 @@ def get_admin_phone_by_marca(instagram_id):
                             'id_marca': admin['id_marca'],
                             'nombre_marca': admin.get('nombre_marca', 'Marca')
                         }
-                print(f"[ADMIN] ⚠️ Se encontraron {len(resultado.data)} admins pero ninguno tiene teléfono")
+                log.warning("ADMIN", f"Se encontraron {len(resultado.data)} admins pero ninguno tiene teléfono")
 
-        print(f"[ADMIN] ⚠️ No se encontró admin con teléfono para marca: {instagram_id}")
+        log.warning("ADMIN", f"No se encontró admin con teléfono para marca: {instagram_id}")
         return None
 
     except Exception as e:
-        print(f"[ADMIN] ❌ Error buscando admin: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("ADMIN", f"Error buscando admin: {e}", exc_info=True, brand=instagram_id)
         return None
 
 
+@metrics.timed('task_create')
 def create_approval_task(instagram_id, page_name, post_data, admin_info):
     """
     Crea una tarea de aprobación en Supabase
     """
-    print(f"[TAREA] Iniciando creación de tarea para {page_name}")
+    log.info("TAREA", f"Iniciando creación de tarea para {page_name}")
 
     if not supabase:
-        print(f"[TAREA] ❌ Supabase no disponible")
+        log.error("TAREA", "Supabase no disponible")
         return None
     try:
         caption_preview = post_data.get('caption', 'Sin descripción')[:200]
@@ -544,34 +1429,32 @@ def create_approval_task(instagram_id, page_name, post_data, admin_info):
             "activo": True
         }
 
-        print(f"[TAREA] Insertando tarea: asignado_a={admin_info['id']}")
+        log.info("TAREA", f"Insertando tarea: asignado_a={admin_info['id']}")
         resultado = supabase.table("tareas").insert(tarea).execute()
 
         if resultado.data:
             tarea_id = resultado.data[0]['id']
-            print(f"[TAREA] ✅ Tarea de aprobación creada: #{tarea_id}")
+            log.info("TAREA", f"Tarea de aprobación creada: #{tarea_id}")
             return resultado.data[0]
         else:
-            print(f"[TAREA] ⚠️ Insert no devolvió datos")
+            log.warning("TAREA", "Insert no devolvió datos")
             return None
 
     except Exception as e:
-        print(f"[TAREA] ❌ Error creando tarea: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("TAREA", f"Error creando tarea: {e}", exc_info=True)
         return None
 
 
 def send_whatsapp_approval_request(admin_info, post_data, page_name, tarea_id):
     """
-    Envía mensaje WhatsApp con botones al admin para aprobar/rechazar
-    Usa directamente la API de Meta WhatsApp Business
+    Encola mensaje WhatsApp con botones al admin para aprobar/rechazar.
+    El envío lo hace WhatsAppOutbox (ritmo por número y resumen opcional).
     """
     telefono = admin_info['telefono']
-    print(f"[WHATSAPP] Iniciando envío a {telefono}")
+    log.info("WHATSAPP", f"Encolando aprobación para {telefono}")
 
     if not WHATSAPP_ACCESS_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
-        print(f"[WHATSAPP] ❌ Credenciales no configuradas")
+        log.error("WHATSAPP", "Credenciales no configuradas")
         return False
 
     try:
@@ -625,40 +1508,24 @@ def send_whatsapp_approval_request(admin_info, post_data, page_name, tarea_id):
             }
         }
 
-        print(f"[WHATSAPP] Enviando a API Meta...")
-        response = requests.post(
-            WHATSAPP_API_URL,
-            json=payload,
-            headers={
-                "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-                "Content-Type": "application/json"
-            },
-            timeout=15
-        )
-
-        print(f"[WHATSAPP] Respuesta: {response.status_code}")
-
-        if response.ok:
-            print(f"[WHATSAPP] ✅ Mensaje enviado a {telefono}")
-            return True
-        else:
-            error_msg = response.json().get('error', {}).get('message', response.text[:200])
-            print(f"[WHATSAPP] ❌ Error: {error_msg}")
-            return False
+        resumen = {
+            "tarea_id": tarea_id,
+            "page_name": page_name,
+            "caption": caption_preview
+        }
+        return whatsapp_outbox.enqueue(telefono, payload, tipo='aprobacion', resumen=resumen)
 
     except Exception as e:
-        print(f"[WHATSAPP] ❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("WHATSAPP", f"Error: {e}", exc_info=True)
         return False
 
 
 def send_whatsapp_text(telefono, mensaje):
     """
-    Envía un mensaje de texto simple por WhatsApp
+    Encola un mensaje de texto simple por WhatsApp
     """
     if not WHATSAPP_ACCESS_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
-        print(f"[WHATSAPP] ❌ Credenciales no configuradas")
+        log.error("WHATSAPP", "Credenciales no configuradas")
         return False
 
     try:
@@ -669,8 +1536,18 @@ def send_whatsapp_text(telefono, mensaje):
             "type": "text",
             "text": {"body": mensaje}
         }
+        return whatsapp_outbox.enqueue(telefono, payload, tipo='texto')
 
-        response = requests.post(
+    except Exception as e:
+        log.error("WHATSAPP", f"Error: {e}")
+        return False
+
+
+@metrics.timed('whatsapp_send')
+def post_whatsapp_payload(payload):
+    """Envía un payload a la API de WhatsApp usando la sesión compartida. Retorna (ok, error)"""
+    try:
+        response = whatsapp_session.post(
             WHATSAPP_API_URL,
             json=payload,
             headers={
@@ -679,18 +1556,279 @@ def send_whatsapp_text(telefono, mensaje):
             },
             timeout=15
         )
+        if response.ok:
+            return True, None
+        try:
+            error_msg = response.json().get('error', {}).get('message', response.text[:200])
+        except ValueError:
+            error_msg = response.text[:200]
+        return False, f"{response.status_code}: {error_msg}"
+    except Exception as e:
+        return False, str(e)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Outbox de WhatsApp
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class WhatsAppOutbox:
+    """
+    Cola persistente (SQLite local) de mensajes WhatsApp.
+
+    - Ritmo por número: como máximo un mensaje cada WHATSAPP_MIN_INTERVAL segundos
+      por destinatario (compartido entre workers vía la tabla whatsapp_ritmo).
+    - Modo resumen (WHATSAPP_DIGEST_WINDOW > 0): la ventana parte con la aprobación
+      pendiente más antigua del número; al vencer, todas las pendientes de ese número
+      se envían juntas en un mensaje de lista interactiva.
+    - Las filas se marcan 'enviando' con un lease antes de llamar a la API, así otro
+      worker no envía el mismo mensaje dos veces.
+    - Reintentos con backoff exponencial ante errores de la API.
+    """
+
+    DIGEST_MAX = 3  # 3 tareas x 3 opciones = 9 filas (límite de WhatsApp: 10)
+
+    def __init__(self, min_interval=WHATSAPP_MIN_INTERVAL, digest_window=WHATSAPP_DIGEST_WINDOW,
+                 max_intentos=5, backoff_base=30, intervalo=1, lease=60):
+        self.min_interval = min_interval
+        self.lease = lease
+        self.digest_window = digest_window
+        self.max_intentos = max_intentos
+        self.backoff_base = backoff_base
+        self.intervalo = intervalo
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._tabla_lista = False
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        db = get_local_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS whatsapp_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telefono TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                resumen TEXT,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                disponible_en REAL NOT NULL,
+                ultimo_error TEXT,
+                creado_en TEXT NOT NULL,
+                enviado_en TEXT
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pendientes ON whatsapp_outbox(estado, disponible_en)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS whatsapp_ritmo (
+                telefono TEXT PRIMARY KEY,
+                proximo_envio REAL NOT NULL
+            )
+        """)
+        self._tabla_lista = True
+
+    def enqueue(self, telefono, payload, tipo='texto', resumen=None):
+        """Encola un mensaje. Las aprobaciones esperan la ventana de resumen si está activa"""
+        self._init_table()
+        db = get_local_db()
+        disponible_en = time.time()
+        if tipo == 'aprobacion' and self.digest_window > 0:
+            # La ventana se ancla a la aprobación pendiente más antigua del número
+            ancla = db.execute(
+                "SELECT MIN(disponible_en) FROM whatsapp_outbox "
+                "WHERE telefono = ? AND tipo = 'aprobacion' AND estado = 'pendiente'",
+                (str(telefono),)
+            ).fetchone()[0]
+            disponible_en = ancla if ancla is not None else disponible_en + self.digest_window
+        db.execute(
+            "INSERT INTO whatsapp_outbox (telefono, tipo, payload, resumen, disponible_en, creado_en) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (str(telefono), tipo, json.dumps(payload), json.dumps(resumen) if resumen else None,
+             disponible_en, datetime.now().isoformat())
+        )
+        log.info("WHATSAPP", f"Mensaje encolado ({tipo}) para {telefono}")
+        self.ensure_worker()
+        self._wake.set()
+        return True
 
-        return response.ok
+    def ensure_worker(self):
+        """Inicia el hilo de envío (una vez por proceso)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="whatsapp-outbox", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("WHATSAPP", f"Error en outbox: {e}")
+            self._wake.wait(self.intervalo)
+            self._wake.clear()
+
+    def flush(self):
+        """Envía como máximo un mensaje por número cuyo turno ya llegó"""
+        self._init_table()
+        db = get_local_db()
+        ahora = time.time()
+        telefonos = [r['telefono'] for r in db.execute(
+            "SELECT DISTINCT telefono FROM whatsapp_outbox WHERE estado IN ('pendiente', 'enviando') AND disponible_en <= ?",
+            (ahora,)
+        )]
+        enviados = 0
+        for telefono in telefonos:
+            filas = self._siguiente_lote(telefono, ahora)
+            if filas:
+                self._enviar(filas)
+                enviados += 1
+        return enviados
+
+    def _siguiente_lote(self, telefono, ahora):
+        """
+        Si ya pasó el intervalo mínimo del número, toma su siguiente mensaje vencido
+        (o, en modo resumen, todas sus aprobaciones pendientes), lo marca 'enviando'
+        con un lease y reserva el próximo turno, todo en la misma transacción: un
+        sondeo sin mensajes no consume el turno. Un 'enviando' cuyo lease venció
+        (worker caído) vuelve a tomarse.
+        """
+        db = get_local_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            ritmo = db.execute("SELECT proximo_envio FROM whatsapp_ritmo WHERE telefono = ?", (telefono,)).fetchone()
+            if ritmo and ritmo['proximo_envio'] > ahora:
+                db.execute("COMMIT")
+                return []
+            primera = db.execute(
+                "SELECT * FROM whatsapp_outbox WHERE telefono = ? AND estado IN ('pendiente', 'enviando') "
+                "AND disponible_en <= ? ORDER BY id LIMIT 1",
+                (telefono, ahora)
+            ).fetchone()
+            if not primera:
+                filas = []
+            elif primera['tipo'] != 'aprobacion' or self.digest_window <= 0:
+                filas = [primera]
+            else:
+                filas = db.execute(
+                    "SELECT * FROM whatsapp_outbox WHERE telefono = ? AND tipo = 'aprobacion' "
+                    "AND (estado = 'pendiente' OR (estado = 'enviando' AND disponible_en <= ?)) ORDER BY id LIMIT ?",
+                    (telefono, ahora, self.DIGEST_MAX)
+                ).fetchall()
+            if filas:
+                ids = [f['id'] for f in filas]
+                db.execute(
+                    f"UPDATE whatsapp_outbox SET estado = 'enviando', disponible_en = ? "
+                    f"WHERE id IN ({','.join('?' * len(ids))})",
+                    [ahora + self.lease] + ids
+                )
+                db.execute(
+                    "INSERT INTO whatsapp_ritmo (telefono, proximo_envio) VALUES (?, ?) "
+                    "ON CONFLICT (telefono) DO UPDATE SET proximo_envio = excluded.proximo_envio",
+                    (telefono, ahora + self.min_interval)
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return filas
+
+    def _enviar(self, filas):
+        telefono = filas[0]['telefono']
+        if len(filas) == 1:
+            payload = json.loads(filas[0]['payload'])
+        else:
+            payload = self.build_digest_payload(telefono, [json.loads(f['resumen']) for f in filas])
+
+        ok, error = post_whatsapp_payload(payload)
+        ids = [f['id'] for f in filas]
+        marcas = ','.join('?' * len(ids))
+        db = get_local_db()
+
+        if ok:
+            db.execute(
+                f"UPDATE whatsapp_outbox SET estado = 'enviado', enviado_en = ?, ultimo_error = NULL WHERE id IN ({marcas})",
+                [datetime.now().isoformat()] + ids
+            )
+            log.info("WHATSAPP", f"Mensaje enviado a {telefono} ({len(filas)} elemento(s))")
+            return True
 
-    except Exception as e:
-        print(f"[WHATSAPP] ❌ Error: {e}")
+        intentos = max(f['intentos'] for f in filas) + 1
+        if intentos >= self.max_intentos:
+            db.execute(
+                f"UPDATE whatsapp_outbox SET estado = 'fallido', intentos = ?, ultimo_error = ? WHERE id IN ({marcas})",
+                [intentos, error] + ids
+            )
+            log.error("WHATSAPP", f"Envío a {telefono} descartado tras {intentos} intentos: {error}")
+        else:
+            espera = self.backoff_base * 2 ** (intentos - 1) * random.uniform(0.8, 1.2)
+            db.execute(
+                f"UPDATE whatsapp_outbox SET estado = 'pendiente', intentos = ?, ultimo_error = ?, disponible_en = ? "
+                f"WHERE id IN ({marcas})",
+                [intentos, error, time.time() + espera] + ids
+            )
+            log.warning("WHATSAPP", f"Error enviando a {telefono} ({error}), reintento en {espera:.0f}s")
         return False
 
+    def build_digest_payload(self, telefono, resumenes):
+        """Mensaje de lista interactiva con opciones aprobar/rechazar/modificar por tarea"""
+        page_names = sorted({r.get('page_name') or 'Marca' for r in resumenes})
+        mensaje = f"{len(resumenes)} publicaciones nuevas detectadas\n\nMarca: {', '.join(page_names)}\n"
+        sections = []
+        for r in resumenes:
+            tarea_id = r['tarea_id']
+            mensaje += f"\n#{tarea_id}: {(r.get('caption') or 'Sin descripción')[:80]}..."
+            sections.append({
+                "title": f"Tarea #{tarea_id}"[:24],
+                "rows": [
+                    {"id": f"aprobar_{tarea_id}", "title": f"Si, aprobar #{tarea_id}"[:24]},
+                    {"id": f"rechazar_{tarea_id}", "title": f"No, rechazar #{tarea_id}"[:24]},
+                    {"id": f"modificar_{tarea_id}", "title": f"Modificar #{tarea_id}"[:24]}
+                ]
+            })
+        mensaje += "\n\nDeseas usar estas publicaciones para respuestas automaticas? Elige una opcion por tarea."
+
+        return {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": telefono,
+            "type": "interactive",
+            "interactive": {
+                "type": "list",
+                "body": {"text": mensaje[:1024]},
+                "action": {
+                    "button": "Ver opciones",
+                    "sections": sections
+                }
+            }
+        }
+
+    def pending_count(self):
+        self._init_table()
+        return get_local_db().execute(
+            "SELECT COUNT(*) FROM whatsapp_outbox WHERE estado IN ('pendiente', 'enviando')"
+        ).fetchone()[0]
+
+    def get_stats(self):
+        """Conteo de mensajes por estado (para diagnóstico)"""
+        self._init_table()
+        return {r['estado']: r['total'] for r in get_local_db().execute(
+            "SELECT estado, COUNT(*) AS total FROM whatsapp_outbox GROUP BY estado"
+        )}
+
+# Instancia global
+whatsapp_outbox = WhatsAppOutbox()
+metrics.gauge("comentarios_queue_depth", whatsapp_outbox.pending_count, queue="whatsapp_outbox")
+
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # FUNCIONES DE SUPABASE - DATOS DE MARCA (PROMPTS Y PUBLICACIONES)
 # ═══════════════════════════════════════════════════════════════════════════════
 
+@metrics.timed('brand_data')
 def get_brand_data(instagram_id):
     """Obtiene datos de marca con sistema de prioridades"""
     if not supabase:
@@ -703,7 +1841,7 @@ def get_brand_data(instagram_id):
             .execute()
 
         if not response.data:
-            print(f"[SUPABASE] No se encontró marca: {instagram_id}")
+            log.info("SUPABASE", f"No se encontró marca: {instagram_id}")
             return None
 
         datos_marca = response.data
@@ -711,7 +1849,8 @@ def get_brand_data(instagram_id):
 
         return organizar_datos_marca(datos_marca, nombre_marca)
     except Exception as e:
-        print(f"[SUPABASE] Error obteniendo datos de marca: {e}")
+        log.error("SUPABASE", f"Error obteniendo datos de marca: {e}")
+        metrics.error('brand_data')
         return None
 
 
@@ -724,7 +1863,10 @@ def organizar_datos_marca(datos_marca, nombre_marca):
         "si_relevante": [],         # prioridad 2-3 (incluye publicaciones)
         "solo_si_pregunta": [],     # prioridad 4+
         "promociones_activas": [],
-        "publicaciones_recientes": []
+        "publicaciones_recientes": [],
+        "plantillas": {},           # intención -> {"publica": [...], "inbox": [...]}
+        "palabras_intencion": {},   # intención -> palabras clave propias de la marca
+        "hechos": {}                # clave -> valor (para rellenar plantillas)
     }
 
     for dato in datos_marca:
@@ -734,6 +1876,15 @@ def organizar_datos_marca(datos_marca, nombre_marca):
         valor = dato.get("valor", "")
         fecha_caducidad = dato.get("fecha_caducidad")
 
+        # Plantillas de respuesta por intención (no van al prompt)
+        if categoria in ["plantilla_publica", "plantilla_inbox"]:
+            tipo = "publica" if categoria == "plantilla_publica" else "inbox"
+            datos["plantillas"].setdefault(clave, {"publica": [], "inbox": []})[tipo].append(valor)
+            continue
+        if categoria == "intencion_palabras":
+            datos["palabras_intencion"][clave] = [p.strip() for p in valor.split(",") if p.strip()]
+            continue
+
         # Manejar promociones
         if categoria in ["promocion", "promo"]:
             if fecha_caducidad:
@@ -744,6 +1895,7 @@ def organizar_datos_marca(datos_marca, nombre_marca):
                 except:
                     pass
             datos["promociones_activas"].append({"clave": clave, "valor": valor})
+            datos["hechos"][clave] = valor
             continue
 
         # Manejar publicaciones
@@ -754,6 +1906,7 @@ def organizar_datos_marca(datos_marca, nombre_marca):
             continue
 
         # Clasificar por prioridad
+        datos["hechos"][clave] = valor
         dato_simple = {"categoria": categoria, "clave": clave, "valor": valor}
         if prioridad == 1:
             datos["siempre_incluir"].append(dato_simple)
@@ -762,10 +1915,12 @@ def organizar_datos_marca(datos_marca, nombre_marca):
         else:
             datos["solo_si_pregunta"].append(dato_simple)
 
-    print(f"[SUPABASE] Datos de {nombre_marca}: P1={len(datos['siempre_incluir'])}, P2-3={len(datos['si_relevante'])}, Promos={len(datos['promociones_activas'])}, Posts={len(datos['publicaciones_recientes'])}")
+    log.info("SUPABASE", f"Datos de {nombre_marca}", p1=len(datos['siempre_incluir']), p2_3=len(datos['si_relevante']),
+             promos=len(datos['promociones_activas']), posts=len(datos['publicaciones_recientes']))
     return datos
 
 
+@metrics.timed('post_save')
 def save_post_to_base_cuentas(instagram_id, page_name, post_data, estado_aprobacion='activo'):
     """
     Guarda una publicación nueva en base_cuentas con categoría 'publicacion' y prioridad 2
@@ -799,7 +1954,7 @@ def save_post_to_base_cuentas(instagram_id, page_name, post_data, estado_aprobac
             .execute()
 
         if existing.data:
-            print(f"[SUPABASE] Publicación ya existe: {post_id}")
+            log.info("SUPABASE", f"Publicación ya existe: {post_id}")
             return False
 
         # Construir valor con info útil
@@ -824,14 +1979,17 @@ def save_post_to_base_cuentas(instagram_id, page_name, post_data, estado_aprobac
             "estado_aprobacion": estado_aprobacion
         }).execute()
 
-        print(f"[SUPABASE] ✅ Publicación guardada ({estado_aprobacion}): {post_id} ({media_type})")
+        if estado_activo:
+            brand_context_cache.invalidate(instagram_id)
+        log.info("SUPABASE", f"Publicación guardada ({estado_aprobacion}): {post_id} ({media_type})")
         return True
 
     except Exception as e:
-        print(f"[SUPABASE] ❌ Error guardando publicación: {e}")
+        log.error("SUPABASE", f"Error guardando publicación: {e}")
         return False
 
 
+@metrics.timed('prompt_lookup')
 def get_prompt_from_supabase(instagram_id):
     """Obtiene el prompt activo de una marca"""
     if not supabase:
@@ -850,7 +2008,7 @@ def get_prompt_from_supabase(instagram_id):
             return response.data[0].get("valor")
         return None
     except Exception as e:
-        print(f"[SUPABASE] Error obteniendo prompt: {e}")
+        log.error("SUPABASE", f"Error obteniendo prompt: {e}")
         return None
 
 
@@ -858,6 +2016,7 @@ def get_prompt_from_supabase(instagram_id):
 # FUNCIONES DE SUPABASE - LOGS Y LOCKS
 # ═══════════════════════════════════════════════════════════════════════════════
 
+@metrics.timed('lock')
 def acquire_comment_lock(comment_id, instagram_id, platform="instagram"):
     """Intenta adquirir un lock para procesar un comentario (evita duplicados)"""
     if not supabase:
@@ -870,7 +2029,8 @@ def acquire_comment_lock(comment_id, instagram_id, platform="instagram"):
             .execute()
 
         if existing.data:
-            print(f"[LOCK] Ya existe lock para: {comment_id}")
+            log.info("LOCK", "Ya existe lock", comment_id=comment_id)
+            metrics.cache('comment_lock', True)
             return False
 
         # Crear lock
@@ -881,71 +2041,439 @@ def acquire_comment_lock(comment_id, instagram_id, platform="instagram"):
             "created_at": datetime.now().isoformat()
         }).execute()
 
-        print(f"[LOCK] ✅ Lock adquirido: {comment_id}")
+        log.info("LOCK", "Lock adquirido", comment_id=comment_id, brand=instagram_id)
+        metrics.cache('comment_lock', False)
         return True
 
     except Exception as e:
         if 'duplicate' in str(e).lower() or 'unique' in str(e).lower():
-            print(f"[LOCK] Duplicado detectado: {comment_id}")
+            log.info("LOCK", "Duplicado detectado", comment_id=comment_id)
+            metrics.cache('comment_lock', True)
             return False
-        print(f"[LOCK] Error: {e}")
+        log.error("LOCK", f"Error: {e}", comment_id=comment_id)
+        metrics.error('lock')
         return True  # En caso de error, permitir procesamiento
 
 
-def save_comment_log(instagram_id, nombre_marca, post_description, comment_text, respuestas, platform="instagram", comment_id=None, sender_id=None, media_id=None, respuesta_enviada=False, dm_enviado=False):
-    """Guarda log de comentario procesado con todos los campos disponibles"""
+@metrics.timed('log_write')
+def save_comment_log(instagram_id, nombre_marca, post_description, comment_text, respuestas, platform="instagram", comment_id=None, sender_id=None, media_id=None, respuesta_enviada=False, dm_enviado=False, procesado_en=None):
+    """
+    Guarda log de comentario procesado con todos los campos disponibles.
+    procesado_en (ISO UTC) solo viene al replicar una escritura diferida.
+    """
     if not supabase:
         return
+    if load_shedder.defer_write("logs_comentarios", {
+        "instagram_id": instagram_id, "nombre_marca": nombre_marca, "post_description": post_description,
+        "comment_text": comment_text, "respuestas": respuestas, "platform": platform, "comment_id": comment_id,
+        "sender_id": sender_id, "media_id": media_id, "respuesta_enviada": respuesta_enviada, "dm_enviado": dm_enviado,
+        "procesado_en": utc_now_iso()
+    }):
+        return
+
+    fila = {
+        "id_marca": str(instagram_id),
+        "nombre_marca": nombre_marca,
+        "texto_publicacion": post_description[:1000] if post_description else "",
+        "comentario_original": comment_text[:1000] if comment_text else "",
+        "es_inapropiado": respuestas.get("es_inapropiado", False),
+        "razon_inapropiado": respuestas.get("razon_inapropiado"),
+        "respuesta_comentario": respuestas.get("respuesta_comentario"),
+        "mensaje_inbox": respuestas.get("mensaje_inbox"),
+        "plataforma": platform,
+        "comment_id": comment_id,
+        "sender_id": str(sender_id) if sender_id else None,
+        "media_id": str(media_id) if media_id else None,
+        "respuesta_enviada": respuesta_enviada,
+        "dm_enviado": dm_enviado
+    }
+    if procesado_en:
+        fila["creado_en"] = procesado_en
+    if surge_detector.buffer_log(media_id, fila):
+        return
+
     try:
-        supabase.table("logs_comentarios").insert({
-            "id_marca": str(instagram_id),
-            "nombre_marca": nombre_marca,
-            "texto_publicacion": post_description[:1000] if post_description else "",
-            "comentario_original": comment_text[:1000] if comment_text else "",
-            "es_inapropiado": respuestas.get("es_inapropiado", False),
-            "razon_inapropiado": respuestas.get("razon_inapropiado"),
-            "respuesta_comentario": respuestas.get("respuesta_comentario"),
-            "mensaje_inbox": respuestas.get("mensaje_inbox"),
-            "plataforma": platform,
-            "comment_id": comment_id,
-            "sender_id": str(sender_id) if sender_id else None,
-            "media_id": str(media_id) if media_id else None,
-            "respuesta_enviada": respuesta_enviada,
-            "dm_enviado": dm_enviado
-        }).execute()
-        print(f"[SUPABASE] ✅ Log guardado: {comment_id}")
+        supabase.table("logs_comentarios").insert(fila).execute()
+        log.info("SUPABASE", "Log guardado", comment_id=comment_id, brand=instagram_id)
     except Exception as e:
-        print(f"[SUPABASE] Error guardando log: {e}")
+        log.error("SUPABASE", f"Error guardando log: {e}", comment_id=comment_id, brand=instagram_id)
+        metrics.error('log_write')
 
 
-def cleanup_old_locks():
-    """Limpia locks antiguos (más de 24 horas)"""
+def process_in_chunks(select_ids, apply_ids, chunk=500, max_chunks=20, pausa=0.2):
+    """
+    Procesa filas por lotes: select_ids(limit) retorna IDs, apply_ids(ids) los modifica.
+    Se detiene cuando no quedan filas o tras max_chunks lotes (con pausa entre lotes).
+    """
+    total = 0
+    for i in range(max_chunks):
+        ids = select_ids(chunk)
+        if not ids:
+            break
+        apply_ids(ids)
+        total += len(ids)
+        if len(ids) < chunk:
+            break
+        time.sleep(pausa)
+    return total
+
+
+def cleanup_old_locks(horas=24, chunk=500, max_chunks=20):
+    """Limpia locks antiguos (más de 24 horas) en lotes"""
     if not supabase:
         return 0
     try:
-        limite = (datetime.now() - timedelta(hours=24)).isoformat()
-        result = supabase.table("comment_locks").delete().lt("created_at", limite).execute()
-        eliminados = len(result.data) if result.data else 0
+        limite = (datetime.now() - timedelta(hours=horas)).isoformat()
+        eliminados = process_in_chunks(
+            lambda n: [r['comment_id'] for r in supabase.table("comment_locks")
+                       .select("comment_id").lt("created_at", limite).limit(n).execute().data],
+            lambda ids: supabase.table("comment_locks").delete().in_("comment_id", ids).execute(),
+            chunk=chunk, max_chunks=max_chunks
+        )
         if eliminados > 0:
-            print(f"[CLEANUP] Locks eliminados: {eliminados}")
+            log.info("CLEANUP", f"Locks eliminados: {eliminados}")
         return eliminados
     except Exception as e:
-        print(f"[CLEANUP] Error: {e}")
+        log.error("CLEANUP", f"Error: {e}")
         return 0
 
 
-# ═══════════════════════════════════════════════════════════════════════════════
-# FUNCIONES DE GOOGLE SHEETS (FALLBACK)
-# ═══════════════════════════════════════════════════════════════════════════════
+def deactivate_expired_base_cuentas(chunk=200, max_chunks=20):
+    """Desactiva publicaciones y promociones de base_cuentas con fecha_caducidad vencida"""
+    if not supabase:
+        return 0
+    hoy = datetime.now().date().isoformat()
+    marcas = set()
 
-def get_user_accounts_sheets(user_id):
-    """Obtiene cuentas desde Google Sheets (fallback)"""
-    if not sheet:
-        return []
-    try:
-        response = sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='user_instagram_accounts!A:E'
+    def vencidas(n):
+        filas = supabase.table("base_cuentas")\
+            .select('id, "ID marca"')\
+            .eq("Estado", True)\
+            .in_("categoria", ["publicacion", "promocion", "promo"])\
+            .lt("fecha_caducidad", hoy)\
+            .limit(n).execute().data
+        marcas.update(str(r['ID marca']) for r in filas if r.get('ID marca'))
+        return [r['id'] for r in filas]
+
+    desactivados = process_in_chunks(
+        vencidas,
+        lambda ids: supabase.table("base_cuentas").update({"Estado": False}).in_("id", ids).execute(),
+        chunk=chunk, max_chunks=max_chunks
+    )
+    # Las promociones vencidas no deben seguir en el contexto cacheado de las marcas
+    for marca in marcas:
+        brand_context_cache.invalidate(marca)
+    if desactivados > 0:
+        log.info("CLEANUP", f"Publicaciones/promos caducadas desactivadas: {desactivados}", marcas=len(marcas))
+    return desactivados
+
+
+def cleanup_old_comment_logs(dias, chunk=500, max_chunks=20):
+    """Elimina logs_comentarios más antiguos que `dias` (0 = conservar todo)"""
+    if not supabase or dias <= 0:
+        return 0
+    limite = (datetime.now() - timedelta(days=dias)).isoformat()
+    eliminados = process_in_chunks(
+        lambda n: [r['id'] for r in supabase.table("logs_comentarios")
+                   .select("id").lt("creado_en", limite).limit(n).execute().data],
+        lambda ids: supabase.table("logs_comentarios").delete().in_("id", ids).execute(),
+        chunk=chunk, max_chunks=max_chunks
+    )
+    if eliminados > 0:
+        log.info("CLEANUP", f"Logs de comentarios eliminados: {eliminados}")
+    return eliminados
+
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+EXPORT_COLUMNS = [
+    "id", "creado_en", "id_marca", "nombre_marca", "plataforma", "media_id", "comment_id", "sender_id",
+    "comentario_original", "respuesta_comentario", "mensaje_inbox", "es_inapropiado", "razon_inapropiado",
+    "respuesta_enviada", "dm_enviado", "texto_publicacion"
+]
+
+
+def iter_comment_logs(marcas, desde=None, hasta=None, chunk=EXPORT_CHUNK_SIZE, columnas=EXPORT_COLUMNS):
+    """
+    Recorre logs_comentarios de las marcas en orden de id con paginación por
+    keyset (id > último visto), de a `chunk` filas: memoria constante sin
+    importar el rango.
+    """
+    ultimo_id = 0
+    while True:
+        query = supabase.table("logs_comentarios")\
+            .select(",".join(columnas))\
+            .in_("id_marca", [str(m) for m in marcas])\
+            .gt("id", ultimo_id)
+        if desde:
+            query = query.gte("creado_en", desde)
+        if hasta:
+            query = query.lt("creado_en", hasta)
+        with metrics.timer('export_chunk'):
+            filas = query.order("id").limit(chunk).execute().data or []
+        yield from filas
+        if len(filas) < chunk:
+            return
+        ultimo_id = filas[-1]["id"]
+
+
+def stream_comment_logs(filas, formato):
+    """Serializa filas como CSV (con encabezado) o NDJSON, una línea a la vez"""
+    if formato == 'ndjson':
+        for fila in filas:
+            yield json.dumps(fila, ensure_ascii=False, default=str) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for fila in filas:
+        writer.writerow(fila)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()  # solo encabezado si no hubo filas
+
+
+@metrics.timed('search')
+def search_comment_logs(consulta, marcas, plataforma=None, inapropiado=None, pagina=1, por_pagina=20):
+    """
+    Búsqueda de texto completo en logs_comentarios (función buscar_comentarios,
+    ver sql/logs_comentarios_busqueda.sql). Devuelve (filas, hay_mas).
+    """
+    filas = supabase.rpc("buscar_comentarios", {
+        "p_consulta": consulta,
+        "p_marcas": [str(m) for m in marcas],
+        "p_plataforma": plataforma,
+        "p_inapropiado": inapropiado,
+        "p_limite": por_pagina,
+        "p_offset": (pagina - 1) * por_pagina
+    }).execute().data or []
+    return filas[:por_pagina], len(filas) > por_pagina
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Analítica de interacción por marca
+# ═══════════════════════════════════════════════════════════════════════════════
+
+ANALYTICS_DAYS = int(os.getenv('ANALYTICS_DAYS', '30'))  # período actual; se compara con el anterior de igual largo
+ANALYTICS_CACHE_SECONDS = int(os.getenv('ANALYTICS_CACHE_SECONDS', '600'))
+ANALYTICS_TZ = os.getenv('ANALYTICS_TZ', 'America/Santiago')  # zona de los heatmaps hora/día
+ANALYTICS_INFORMES_FILE = os.getenv(
+    'ANALYTICS_INFORMES_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'informes_instagram_rows.json')
+)
+
+ANALYTICS_LOG_COLUMNS = ["id", "creado_en", "id_marca", "es_inapropiado", "respuesta_enviada", "dm_enviado"]
+ANALYTICS_INFORME_COLUMNS = [
+    "instagram_id", "nombre_marca", "periodo_desde", "periodo_hasta", "total_posts", "total_likes",
+    "total_comments", "total_reach", "total_impressions", "total_saves", "total_shares", "engagement_rate",
+    "followers_count", "bot_total", "bot_respondidos", "bot_inapropiados"
+]
+ANALYTICS_INFORME_METRICS = [
+    "total_posts", "total_likes", "total_comments", "total_reach", "engagement_rate", "followers_count",
+    "bot_total", "bot_respondidos", "bot_inapropiados", "tasa_respuesta_bot"
+]
+
+
+def _json_numero(valor, decimales=4):
+    """float/int de NumPy a JSON (NaN e infinitos -> None)"""
+    valor = float(valor)
+    if valor != valor or valor in (float('inf'), float('-inf')):
+        return None
+    return int(valor) if valor.is_integer() else round(valor, decimales)
+
+
+class EngagementAnalytics:
+    """
+    Métricas de interacción de varias marcas en una pasada vectorizada (NumPy/pandas,
+    importados al primer uso):
+
+    - logs_comentarios de los últimos 2 x dias (lectura por keyset) en columnas:
+      tasa de respuesta del bot, tasa de inapropiados y de DMs, heatmap día x hora
+      y variación contra el período anterior. Todas las marcas se cuentan juntas
+      con np.bincount sobre el código de marca.
+    - informes_instagram (o el export local informes_instagram_rows.json si no hay
+      Supabase): último informe por marca y su delta contra el anterior. Sin
+      Supabase las métricas de comentarios quedan en cero.
+
+    Los resultados se cachean por (marcas, dias) durante ANALYTICS_CACHE_SECONDS.
+    """
+
+    def __init__(self, ttl=ANALYTICS_CACHE_SECONDS, zona=ANALYTICS_TZ, archivo_informes=ANALYTICS_INFORMES_FILE):
+        self.ttl = ttl
+        self.zona = zona
+        self.archivo_informes = archivo_informes
+        self._cache = {}
+
+    @staticmethod
+    def _librerias():
+        import numpy as np
+        import pandas as pd
+        return np, pd
+
+    def report(self, marcas, dias=ANALYTICS_DAYS):
+        clave = (tuple(sorted(str(m) for m in marcas)), dias)
+        entrada = self._cache.get(clave)
+        vigente = entrada is not None and entrada["expira"] > time.time()
+        metrics.cache('analytics', vigente)
+        if vigente:
+            return entrada["resultado"]
+
+        inicio = time.perf_counter()
+        with metrics.timer('analytics'):
+            resultado = self._calcular(list(clave[0]), dias)
+        ahora = time.time()
+        self._cache = {k: v for k, v in self._cache.items() if v["expira"] > ahora}
+        self._cache[clave] = {"resultado": resultado, "expira": ahora + self.ttl}
+        log.info("ANALITICA", "Informe calculado", marcas=len(clave[0]), dias=dias,
+                 comentarios=resultado["totales"]["comentarios"]["actual"],
+                 ms=round((time.perf_counter() - inicio) * 1000))
+        return resultado
+
+    def invalidate(self):
+        self._cache.clear()
+
+    # ── Carga columnar ──
+
+    def _cargar_logs(self, pd, marcas, desde):
+        if not supabase:
+            return pd.DataFrame(columns=ANALYTICS_LOG_COLUMNS)
+        filas = iter_comment_logs(marcas, desde=desde.isoformat(), columnas=ANALYTICS_LOG_COLUMNS)
+        return pd.DataFrame.from_records(filas, columns=ANALYTICS_LOG_COLUMNS)
+
+    def _cargar_informes(self, pd, marcas):
+        if supabase:
+            filas = supabase.table("informes_instagram")\
+                .select(",".join(ANALYTICS_INFORME_COLUMNS))\
+                .in_("instagram_id", marcas)\
+                .execute().data or []
+        elif os.path.exists(self.archivo_informes):
+            with open(self.archivo_informes, encoding='utf-8') as f:
+                filas = [r for r in json.load(f) if str(r.get("instagram_id")) in set(marcas)]
+        else:
+            filas = []
+        return pd.DataFrame.from_records(filas, columns=ANALYTICS_INFORME_COLUMNS)
+
+    # ── Cálculo ──
+
+    def _calcular(self, marcas, dias):
+        np, pd = self._librerias()
+        ahora = pd.Timestamp.now(tz=self.zona)
+        corte = ahora - pd.Timedelta(days=dias)
+        logs = self._cargar_logs(pd, marcas, (corte - pd.Timedelta(days=dias)).tz_convert('UTC'))
+        informes = self._cargar_informes(pd, marcas)
+
+        comentarios = self._metricas_logs(np, pd, logs, marcas, corte)
+        por_informe = self._metricas_informes(np, pd, informes)
+
+        resultado_marcas = {}
+        for i, marca in enumerate(marcas):
+            resultado_marcas[marca] = {
+                "comentarios": {nombre: self._periodo(valores[0][i], valores[1][i])
+                                for nombre, valores in comentarios["series"].items()},
+                "heatmap_dia_hora": comentarios["heatmap"][i].tolist(),
+                "informe": por_informe.get(marca)
+            }
+
+        totales = {nombre: self._periodo(valores[0].sum(), valores[1].sum())
+                   for nombre, valores in comentarios["conteos"].items()}
+        for tasa, (numerador, denominador) in {"tasa_respuesta_bot": ("respondidos", "comentarios"),
+                                                "tasa_inapropiados": ("inapropiados", "comentarios"),
+                                                "tasa_dm": ("dms", "comentarios")}.items():
+            totales[tasa] = self._periodo(*[
+                comentarios["conteos"][numerador][p].sum() / max(comentarios["conteos"][denominador][p].sum(), 1)
+                for p in (0, 1)
+            ])
+
+        return {
+            "generado_en": datetime.now().isoformat(),
+            "periodo": {"dias": dias, "desde": corte.isoformat(), "hasta": ahora.isoformat(), "zona": self.zona},
+            "heatmap_ejes": {"filas": "día (0 = lunes)", "columnas": "hora"},
+            "totales": dict(totales, heatmap_dia_hora=comentarios["heatmap"].sum(axis=0).tolist()),
+            "marcas": resultado_marcas
+        }
+
+    @staticmethod
+    def _periodo(actual, anterior):
+        actual, anterior = float(actual), float(anterior)
+        return {
+            "actual": _json_numero(actual),
+            "anterior": _json_numero(anterior),
+            "delta": _json_numero(actual - anterior),
+            "delta_pct": _json_numero((actual - anterior) / anterior * 100, 1) if anterior else None
+        }
+
+    def _metricas_logs(self, np, pd, logs, marcas, corte):
+        n = len(marcas)
+        fechas = pd.to_datetime(logs["creado_en"], utc=True, errors='coerce', format='ISO8601').dt.tz_convert(self.zona)
+        codigos = pd.Categorical(logs["id_marca"].astype(str), categories=marcas).codes
+        validos = (codigos >= 0) & fechas.notna().to_numpy()
+        actual = (fechas >= corte).to_numpy() & validos
+        anterior = validos & ~actual
+
+        def bandera(columna):
+            return logs[columna].fillna(False).astype(bool).to_numpy()
+
+        banderas = {"comentarios": np.ones(len(logs), dtype=bool), "respondidos": bandera("respuesta_enviada"),
+                    "inapropiados": bandera("es_inapropiado"), "dms": bandera("dm_enviado")}
+        conteos = {nombre: (np.bincount(codigos[actual & b], minlength=n), np.bincount(codigos[anterior & b], minlength=n))
+                   for nombre, b in banderas.items()}
+
+        series = dict(conteos)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for tasa, numerador in {"tasa_respuesta_bot": "respondidos", "tasa_inapropiados": "inapropiados",
+                                    "tasa_dm": "dms"}.items():
+                series[tasa] = tuple(conteos[numerador][p] / conteos["comentarios"][p] for p in (0, 1))
+
+        celdas = (fechas.dt.dayofweek * 24 + fechas.dt.hour).fillna(0).to_numpy(dtype=np.int64)
+        heatmap = np.bincount(codigos[actual].astype(np.int64) * 168 + celdas[actual], minlength=n * 168)
+        return {"conteos": conteos, "series": series, "heatmap": heatmap.reshape(n, 7, 24)}
+
+    def _metricas_informes(self, np, pd, informes):
+        if informes.empty:
+            return {}
+        informes = informes.copy()
+        informes["instagram_id"] = informes["instagram_id"].astype(str)
+        for columna in ANALYTICS_INFORME_METRICS[:-1]:
+            informes[columna] = pd.to_numeric(informes[columna], errors='coerce')
+        informes["tasa_respuesta_bot"] = informes["bot_respondidos"] / informes["bot_total"].where(informes["bot_total"] > 0)
+        informes = informes.sort_values(["instagram_id", "periodo_hasta", "periodo_desde"], kind='stable')
+
+        grupos = informes.groupby("instagram_id", sort=False)
+        ultimo = grupos.tail(1).set_index("instagram_id")
+        previo = informes[grupos.cumcount(ascending=False) == 1].set_index("instagram_id").reindex(ultimo.index)
+        valores = ultimo[ANALYTICS_INFORME_METRICS].to_numpy(dtype=float)
+        deltas = valores - previo[ANALYTICS_INFORME_METRICS].to_numpy(dtype=float)
+
+        resultado = {}
+        for i, marca in enumerate(ultimo.index):
+            resultado[marca] = {
+                "nombre_marca": ultimo["nombre_marca"].iloc[i],
+                "periodo_desde": str(ultimo["periodo_desde"].iloc[i]),
+                "periodo_hasta": str(ultimo["periodo_hasta"].iloc[i]),
+                "informes": int(grupos.size()[marca]),
+                "ultimo": {c: _json_numero(v) for c, v in zip(ANALYTICS_INFORME_METRICS, valores[i])},
+                "delta_vs_anterior": {c: _json_numero(v) for c, v in zip(ANALYTICS_INFORME_METRICS, deltas[i])}
+            }
+        return resultado
+
+# Instancia global
+engagement_analytics = EngagementAnalytics()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FUNCIONES DE GOOGLE SHEETS (FALLBACK)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def get_user_accounts_sheets(user_id):
+    """Obtiene cuentas desde Google Sheets (fallback)"""
+    if not sheet:
+        return []
+    try:
+        response = sheet.values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range='user_instagram_accounts!A:E'
         ).execute()
         values = response.get('values', [])
         accounts = []
@@ -959,7 +2487,7 @@ def get_user_accounts_sheets(user_id):
                 })
         return accounts
     except Exception as e:
-        print(f"[SHEETS] Error: {e}")
+        log.error("SHEETS", f"Error: {e}")
         return []
 
 
@@ -979,10 +2507,11 @@ def get_prompt_from_sheets(user_id):
                 return row[2]
         return None
     except Exception as e:
-        print(f"[SHEETS] Error: {e}")
+        log.error("SHEETS", f"Error: {e}")
         return None
 
 
+@metrics.timed('sheets_write')
 def save_to_sheets_user_accounts(user_id, page_id, page_name, instagram_id, page_access_token):
     """Guarda cuenta en Google Sheets (fallback)"""
     if not sheet:
@@ -997,21 +2526,49 @@ def save_to_sheets_user_accounts(user_id, page_id, page_name, instagram_id, page
             insertDataOption='INSERT_ROWS',
             body=body
         ).execute()
-        print(f"[SHEETS] ✅ Cuenta guardada: {page_name}")
+        log.info("SHEETS", f"Cuenta guardada: {page_name}")
+    except Exception as e:
+        log.error("SHEETS", f"Error guardando cuenta: {e}")
+
+
+def save_accounts_to_sheets(user_id, cuentas):
+    """Guarda varias cuentas en Google Sheets con un solo append (fallback)"""
+    if not sheet or not cuentas:
+        return
+    try:
+        values = [[user_id, c['page_id'], c['page_name'], c['instagram_id'] or '', c['page_access_token']] for c in cuentas]
+        sheet.values().append(
+            spreadsheetId=SPREADSHEET_ID,
+            range='user_instagram_accounts',
+            valueInputOption='RAW',
+            insertDataOption='INSERT_ROWS',
+            body={'values': values}
+        ).execute()
+        log.info("SHEETS", f"{len(values)} cuenta(s) guardada(s)")
     except Exception as e:
-        print(f"[SHEETS] Error guardando cuenta: {e}")
+        log.error("SHEETS", f"Error guardando cuentas: {e}")
 
 
-def save_comment_to_sheets(sender_name, sender_id, message, post_id, comment_id, platform, user_id_owner, reply_message, inbox_message):
-    """Guarda comentario en Google Sheets (fallback)"""
+@metrics.timed('sheets_write')
+def save_comment_to_sheets(sender_name, sender_id, message, post_id, comment_id, platform, user_id_owner, reply_message, inbox_message, procesado_en=None):
+    """Guarda comentario en Google Sheets (fallback). procesado_en: ver save_comment_log"""
     if not sheet:
         return
+    if load_shedder.defer_write("sheets", {
+        "sender_name": sender_name, "sender_id": sender_id, "message": message, "post_id": post_id,
+        "comment_id": comment_id, "platform": platform, "user_id_owner": user_id_owner,
+        "reply_message": reply_message, "inbox_message": inbox_message, "procesado_en": utc_now_iso()
+    }):
+        return
     try:
-        current_datetime = datetime.now()
+        # Fecha y hora locales de cuando se procesó el comentario (no de la réplica)
+        current_datetime = parse_utc(procesado_en).astimezone() if procesado_en else datetime.now()
         date = current_datetime.strftime("%Y-%m-%d")
         time_str = current_datetime.strftime("%H:%M:%S")
 
         values = [[user_id_owner, platform, sender_name, sender_id, message, post_id, comment_id, reply_message, inbox_message, date, time_str]]
+        if surge_detector.buffer_sheet(post_id, values[0]):
+            return
         body = {'values': values}
 
         sheet.values().append(
@@ -1022,16 +2579,18 @@ def save_comment_to_sheets(sender_name, sender_id, message, post_id, comment_id,
             body=body
         ).execute()
     except Exception as e:
-        print(f"[SHEETS] Error guardando comentario: {e}")
+        log.error("SHEETS", f"Error guardando comentario: {e}")
+        metrics.error('sheets_write')
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # FUNCIONES DE META API
 # ═══════════════════════════════════════════════════════════════════════════════
 
-GRAPH_API_URL = "https://graph.facebook.com/v18.0"
+GRAPH_API_URL = os.getenv('GRAPH_API_URL', "https://graph.facebook.com/v18.0").rstrip('/')
 
 
+@metrics.timed('graph_token')
 def get_long_lived_token(short_token):
     """Intercambia token corto por uno de larga duración"""
     url = f"{GRAPH_API_URL}/oauth/access_token"
@@ -1046,6 +2605,7 @@ def get_long_lived_token(short_token):
     return data.get('access_token')
 
 
+@metrics.timed('graph_subscribe')
 def subscribe_page_to_webhooks(page_id, page_token):
     """Suscribe una página a webhooks de Facebook"""
     url = f"{GRAPH_API_URL}/{page_id}/subscribed_apps"
@@ -1057,28 +2617,35 @@ def subscribe_page_to_webhooks(page_id, page_token):
         'access_token': page_token
     }
 
-    print(f"[META] Suscribiendo página {page_id} a webhooks...")
+    log.info("META", f"Suscribiendo página {page_id} a webhooks...")
 
     try:
         response = requests.post(url, params=params)
         data = response.json()
 
         if data.get('success'):
-            print(f"[META] ✅ Página {page_id} suscrita exitosamente")
+            log.info("META", f"Página {page_id} suscrita exitosamente")
             return {"success": True}
         else:
-            print(f"[META] ❌ Error suscribiendo: {data}")
+            log.error("META", f"Error suscribiendo: {data}")
             return {"success": False, "error": data}
     except Exception as e:
-        print(f"[META] ❌ Excepción: {e}")
+        log.error("META", f"Excepción: {e}")
         return {"success": False, "error": str(e)}
 
 
+@metrics.timed('caption')
 def get_post_description(media_id, token):
     """Obtiene la descripción/caption de un post"""
     if not media_id:
         return ''
 
+    caption = speculative_replies.get_caption(media_id)
+    if caption is None:
+        caption = surge_detector.pinned_caption(media_id)
+    if caption is not None:
+        return caption
+
     url = f"{GRAPH_API_URL}/{media_id}"
     params = {'fields': 'caption,message', 'access_token': token}
 
@@ -1086,13 +2653,19 @@ def get_post_description(media_id, token):
         response = requests.get(url, params=params)
         data = response.json()
         if 'error' in data:
+            metrics.error('caption')
+            token_health.report(token, data)
             return ''
-        return data.get('caption') or data.get('message', '')
+        caption = data.get('caption') or data.get('message', '')
+        surge_detector.pin_caption(media_id, caption)
+        return caption
     except Exception as e:
-        print(f"[META] Error obteniendo descripción: {e}")
+        log.error("META", f"Error obteniendo descripción: {e}")
+        metrics.error('caption')
         return ''
 
 
+@metrics.timed('post_details')
 def get_post_details(post_id, token):
     """Obtiene detalles completos de un post para guardar en base_cuentas"""
     if not post_id:
@@ -1109,7 +2682,7 @@ def get_post_details(post_id, token):
         data = response.json()
 
         if 'error' in data:
-            print(f"[META] Error obteniendo detalles del post: {data['error']}")
+            log.error("META", f"Error obteniendo detalles del post: {data['error']}")
             return None
 
         return {
@@ -1121,10 +2694,11 @@ def get_post_details(post_id, token):
             'timestamp': data.get('timestamp', datetime.now().isoformat())
         }
     except Exception as e:
-        print(f"[META] Error obteniendo detalles del post: {e}")
+        log.error("META", f"Error obteniendo detalles del post: {e}")
         return None
 
 
+@metrics.timed('graph_reply_instagram')
 def reply_to_instagram_comment(comment_id, message, token):
     """Responde a un comentario de Instagram"""
     url = f"{GRAPH_API_URL}/{comment_id}/replies"
@@ -1134,13 +2708,16 @@ def reply_to_instagram_comment(comment_id, message, token):
 
     if 'id' in data:
         anti_loop.mark_bot_reply(data['id'])
-        print(f"[META] ✅ Respuesta IG enviada: {data['id']}")
+        log.info("META", f"Respuesta IG enviada: {data['id']}")
     else:
-        print(f"[META] ❌ Error respuesta IG: {data}")
+        log.error("META", f"Error respuesta IG: {data}")
+        token_health.report(token, data)
+        metrics.error('graph_reply_instagram')
 
     return data
 
 
+@metrics.timed('graph_reply_facebook')
 def reply_to_facebook_comment(comment_id, message, token):
     """Responde a un comentario de Facebook"""
     url = f"{GRAPH_API_URL}/{comment_id}/comments"
@@ -1150,13 +2727,16 @@ def reply_to_facebook_comment(comment_id, message, token):
 
     if 'id' in data:
         anti_loop.mark_bot_reply(data['id'])
-        print(f"[META] ✅ Respuesta FB enviada: {data['id']}")
+        log.info("META", f"Respuesta FB enviada: {data['id']}")
     else:
-        print(f"[META] ❌ Error respuesta FB: {data}")
+        log.error("META", f"Error respuesta FB: {data}")
+        token_health.report(token, data)
+        metrics.error('graph_reply_facebook')
 
     return data
 
 
+@metrics.timed('graph_dm')
 def send_direct_message(recipient_id, message, token):
     """Envía un mensaje directo"""
     url = f"{GRAPH_API_URL}/me/messages"
@@ -1171,13 +2751,16 @@ def send_direct_message(recipient_id, message, token):
     data = response.json()
 
     if 'message_id' in data:
-        print(f"[META] ✅ DM enviado: {data['message_id']}")
+        log.info("META", f"DM enviado: {data['message_id']}")
     elif 'error' in data:
-        print(f"[META] ❌ Error DM: {data['error'].get('message', 'Unknown')}")
+        log.error("META", f"Error DM: {data['error'].get('message', 'Unknown')}")
+        token_health.report(token, data)
+        metrics.error('graph_dm')
 
     return data
 
 
+@metrics.timed('graph_hide')
 def hide_comment(comment_id, token):
     """Oculta un comentario"""
     url = f"{GRAPH_API_URL}/{comment_id}"
@@ -1186,6 +2769,408 @@ def hide_comment(comment_id, token):
     return response.json()
 
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Salud de tokens de página
+# ═══════════════════════════════════════════════════════════════════════════════
+
+TOKEN_CHECK_INTERVAL = int(os.getenv('TOKEN_CHECK_INTERVAL', '3600'))  # revalidación con debug_token
+TOKEN_REFRESH_AHEAD_DAYS = float(os.getenv('TOKEN_REFRESH_AHEAD_DAYS', '7'))
+TOKEN_INVALID_CODES = {102, 190}  # OAuthException: token expirado, revocado o inválido
+
+
+class TokenHealthRegistry:
+    """
+    Estado de los page_access_token de cuentas_instagram (SQLite local, por huella
+    sha256: el token no se guarda). Un job de mantenimiento valida cada token con
+    debug_token y renueva con get_long_lived_token los que vencen en menos de
+    TOKEN_REFRESH_AHEAD_DAYS. Los errores OAuth de Graph (código 190) también
+    marcan el token como inválido al momento.
+
+    get_entry_token descarta los eventos de páginas con token inválido antes de
+    gastar en OpenAI. Reconectar la página trae un token nuevo (otra huella) y
+    vuelve a procesar.
+    """
+
+    def __init__(self, intervalo=TOKEN_CHECK_INTERVAL, renovar_dias=TOKEN_REFRESH_AHEAD_DAYS, memo=60):
+        self.intervalo = intervalo
+        self.renovar_antes = renovar_dias * 86400
+        self.memo = memo
+        self._memo = {}
+        self._tabla_lista = False
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS tokens_salud (
+                huella TEXT PRIMARY KEY,
+                page_id TEXT,
+                page_name TEXT,
+                valido INTEGER NOT NULL,
+                expira REAL,
+                motivo TEXT,
+                verificado_en REAL NOT NULL
+            )
+        """)
+        self._tabla_lista = True
+
+    @staticmethod
+    def fingerprint(token):
+        return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+    def is_usable(self, token):
+        """False solo si el token está marcado como inválido (sin verificar = utilizable)"""
+        if not token:
+            return False
+        huella = self.fingerprint(token)
+        memo = self._memo.get(huella)
+        if memo and memo[0] > time.time():
+            return memo[1]
+        self._init_table()
+        fila = get_local_db().execute("SELECT valido FROM tokens_salud WHERE huella = ?", (huella,)).fetchone()
+        usable = fila is None or bool(fila['valido'])
+        self._memo[huella] = (time.time() + self.memo, usable)
+        return usable
+
+    def _guardar(self, token, valido, expira=None, motivo=None, page_id=None, page_name=None):
+        self._init_table()
+        huella = self.fingerprint(token)
+        get_local_db().execute(
+            "INSERT INTO tokens_salud (huella, page_id, page_name, valido, expira, motivo, verificado_en) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (huella) DO UPDATE SET "
+            "page_id = COALESCE(excluded.page_id, page_id), page_name = COALESCE(excluded.page_name, page_name), "
+            "valido = excluded.valido, expira = COALESCE(excluded.expira, expira), motivo = excluded.motivo, "
+            "verificado_en = excluded.verificado_en",
+            (huella, page_id, page_name, int(valido), expira, motivo, time.time())
+        )
+        self._memo[huella] = (time.time() + self.memo, valido)
+
+    def report(self, token, data):
+        """Marca el token como inválido si la respuesta de Graph es un error OAuth"""
+        error = data.get('error') if isinstance(data, dict) else None
+        if not (token and isinstance(error, dict) and error.get('code') in TOKEN_INVALID_CODES):
+            return False
+        if self.is_usable(token):
+            metrics.inc("comentarios_token_health_total", resultado="invalido_graph")
+            log.warning("TOKENS", f"Token marcado inválido por Graph: {error.get('message', '')[:120]}")
+        self._guardar(token, False, motivo=f"graph {error.get('code')}/{error.get('error_subcode', '')}")
+        return True
+
+    def debug(self, token):
+        """Consulta debug_token: (valido, expira_epoch o None, motivo)"""
+        if not (APP_ID and APP_SECRET):
+            return None
+        with metrics.timer('graph_debug_token'):
+            response = requests.get(f"{GRAPH_API_URL}/debug_token", params={
+                'input_token': token, 'access_token': f"{APP_ID}|{APP_SECRET}"
+            }, timeout=15)
+        data = response.json()
+        if 'error' in data:
+            raise RuntimeError(data['error'].get('message', 'debug_token falló'))
+        info = data.get('data', {})
+        motivo = (info.get('error') or {}).get('message')
+        return bool(info.get('is_valid')), info.get('expires_at') or None, motivo
+
+    def check_all(self, max_cuentas=500):
+        """Valida los tokens de las cuentas activas y renueva los que están por vencer"""
+        if not supabase or not (APP_ID and APP_SECRET):
+            return 0
+        cuentas = supabase.table("cuentas_instagram")\
+            .select("page_id, page_name, page_access_token")\
+            .eq("activo", True)\
+            .limit(max_cuentas)\
+            .execute().data or []
+        invalidos = 0
+        for cuenta in cuentas:
+            token = cuenta.get('page_access_token')
+            if not token:
+                continue
+            try:
+                resultado = self.debug(token)
+            except Exception as e:
+                log.warning("TOKENS", f"debug_token falló: {e}", brand=cuenta.get('page_id'))
+                continue
+            if resultado is None:
+                continue
+            valido, expira, motivo = resultado
+            self._guardar(token, valido, expira, motivo, cuenta.get('page_id'), cuenta.get('page_name'))
+            metrics.inc("comentarios_token_health_total", resultado="valido" if valido else "invalido")
+            if not valido:
+                invalidos += 1
+                log.warning("TOKENS", f"Token inválido: {motivo or 'sin detalle'}", brand=cuenta.get('page_id'),
+                            page_name=cuenta.get('page_name'))
+            elif expira and expira - time.time() < self.renovar_antes:
+                self.refresh(cuenta, token)
+        return invalidos
+
+    def refresh(self, cuenta, token):
+        """Renueva un token por vencer y actualiza cuentas_instagram"""
+        try:
+            nuevo = get_long_lived_token(token)
+        except Exception as e:
+            nuevo = None
+            log.warning("TOKENS", f"Error renovando token: {e}", brand=cuenta.get('page_id'))
+        if not nuevo or nuevo == token:
+            metrics.inc("comentarios_token_health_total", resultado="renovacion_fallida")
+            return False
+        supabase.table("cuentas_instagram").update({
+            'page_access_token': nuevo,
+            'fecha_actualizacion': utc_now_iso()
+        }).eq("page_id", str(cuenta.get('page_id'))).execute()
+        self._guardar(nuevo, True, page_id=cuenta.get('page_id'), page_name=cuenta.get('page_name'))
+        metrics.inc("comentarios_token_health_total", resultado="renovado")
+        log.info("TOKENS", "Token renovado antes de vencer", brand=cuenta.get('page_id'))
+        return True
+
+    def invalid_count(self):
+        self._init_table()
+        return get_local_db().execute("SELECT COUNT(*) FROM tokens_salud WHERE valido = 0").fetchone()[0]
+
+    def get_stats(self):
+        self._init_table()
+        ahora = time.time()
+        return {
+            "intervalo_s": self.intervalo,
+            "renovar_antes_dias": self.renovar_antes / 86400,
+            "tokens": [{
+                "page_id": r['page_id'],
+                "page_name": r['page_name'],
+                "valido": bool(r['valido']),
+                "vence_en_dias": round((r['expira'] - ahora) / 86400, 1) if r['expira'] else None,
+                "motivo": r['motivo'],
+                "verificado_en": datetime.fromtimestamp(r['verificado_en']).isoformat()
+            } for r in get_local_db().execute("SELECT * FROM tokens_salud ORDER BY valido, verificado_en DESC")]
+        }
+
+# Instancia global
+token_health = TokenHealthRegistry()
+metrics.gauge("comentarios_token_invalid", token_health.invalid_count)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Conexión de páginas (OAuth)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+ONBOARDING_CONCURRENCY = int(os.getenv('ONBOARDING_CONCURRENCY', '8'))  # páginas preparadas en paralelo
+ONBOARDING_MAX_PAGES = int(os.getenv('ONBOARDING_MAX_PAGES', '5000'))
+ONBOARDING_STALE_SECONDS = int(os.getenv('ONBOARDING_STALE_SECONDS', '900'))  # sin avance = proceso reiniciado
+
+
+def fetch_user_pages(user_token, limite=100, max_paginas=ONBOARDING_MAX_PAGES):
+    """Todas las páginas de /me/accounts siguiendo paging.next"""
+    url = f"{GRAPH_API_URL}/me/accounts"
+    params = {'fields': 'id,name,access_token,instagram_business_account', 'limit': limite,
+              'access_token': user_token}
+    paginas = []
+    while url and len(paginas) < max_paginas:
+        with metrics.timer('graph_accounts'):
+            data = requests.get(url, params=params, timeout=30).json()
+        if 'error' in data:
+            raise RuntimeError(f"Error obteniendo páginas: {data['error'].get('message', data['error'])}")
+        paginas.extend(data.get('data', []))
+        url = data.get('paging', {}).get('next')
+        params = None  # next ya incluye token, campos y cursor
+    return paginas[:max_paginas]
+
+
+def prepare_page_account(page):
+    """Token largo, suscripción a webhooks y usuario de Instagram de una página (sin escribir en BD)"""
+    page_id = page.get('id')
+    page_name = page.get('name')
+    page_token = page.get('access_token')
+
+    # Token de larga duración para la página
+    page_long_token = get_long_lived_token(page_token) or page_token
+
+    log.info("OAUTH", f"Procesando: {page_name} ({page_id})")
+
+    # Suscribir a webhooks
+    subscribe_page_to_webhooks(page_id, page_long_token)
+
+    # Obtener cuenta de Instagram
+    instagram_account = page.get('instagram_business_account')
+    instagram_id = None
+    instagram_name = ""
+
+    if isinstance(instagram_account, dict):
+        instagram_id = instagram_account.get('id')
+    elif isinstance(instagram_account, str):
+        instagram_id = instagram_account
+
+    if instagram_id:
+        ig_info_url = f"{GRAPH_API_URL}/{instagram_id}"
+        ig_info_params = {'fields': 'username', 'access_token': page_long_token}
+        instagram_name = requests.get(ig_info_url, params=ig_info_params, timeout=15).json().get('username', '')
+        log.info("OAUTH", f"Instagram: {instagram_name} ({instagram_id})")
+
+    return {
+        'page_id': str(page_id),
+        'page_name': page_name,
+        'instagram_id': str(instagram_id) if instagram_id else None,
+        'page_access_token': page_long_token,
+        'instagram_name': instagram_name
+    }
+
+
+@metrics.timed('account_save')
+def save_accounts_bulk(user_id, cuentas, chunk=200):
+    """
+    Guarda las cuentas con un upsert por page_id (requiere sql/cuentas_instagram_page_id_unico.sql).
+    Conserva fecha_conexion de las existentes y crea el prompt default de las nuevas.
+    """
+    if not supabase or not cuentas:
+        return 0
+    ids = [c['page_id'] for c in cuentas]
+    existentes = {}
+    for i in range(0, len(ids), chunk):
+        for fila in supabase.table("cuentas_instagram").select("page_id, fecha_conexion")\
+                .in_("page_id", ids[i:i + chunk]).execute().data or []:
+            existentes[str(fila['page_id'])] = fila
+
+    ahora = utc_now_iso()
+    filas = [{
+        'user_id': str(user_id),
+        'page_id': c['page_id'],
+        'page_name': c['page_name'],
+        'instagram_id': c['instagram_id'],
+        'page_access_token': c['page_access_token'],
+        'instagram_name': c['instagram_name'],
+        'activo': True,
+        'fecha_actualizacion': ahora,
+        'fecha_conexion': (existentes.get(c['page_id']) or {}).get('fecha_conexion') or ahora
+    } for c in cuentas]
+
+    try:
+        supabase.table("cuentas_instagram").upsert(filas, on_conflict="page_id").execute()
+    except Exception as e:
+        # Sin índice único en page_id el upsert falla: se guarda cuenta por cuenta
+        log.warning("SUPABASE", f"Upsert masivo de cuentas falló ({e}), guardando una por una", cuentas=len(filas))
+        return sum(bool(save_account_to_supabase(user_id, c['page_id'], c['page_name'], c['instagram_id'],
+                                                 c['page_access_token'], c['instagram_name'])) for c in cuentas)
+
+    log.info("SUPABASE", "Cuentas guardadas", nuevas=len(filas) - len(existentes), actualizadas=len(existentes))
+    for c in cuentas:
+        if c['page_id'] not in existentes and c['instagram_id']:
+            crear_prompt_default(c['instagram_id'], c['page_name'])
+    return len(filas)
+
+
+class PageOnboarding:
+    """
+    Conecta las páginas de un usuario tras el OAuth en un hilo de fondo: sigue la
+    paginación de /me/accounts, prepara hasta ONBOARDING_CONCURRENCY páginas en
+    paralelo y guarda todas las cuentas con un solo upsert y un append en Sheets.
+    El avance queda en la base SQLite local (visible desde cualquier worker), se
+    muestra en el dashboard y se consulta en /comentarios/conexion_progreso. Una
+    conexión sin avance en ONBOARDING_STALE_SECONDS (el hilo murió con el proceso)
+    pasa a 'error'.
+    """
+
+    def __init__(self, concurrencia=ONBOARDING_CONCURRENCY, plazo=ONBOARDING_STALE_SECONDS):
+        self.concurrencia = max(1, concurrencia)
+        self.plazo = plazo
+        self._tabla_lista = False
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS conexiones_paginas (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'en_curso',
+                total INTEGER NOT NULL DEFAULT 0,
+                procesadas INTEGER NOT NULL DEFAULT 0,
+                conectadas INTEGER NOT NULL DEFAULT 0,
+                errores TEXT NOT NULL DEFAULT '[]',
+                creado_en TEXT NOT NULL,
+                actualizado_en TEXT NOT NULL
+            )
+        """)
+        self._tabla_lista = True
+
+    def start(self, user_id, user_token):
+        """Registra la conexión y la ejecuta en segundo plano; devuelve su id"""
+        self._init_table()
+        conexion_id = uuid.uuid4().hex
+        ahora = datetime.now().isoformat()
+        get_local_db().execute(
+            "INSERT INTO conexiones_paginas (id, user_id, creado_en, actualizado_en) VALUES (?, ?, ?, ?)",
+            (conexion_id, str(user_id), ahora, ahora)
+        )
+        threading.Thread(target=self.run, args=(conexion_id, user_id, user_token),
+                         name="comentarios-onboarding", daemon=True).start()
+        return conexion_id
+
+    def _avance(self, conexion_id, **campos):
+        if 'errores' in campos:
+            campos['errores'] = json.dumps(campos['errores'], ensure_ascii=False)
+        campos['actualizado_en'] = datetime.now().isoformat()
+        asignaciones = ', '.join(f"{k} = ?" for k in campos)
+        get_local_db().execute(f"UPDATE conexiones_paginas SET {asignaciones} WHERE id = ?",
+                               list(campos.values()) + [conexion_id])
+
+    def run(self, conexion_id, user_id, user_token):
+        self._init_table()
+        errores = []
+        try:
+            with tracer.trace('onboarding', user_id=user_id):
+                paginas = fetch_user_pages(user_token)
+                self._avance(conexion_id, total=len(paginas))
+
+                cuentas = []
+                with ThreadPoolExecutor(max_workers=self.concurrencia, thread_name_prefix="comentarios-onboarding") as pool:
+                    futuros = {pool.submit(prepare_page_account, p): p for p in paginas}
+                    for futuro in as_completed(futuros):
+                        try:
+                            cuentas.append(futuro.result())
+                        except Exception as e:
+                            pagina = futuros[futuro]
+                            errores.append({"page_id": pagina.get('id'), "page_name": pagina.get('name'), "error": str(e)})
+                            log.error("OAUTH", f"Error preparando página: {e}", brand=pagina.get('id'))
+                        self._avance(conexion_id, procesadas=len(cuentas) + len(errores), errores=errores)
+
+                conectadas = save_accounts_bulk(user_id, cuentas)
+                save_accounts_to_sheets(user_id, cuentas)
+                for c in cuentas:
+                    if c['instagram_id']:
+                        anti_loop.add_own_account(c['instagram_id'])
+                    anti_loop.add_own_account(c['page_id'])
+
+            self._avance(conexion_id, estado='terminado', conectadas=conectadas)
+            log.info("OAUTH", "Conexión de páginas terminada", user_id=user_id, paginas=len(paginas),
+                     conectadas=conectadas, errores=len(errores))
+        except Exception as e:
+            errores.append({"error": str(e)})
+            self._avance(conexion_id, estado='error', errores=errores)
+            log.error("OAUTH", f"Error conectando páginas: {e}", user_id=user_id, exc_info=True)
+
+    def expire_stale(self, conexion_id=None):
+        """Marca como 'error' las conexiones en curso sin avance dentro del plazo; retorna cuántas"""
+        self._init_table()
+        limite = (datetime.now() - timedelta(seconds=self.plazo)).isoformat()
+        consulta = "SELECT id, errores FROM conexiones_paginas WHERE estado = 'en_curso' AND actualizado_en < ?"
+        parametros = [limite]
+        if conexion_id:
+            consulta += " AND id = ?"
+            parametros.append(conexion_id)
+        vencidas = get_local_db().execute(consulta, parametros).fetchall()
+        for fila in vencidas:
+            errores = json.loads(fila['errores']) + [{"error": "La conexión se interrumpió, vuelve a conectar tus páginas"}]
+            self._avance(fila['id'], estado='error', errores=errores)
+            log.warning("OAUTH", "Conexión de páginas interrumpida", conexion_id=fila['id'])
+        return len(vencidas)
+
+    def get(self, conexion_id):
+        self._init_table()
+        self.expire_stale(conexion_id)
+        fila = get_local_db().execute("SELECT * FROM conexiones_paginas WHERE id = ?", (conexion_id,)).fetchone()
+        return dict(fila, errores=json.loads(fila['errores'])) if fila else None
+
+# Instancia global
+page_onboarding = PageOnboarding()
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # FUNCIONES DE OPENAI
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1201,12 +3186,35 @@ def is_unwanted_message(text):
     return False
 
 
-def generate_responses(instagram_id, post_description, comment_text):
+OPENAI_BATCH_SIZE = int(os.getenv('OPENAI_BATCH_SIZE', '1'))  # 1 = una completion por comentario
+OPENAI_BATCH_WINDOW_MS = float(os.getenv('OPENAI_BATCH_WINDOW_MS', '250'))
+OPENAI_BATCH_TIMEOUT = float(os.getenv('OPENAI_BATCH_TIMEOUT', '45'))  # plazo del lote completo (completion + fallbacks)
+
+
+def generate_responses(instagram_id, post_description, comment_text, comment_id=None, media_id=None):
     """Genera respuestas usando OpenAI con sistema de prioridades"""
+    respuesta = (intent_templates.respond(instagram_id, comment_text)
+                 or speculative_replies.respond(media_id, comment_text)
+                 or surge_detector.respond(media_id, comment_text))
+    if respuesta:
+        return respuesta
     if not openai_client:
         return fallback_response()
+    respuesta = load_shedder.shed_llm()
+    if respuesta:
+        return respuesta
+    if completion_batcher.enabled:
+        respuesta = completion_batcher.submit(instagram_id, post_description, comment_text, comment_id)
+    else:
+        datos = surge_detector.pinned_brand_data(media_id, instagram_id)
+        respuesta = generate_single_response(instagram_id, post_description, comment_text, datos)
+    surge_detector.remember(media_id, comment_text, respuesta)
+    return respuesta
 
-    datos = get_brand_data(instagram_id)
+
+def generate_single_response(instagram_id, post_description, comment_text, datos=None):
+    """Una completion para un comentario (datos: contexto de marca ya cargado, si lo hay)"""
+    datos = datos or get_brand_data(instagram_id)
     if not datos:
         return fallback_response()
 
@@ -1215,24 +3223,25 @@ def generate_responses(instagram_id, post_description, comment_text):
     prompt_usuario = build_user_prompt(post_description, comment_text)
 
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": prompt_sistema},
-                {"role": "user", "content": prompt_usuario}
-            ],
-            temperature=0.7,
-            max_tokens=500
-        )
+        with metrics.timer('openai'):
+            response = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": prompt_sistema},
+                    {"role": "user", "content": prompt_usuario}
+                ],
+                temperature=0.7,
+                max_tokens=500
+            )
         respuesta_raw = response.choices[0].message.content
         respuesta_json = parse_openai_response(respuesta_raw)
 
-        print(f"[OPENAI] ✅ Respuesta generada para {nombre_marca}")
+        log.info("OPENAI", "Respuesta generada", brand=instagram_id)
         save_comment_log(instagram_id, nombre_marca, post_description, comment_text, respuesta_json)
 
         return respuesta_json
     except Exception as e:
-        print(f"[OPENAI] ❌ Error: {e}")
+        log.error("OPENAI", f"Error: {e}", brand=instagram_id)
         return fallback_response()
 
 
@@ -1327,335 +3336,2749 @@ def fallback_response():
     }
 
 
-def generate_dm_response(instagram_id, user_message, user_id):
-    """Genera respuesta para DM con historial de conversación"""
-    if not openai_client:
-        return "¡Hola! Gracias por escribirnos. ¿En qué podemos ayudarte?"
+def build_batch_user_prompt(items):
+    """Prompt de usuario con varios comentarios de la misma marca, cada uno con su ID"""
+    prompt = "Responde CADA comentario por separado.\n"
+    for item in items:
+        descripcion = item["post"][:300] if item["post"] else "(sin descripción)"
+        prompt += f'\nID: {item["id"]}\nPUBLICACIÓN: "{descripcion}"\nCOMENTARIO: "{item["texto"]}"\n'
+    prompt += """
+Responde SOLO un arreglo JSON (sin markdown), un objeto por ID:
+[{"id": "ID", "es_inapropiado": true/false, "razon_inapropiado": "razón o null", "respuesta_comentario": "respuesta pública", "mensaje_inbox": "mensaje privado"}]
+"""
+    return prompt
 
-    datos = get_brand_data(instagram_id)
-    if not datos:
-        return "¡Hola! Gracias por escribirnos. ¿En qué podemos ayudarte?"
 
-    history = conversation_history.get_history(user_id)
+def parse_batch_response(respuesta_raw):
+    """Parsea el arreglo JSON de un lote; devuelve {id: respuesta} con los objetos válidos"""
+    texto = (respuesta_raw or "").strip()
+    if texto.startswith("```"):
+        texto = texto.split("```")[1]
+        if texto.startswith("json"):
+            texto = texto[4:]
+    try:
+        elementos = json.loads(texto.strip())
+    except ValueError:
+        return {}
+    if isinstance(elementos, dict):
+        elementos = elementos.get("respuestas") or [elementos]
+    resultado = {}
+    for elemento in elementos if isinstance(elementos, list) else []:
+        if isinstance(elemento, dict) and elemento.get("id") is not None and "respuesta_comentario" in elemento:
+            resultado[str(elemento.pop("id"))] = elemento
+    return resultado
+
+
+class CompletionBatcher:
+    """
+    Micro-batching de completions por marca. Si la marca ya tiene generaciones en
+    curso, el comentario abre un lote y espera hasta OPENAI_BATCH_WINDOW_MS (o hasta
+    OPENAI_BATCH_SIZE comentarios); los que llegan mientras tanto desde otros hilos
+    se suman al lote y se responden con una sola completion que devuelve un arreglo
+    JSON por ID. Un comentario sin concurrencia se genera de inmediato.
+
+    Los elementos que faltan o no se pueden parsear se generan individualmente y en
+    paralelo. Todo el lote tiene un plazo (OPENAI_BATCH_TIMEOUT) que comparten el
+    líder y los hilos que esperan su resultado.
+    """
+
+    def __init__(self, max_items=OPENAI_BATCH_SIZE, ventana_ms=OPENAI_BATCH_WINDOW_MS,
+                 timeout=OPENAI_BATCH_TIMEOUT, max_fallbacks=8):
+        self.max_items = max_items
+        self.ventana = ventana_ms / 1000
+        self.timeout = timeout
+        self.max_fallbacks = max_fallbacks
+        self.lotes = {}
+        self.activos = Counter()  # submits en curso por marca
+        self.lock = threading.Lock()
+        self.secuencia = 0
+
+    @property
+    def enabled(self):
+        return self.max_items > 1
+
+    def submit(self, instagram_id, post_description, comment_text, comment_id=None):
+        clave = str(instagram_id)
+        with self.lock:
+            self.secuencia += 1
+            item = {
+                "id": str(comment_id or f"c{self.secuencia}"),
+                "post": post_description,
+                "texto": comment_text,
+                "listo": threading.Event(),
+                "resultado": None
+            }
+            lote = self.lotes.get(clave)
+            lider = lote is None
+            if lider:
+                lote = self.lotes[clave] = {"items": [], "lleno": threading.Event(),
+                                            "plazo": time.time() + self.ventana + self.timeout}
+            lote["items"].append(item)
+            # Sin otras generaciones de la marca en curso no hay con quién agrupar
+            if len(lote["items"]) >= self.max_items or (lider and not self.activos[clave]):
+                self.lotes.pop(clave, None)
+                lote["lleno"].set()
+            self.activos[clave] += 1
+
+        try:
+            if lider:
+                lote["lleno"].wait(self.ventana)
+                with self.lock:
+                    if self.lotes.get(clave) is lote:
+                        del self.lotes[clave]
+                self._ejecutar(instagram_id, lote["items"], lote["plazo"])
+            else:
+                # El líder termina a más tardar en el plazo del lote
+                item["listo"].wait(max(0.0, lote["plazo"] - time.time()) + 1)
+        finally:
+            with self.lock:
+                self.activos[clave] -= 1
+                if self.activos[clave] <= 0:
+                    del self.activos[clave]
+
+        return item["resultado"] or fallback_response()
+
+    def _ejecutar(self, instagram_id, items, plazo):
+        try:
+            if len(items) == 1:
+                metrics.inc("comentarios_openai_batch_items_total", modo="individual")
+                items[0]["resultado"] = generate_single_response(instagram_id, items[0]["post"], items[0]["texto"])
+                return
+            self._ejecutar_lote(instagram_id, items, plazo)
+        except Exception as e:
+            log.error("OPENAI", f"Error en lote: {e}", brand=instagram_id, items=len(items))
+        finally:
+            for item in items:
+                item["listo"].set()
+
+    def _ejecutar_lote(self, instagram_id, items, plazo):
+        datos = get_brand_data(instagram_id)
+        if not datos:
+            for item in items:
+                item["resultado"] = fallback_response()
+            return
+
+        respuestas = {}
+        try:
+            with metrics.timer('openai_batch'):
+                response = openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": build_system_prompt(datos)},
+                        {"role": "user", "content": build_batch_user_prompt(items)}
+                    ],
+                    temperature=0.7,
+                    max_tokens=min(4000, 200 * len(items) + 100),
+                    timeout=max(1.0, plazo - time.time())
+                )
+            respuestas = parse_batch_response(response.choices[0].message.content)
+        except Exception as e:
+            log.error("OPENAI", f"Error en completion de lote: {e}", brand=instagram_id, items=len(items))
+
+        nombre_marca = datos.get("nombre_marca", "la marca")
+        faltantes = []
+        for item in items:
+            respuesta = respuestas.get(item["id"])
+            if respuesta is None:
+                faltantes.append(item)
+                continue
+            metrics.inc("comentarios_openai_batch_items_total", modo="lote")
+            item["resultado"] = respuesta
+            save_comment_log(instagram_id, nombre_marca, item["post"], item["texto"], respuesta)
+
+        if faltantes:
+            # Fallback por elemento: completions individuales en paralelo, hasta el plazo del lote
+            metrics.inc("comentarios_openai_batch_items_total", value=len(faltantes), modo="fallback")
+            pool = ThreadPoolExecutor(max_workers=min(len(faltantes), self.max_fallbacks),
+                                      thread_name_prefix="comentarios-lote")
+            futuros = {pool.submit(contextvars.copy_context().run, generate_single_response,
+                                   instagram_id, item["post"], item["texto"]): item for item in faltantes}
+            wait(futuros, timeout=max(0.0, plazo - time.time()))
+            pool.shutdown(wait=False)
+            for futuro, item in futuros.items():
+                if futuro.done() and not futuro.exception():
+                    item["resultado"] = futuro.result()
+
+        log.info("OPENAI", "Lote generado", brand=instagram_id, items=len(items), parseados=len(respuestas),
+                 fallbacks=len(faltantes))
+
+# Instancia global
+completion_batcher = CompletionBatcher()
+
+
+INTENT_TEMPLATES_ENABLED = os.getenv('INTENT_TEMPLATES_ENABLED', 'true').lower() != 'false'
+INTENT_MAX_WORDS = int(os.getenv('INTENT_MAX_WORDS', '12'))
+INTENT_MIN_CONFIDENCE = float(os.getenv('INTENT_MIN_CONFIDENCE', '0.9'))
+
+
+def normalizar_texto(texto):
+    """Minúsculas y sin tildes, para comparar palabras clave"""
+    texto = (texto or "").lower()
+    for con, sin in (("á", "a"), ("é", "e"), ("í", "i"), ("ó", "o"), ("ú", "u"), ("ü", "u")):
+        texto = texto.replace(con, sin)
+    return texto
+
+
+class IntentTemplateEngine:
+    """
+    Responde sin LLM los comentarios de intención clara (precio, stock, ubicación,
+    link...) usando plantillas de la marca en base_cuentas:
+
+    - categoria 'plantilla_publica' / 'plantilla_inbox', clave = intención, valor =
+      texto con {marca} o {clave} de cualquier dato de la marca (p. ej. {ubicacion}).
+      Varias filas por intención se usan en rotación.
+    - categoria 'intencion_palabras', clave = intención, valor = palabras separadas
+      por coma (amplía o crea intenciones propias de la marca).
+
+    Solo responde si una única intención calza con confianza >= INTENT_MIN_CONFIDENCE
+    en un comentario corto y sin señales de reclamo; si no, sigue el flujo con OpenAI.
+    """
+
+    INTENCIONES = {
+        "precio": ["precio", "precios", "cuanto cuesta", "cuanto sale", "cuanto vale", "valor", "costo", "cuanto es"],
+        "disponibilidad": ["stock", "disponible", "disponibilidad", "quedan", "talla", "tallas", "colores", "hay en"],
+        "ubicacion": ["donde estan", "direccion", "ubicacion", "ubicados", "local", "tienda fisica", "sucursal", "donde queda"],
+        "horario": ["horario", "horarios", "a que hora", "abren", "cierran", "atienden"],
+        "envio": ["envio", "envios", "despacho", "despachan", "regiones", "delivery", "envian"],
+        "link": ["link", "enlace", "url", "pagina web", "sitio web"],
+        "info": ["info", "informacion", "mas info", "detalles", "inbox", "dm", "interno"],
+    }
+    BLOQUEO = ["no me", "reclamo", "estafa", "malo", "mala", "pesimo", "devolucion", "nunca", "denuncia", "robo"]
+
+    def __init__(self, enabled=INTENT_TEMPLATES_ENABLED):
+        self.enabled = enabled
+        self.rotacion = defaultdict(int)
+        self.stats = defaultdict(Counter)
+        self._patrones = {}
+
+    def _patron(self, palabras):
+        clave = tuple(palabras)
+        if clave not in self._patrones:
+            alternativas = "|".join(re.escape(normalizar_texto(p)) for p in palabras)
+            self._patrones[clave] = re.compile(rf"(?<!\w)(?:{alternativas})(?!\w)")
+        return self._patrones[clave]
+
+    def classify(self, texto, palabras_marca=None):
+        """Devuelve (intención, confianza) para un comentario"""
+        normalizado = normalizar_texto(texto)
+        if len(normalizado.split()) > INTENT_MAX_WORDS:
+            return None, 0.0
+        if self._patron(self.BLOQUEO).search(normalizado):
+            return None, 0.0
+
+        intenciones = dict(self.INTENCIONES)
+        for intencion, palabras in (palabras_marca or {}).items():
+            intenciones[intencion] = intenciones.get(intencion, []) + palabras
+
+        puntajes = {}
+        for intencion, palabras in intenciones.items():
+            n = len(self._patron(palabras).findall(normalizado))
+            if n:
+                puntajes[intencion] = n
+        if not puntajes:
+            return None, 0.0
+        mejor = max(puntajes, key=puntajes.get)
+        return mejor, puntajes[mejor] / sum(puntajes.values())
+
+    def render(self, plantilla, datos):
+        """Rellena {marca} y {clave}; None si falta algún dato"""
+        faltantes = []
+
+        def valor(m):
+            clave = m.group(1)
+            if clave == "marca":
+                return datos.get("nombre_marca", "")
+            if clave in datos.get("hechos", {}):
+                return str(datos["hechos"][clave])
+            faltantes.append(clave)
+            return ""
+
+        texto = re.sub(r"\{(\w+)\}", valor, plantilla)
+        return None if faltantes else texto
+
+    def _elegir(self, instagram_id, intencion, tipo, plantillas, datos):
+        """Siguiente plantilla en rotación que se pueda rellenar"""
+        for _ in range(len(plantillas)):
+            clave = (str(instagram_id), intencion, tipo)
+            indice = self.rotacion[clave] % len(plantillas)
+            self.rotacion[clave] += 1
+            texto = self.render(plantillas[indice], datos)
+            if texto:
+                return texto
+        return None
+
+    def respond(self, instagram_id, comment_text):
+        """Respuesta por plantilla o None si el comentario debe ir a OpenAI"""
+        if not self.enabled:
+            return None
+        contexto = brand_context_cache.get(instagram_id)
+        datos = contexto["datos"] if contexto else None
+        if not datos or not datos.get("plantillas"):
+            return None
+
+        intencion, confianza = self.classify(comment_text, datos.get("palabras_intencion"))
+        plantillas = datos["plantillas"].get(intencion) if intencion else None
+        publica = None
+        if plantillas and confianza >= INTENT_MIN_CONFIDENCE:
+            publica = self._elegir(instagram_id, intencion, "publica", plantillas["publica"], datos)
+
+        marca = str(instagram_id)
+        if not publica:
+            self.stats[marca]["llm"] += 1
+            metrics.inc("comentarios_intent_templates_total", resultado="llm", intencion=intencion or "ninguna")
+            return None
+
+        inbox = self._elegir(instagram_id, intencion, "inbox", plantillas["inbox"], datos) if plantillas["inbox"] else ""
+        self.stats[marca]["plantilla"] += 1
+        self.stats[marca][f"plantilla:{intencion}"] += 1
+        metrics.inc("comentarios_intent_templates_total", resultado="plantilla", intencion=intencion)
+        log.info("PLANTILLAS", "Respuesta por plantilla", brand=instagram_id, intencion=intencion,
+                 confianza=round(confianza, 2))
+        return {
+            "es_inapropiado": False,
+            "razon_inapropiado": None,
+            "respuesta_comentario": publica,
+            "mensaje_inbox": inbox or "",
+            "origen": "plantilla",
+            "intencion": intencion
+        }
+
+    def get_stats(self):
+        marcas = {}
+        for marca, contadores in self.stats.items():
+            total = contadores["plantilla"] + contadores["llm"]
+            marcas[marca] = {
+                "plantilla": contadores["plantilla"],
+                "llm": contadores["llm"],
+                "tasa_plantilla": round(contadores["plantilla"] / total, 3) if total else 0.0,
+                "por_intencion": {k.split(":", 1)[1]: v for k, v in contadores.items() if k.startswith("plantilla:")}
+            }
+        return {"habilitado": self.enabled, "min_confianza": INTENT_MIN_CONFIDENCE, "marcas": marcas}
+
+# Instancia global
+intent_templates = IntentTemplateEngine()
+
+
+BRAND_CONTEXT_TTL = int(os.getenv('BRAND_CONTEXT_TTL', '300'))
+DM_TOKEN_BUDGET = int(os.getenv('DM_TOKEN_BUDGET', '1500'))  # tokens de prompt por DM
+DM_RECENT_MESSAGES = int(os.getenv('DM_RECENT_MESSAGES', '6'))  # turnos que se envían sin resumir
+DM_SUMMARY_BATCH = int(os.getenv('DM_SUMMARY_BATCH', '4'))  # turnos antiguos acumulados antes de resumir
+
+
+def estimate_tokens(texto):
+    """Estimación rápida (~4 caracteres por token), suficiente para presupuestar prompts"""
+    return len(texto or "") // 4 + 1
+
+
+def build_dm_system_prompt(datos, max_tokens=DM_TOKEN_BUDGET // 2):
+    """Prompt de sistema para DMs con la información de la marca, acotado a max_tokens"""
     nombre_marca = datos.get("nombre_marca", "la marca")
+    prompt = f"""Eres atención al cliente de "{nombre_marca}" respondiendo DMs.
+Sé breve, amable y conversacional. Máximo 100 tokens.
+Usa solo la información de la marca; si no tienes un dato, dilo y ofrece que alguien del equipo lo confirme.
+
+INFORMACIÓN DE LA MARCA:
+"""
+    lineas = [f"• {d['clave']}: {d['valor']}" for d in datos.get("siempre_incluir", [])]
+    lineas += [f"• [{d['categoria']}] {d['clave']}: {d['valor'][:200]}" for d in datos.get("si_relevante", [])[:10]]
+    lineas += [f"• Promoción {p['clave']}: {p['valor']}" for p in datos.get("promociones_activas", [])[:5]]
+
+    usados = estimate_tokens(prompt)
+    for linea in lineas or ["• (Sin información cargada)"]:
+        costo = estimate_tokens(linea)
+        if usados + costo > max_tokens:
+            break
+        prompt += linea + "\n"
+        usados += costo
+    return prompt
 
-    system_prompt = f"""Eres atención al cliente de "{nombre_marca}" respondiendo DMs.
-Sé breve, amable y conversacional. Máximo 100 tokens."""
 
-    messages = [{"role": "system", "content": system_prompt}]
-    for msg in history[-5:]:  # Últimos 5 mensajes
-        messages.append({"role": msg["role"], "content": msg["content"]})
-    messages.append({"role": "user", "content": user_message})
+class BrandContextCache:
+    """
+    Contexto de marca compilado por instagram_id (datos de base_cuentas y prompts
+    derivados), con TTL por proceso para no releer base_cuentas en cada mensaje.
+    """
 
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=200
-        )
-        respuesta = response.choices[0].message.content
+    def __init__(self, ttl=BRAND_CONTEXT_TTL):
+        self.ttl = ttl
+        self.entradas = {}
 
-        conversation_history.add_message(user_id, "user", user_message)
-        conversation_history.add_message(user_id, "assistant", respuesta)
+    def get(self, instagram_id):
+        clave = str(instagram_id)
+        entrada = self.entradas.get(clave)
+        vigente = entrada is not None and entrada["expira"] > time.time()
+        metrics.cache('brand_context', vigente)
+        if vigente:
+            return entrada
 
-        return respuesta
+        datos = get_brand_data(instagram_id)
+        if not datos:
+            return None
+        entrada = {
+            "datos": datos,
+            "dm_prompt": build_dm_system_prompt(datos),
+            "expira": time.time() + self.ttl
+        }
+        self.entradas[clave] = entrada
+        return entrada
+
+    def invalidate(self, instagram_id=None):
+        if instagram_id is None:
+            self.entradas.clear()
+        else:
+            self.entradas.pop(str(instagram_id), None)
+
+# Instancia global
+brand_context_cache = BrandContextCache()
+
+
+def build_dm_messages(system_prompt, resumen, history, user_message, budget=DM_TOKEN_BUDGET):
+    """Arma los mensajes del DM: sistema + resumen + turnos recientes que quepan en el presupuesto"""
+    if resumen:
+        system_prompt += f"\nRESUMEN DE LA CONVERSACIÓN HASTA AHORA:\n{resumen}\n"
+    user_message = user_message[:budget]  # ~budget/4 tokens como máximo
+    usados = estimate_tokens(system_prompt) + estimate_tokens(user_message)
+
+    recientes = []
+    for msg in reversed(history):
+        costo = estimate_tokens(msg["content"])
+        if usados + costo > budget:
+            break
+        recientes.append({"role": msg["role"], "content": msg["content"]})
+        usados += costo
+    recientes.reverse()
+
+    return [{"role": "system", "content": system_prompt}] + recientes + [{"role": "user", "content": user_message}]
+
+
+def schedule_dm_summary(user_id, instagram_id):
+    """Resume en segundo plano los turnos antiguos cuando se acumulan suficientes"""
+    viejos = conversation_history.messages_to_summarize(user_id, DM_RECENT_MESSAGES)
+    if len(viejos) < DM_SUMMARY_BATCH or not openai_client:
+        return False
+    if not conversation_history.begin_summary(user_id):
+        return False
+    threading.Thread(
+        target=_summarize_dm_history, args=(user_id, instagram_id, viejos),
+        name="comentarios-resumen-dm", daemon=True
+    ).start()
+    return True
+
+
+def _summarize_dm_history(user_id, instagram_id, viejos):
+    try:
+        previo = conversation_history.get_summary(user_id) or "(sin resumen previo)"
+        transcript = "\n".join(
+            f"{'Cliente' if m['role'] == 'user' else 'Marca'}: {m['content']}" for m in viejos
+        )
+        with metrics.timer('openai_dm_summary'):
+            response = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "Resume conversaciones de atención al cliente por DM. "
+                     "Máximo 80 palabras: qué necesita el cliente, datos que entregó, qué se le respondió y "
+                     "qué quedó pendiente. Solo el resumen, sin introducción."},
+                    {"role": "user", "content": f"RESUMEN PREVIO:\n{previo}\n\nMENSAJES NUEVOS:\n{transcript}"}
+                ],
+                temperature=0.2,
+                max_tokens=160
+            )
+        conversation_history.apply_summary(user_id, response.choices[0].message.content.strip(), viejos[-1]["timestamp"])
+        log.info("OPENAI", "Historial DM resumido", brand=instagram_id, turnos=len(viejos))
     except Exception as e:
-        print(f"[OPENAI] Error DM: {e}")
-        return "¡Gracias por tu mensaje! Te responderemos pronto. 😊"
+        log.error("OPENAI", f"Error resumiendo DM: {e}", brand=instagram_id)
+    finally:
+        conversation_history.end_summary(user_id)
 
 
-# ═══════════════════════════════════════════════════════════════════════════════
-# PROCESADORES DE EVENTOS
+def generate_dm_response(instagram_id, user_message, user_id):
+    """Genera respuesta para DM con contexto de marca, resumen y turnos recientes"""
+    if not openai_client:
+        return "¡Hola! Gracias por escribirnos. ¿En qué podemos ayudarte?"
+
+    contexto = brand_context_cache.get(instagram_id)
+    if not contexto:
+        return "¡Hola! Gracias por escribirnos. ¿En qué podemos ayudarte?"
+
+    history = conversation_history.get_history(user_id)
+    messages = build_dm_messages(
+        contexto["dm_prompt"], conversation_history.get_summary(user_id), history, user_message
+    )
+
+    try:
+        with metrics.timer('openai_dm'):
+            response = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.7,
+                max_tokens=200
+            )
+        respuesta = response.choices[0].message.content
+
+        conversation_history.add_message(user_id, "user", user_message)
+        conversation_history.add_message(user_id, "assistant", respuesta)
+        schedule_dm_summary(user_id, instagram_id)
+
+        return respuesta
+    except Exception as e:
+        log.error("OPENAI", f"Error DM: {e}", brand=instagram_id)
+        return "¡Gracias por tu mensaje! Te responderemos pronto. 😊"
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Respuestas anticipadas por publicación
+# ═══════════════════════════════════════════════════════════════════════════════
+
+SPECULATIVE_REPLIES_ENABLED = os.getenv('SPECULATIVE_REPLIES_ENABLED', 'false').lower() == 'true'
+SPECULATIVE_VARIANTS = int(os.getenv('SPECULATIVE_VARIANTS', '2'))
+SPECULATIVE_TTL_HOURS = float(os.getenv('SPECULATIVE_TTL_HOURS', '48'))
+
+
+class SpeculativeReplyCache:
+    """
+    Caché por publicación (SQLite local, compartida entre workers) que se llena
+    al detectar un post nuevo: caption y variantes de respuesta pregeneradas para
+    las intenciones típicas de la primera ola de comentarios. Los primeros
+    comentarios con intención clara se responden desde aquí, sin Graph ni OpenAI.
+
+    'elogio' solo existe en esta caché: se evalúa cuando el comentario no calza con
+    ninguna intención de las plantillas, para no cambiar su clasificación.
+    Los memos por publicación son LRU acotados a MAX_ENTRADAS.
+    """
+
+    ELOGIO = ["lindo", "linda", "hermoso", "hermosa", "precioso", "preciosa", "me encanta", "lo quiero", "bello", "bella"]
+    MAX_ENTRADAS = 2000
+
+    INTENCIONES = {
+        "precio": "preguntan el precio",
+        "disponibilidad": "preguntan por stock, tallas o colores",
+        "info": "piden más información",
+        "envio": "preguntan por envíos o despachos",
+        "elogio": "felicitan o dicen que les gusta",
+    }
+
+    def __init__(self, enabled=SPECULATIVE_REPLIES_ENABLED, variantes=SPECULATIVE_VARIANTS, ttl_horas=SPECULATIVE_TTL_HOURS):
+        self.enabled = enabled
+        self.variantes = variantes
+        self.ttl = ttl_horas * 3600
+        self.rotacion = OrderedDict()
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._tabla_lista = False
+
+    def _recordar(self, memo, clave, valor):
+        """Guarda en un memo LRU acotado a MAX_ENTRADAS"""
+        with self._lock:
+            memo[clave] = valor
+            memo.move_to_end(clave)
+            while len(memo) > self.MAX_ENTRADAS:
+                memo.popitem(last=False)
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS respuestas_anticipadas (
+                media_id TEXT PRIMARY KEY,
+                instagram_id TEXT NOT NULL,
+                caption TEXT,
+                variantes TEXT NOT NULL DEFAULT '{}',
+                expira REAL NOT NULL
+            )
+        """)
+        self._tabla_lista = True
+
+    def _fila(self, media_id):
+        """Fila vigente de la publicación (memo por proceso de 30 s)"""
+        if not media_id:
+            return None
+        memo = self._memo.get(media_id)
+        ahora = time.time()
+        if memo and memo[0] > ahora:
+            return memo[1]
+        self._init_table()
+        fila = get_local_db().execute(
+            "SELECT * FROM respuestas_anticipadas WHERE media_id = ? AND expira > ?", (str(media_id), ahora)
+        ).fetchone()
+        fila = dict(fila, variantes=json.loads(fila['variantes'])) if fila else None
+        self._recordar(self._memo, media_id, (ahora + 30, fila))
+        return fila
+
+    def get_caption(self, media_id):
+        if not self.enabled:
+            return None
+        fila = self._fila(media_id)
+        metrics.cache('caption', fila is not None)
+        return fila['caption'] if fila else None
+
+    def warm(self, media_id, instagram_id, caption):
+        """Precarga contexto de marca y caption, y pregenera variantes por intención"""
+        self._init_table()
+        contexto = brand_context_cache.get(instagram_id)
+        variantes = {}
+        if contexto and openai_client:
+            variantes = self._generar(contexto["datos"], caption)
+
+        get_local_db().execute(
+            "INSERT INTO respuestas_anticipadas (media_id, instagram_id, caption, variantes, expira) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (media_id) DO UPDATE SET caption = excluded.caption, variantes = excluded.variantes, "
+            "expira = excluded.expira",
+            (str(media_id), str(instagram_id), caption or '', json.dumps(variantes, ensure_ascii=False),
+             time.time() + self.ttl)
+        )
+        with self._lock:
+            self._memo.pop(media_id, None)
+        log.info("ANTICIPADAS", "Publicación precalentada", media_id=media_id, brand=instagram_id,
+                 intenciones=len(variantes), variantes=sum(len(v) for v in variantes.values()))
+        return variantes
+
+    def _generar(self, datos, caption):
+        lista = "\n".join(f"- {intencion}: {descripcion}" for intencion, descripcion in self.INTENCIONES.items())
+        prompt = f"""PUBLICACIÓN NUEVA: "{(caption or '(sin descripción)')[:500]}"
+
+Anticipa los primeros comentarios de esta publicación. Para cada intención genera {self.variantes} variantes distintas:
+{lista}
+
+Responde SOLO JSON (sin markdown), una lista por intención:
+{{"precio": [{{"respuesta_comentario": "respuesta pública", "mensaje_inbox": "mensaje privado"}}], ...}}
+"""
+        with metrics.timer('openai_speculative'):
+            response = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": build_system_prompt(datos)},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.9,
+                max_tokens=min(4000, 150 * self.variantes * len(self.INTENCIONES))
+            )
+        crudo = parse_openai_response(response.choices[0].message.content)
+        variantes = {}
+        for intencion in self.INTENCIONES:
+            opciones = crudo.get(intencion) if isinstance(crudo, dict) else None
+            validas = [o for o in opciones or [] if isinstance(o, dict) and o.get("respuesta_comentario")]
+            if validas:
+                variantes[intencion] = validas
+        return variantes
+
+    def respond(self, media_id, comment_text):
+        """Variante pregenerada para la intención del comentario, o None"""
+        if not self.enabled:
+            return None
+        fila = self._fila(media_id)
+        if not fila or not fila['variantes']:
+            return None
+
+        intencion, confianza = intent_templates.classify(comment_text)
+        if intencion is None:
+            intencion, confianza = intent_templates.classify(comment_text, {"elogio": self.ELOGIO})
+        opciones = fila['variantes'].get(intencion) if confianza >= INTENT_MIN_CONFIDENCE else None
+        metrics.inc("comentarios_speculative_replies_total", resultado="hit" if opciones else "miss")
+        if not opciones:
+            return None
+
+        clave = (str(media_id), intencion)
+        turno = self.rotacion.get(clave, 0)
+        opcion = opciones[turno % len(opciones)]
+        self._recordar(self.rotacion, clave, turno + 1)
+        log.info("ANTICIPADAS", "Respuesta pregenerada", media_id=media_id, intencion=intencion)
+        return {
+            "es_inapropiado": False,
+            "razon_inapropiado": None,
+            "respuesta_comentario": opcion.get("respuesta_comentario", ""),
+            "mensaje_inbox": opcion.get("mensaje_inbox", ""),
+            "origen": "anticipada",
+            "intencion": intencion
+        }
+
+    def cleanup(self):
+        self._init_table()
+        with self._lock:
+            self._memo.clear()
+        return get_local_db().execute("DELETE FROM respuestas_anticipadas WHERE expira <= ?", (time.time(),)).rowcount
+
+# Instancia global
+speculative_replies = SpeculativeReplyCache()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Modo oleada por publicación
+# ═══════════════════════════════════════════════════════════════════════════════
+
+SURGE_ENABLED = os.getenv('SURGE_ENABLED', 'true').lower() != 'false'
+SURGE_WINDOW_SECONDS = int(os.getenv('SURGE_WINDOW_SECONDS', '300'))
+SURGE_THRESHOLD = int(os.getenv('SURGE_THRESHOLD', '60'))  # comentarios en la ventana para entrar en oleada
+SURGE_EXIT_RATIO = float(os.getenv('SURGE_EXIT_RATIO', '0.3'))  # sale bajo SURGE_THRESHOLD * ratio
+SURGE_SAMPLE_EVERY = int(os.getenv('SURGE_SAMPLE_EVERY', '5'))  # 1 de cada N comentarios va al LLM
+SURGE_POOL_SIZE = int(os.getenv('SURGE_POOL_SIZE', '10'))  # respuestas recientes rotables por intención
+SURGE_ACTION_INTERVAL = float(os.getenv('SURGE_ACTION_INTERVAL', '1.0'))  # segundos entre escrituras a Graph por post
+SURGE_LOG_BATCH = int(os.getenv('SURGE_LOG_BATCH', '50'))
+SURGE_LOG_FLUSH_SECONDS = float(os.getenv('SURGE_LOG_FLUSH_SECONDS', '5'))
+
+
+class SurgeDetector:
+    """
+    Cuenta llegadas de comentarios por publicación en una ventana deslizante
+    (SURGE_WINDOW_SECONDS en 10 buckets, SQLite local compartida entre workers).
+    Al superar SURGE_THRESHOLD la publicación entra en modo oleada:
+
+    - Contexto fijado: caption y datos de marca se leen una vez y se reutilizan
+      mientras dure la oleada.
+    - Muestreo: con respuestas suficientes en el pool de la intención, solo 1 de
+      cada SURGE_SAMPLE_EVERY comentarios va al LLM; el resto rota las respuestas
+      recientes del pool. Solo rotan comentarios con intención clara
+      (INTENT_MIN_CONFIDENCE); los no clasificados y los reclamos van siempre al LLM.
+    - Logs por lotes: logs_comentarios y Sheets se escriben en bloques de hasta
+      SURGE_LOG_BATCH filas cada SURGE_LOG_FLUSH_SECONDS.
+    - Ritmo: con work_scheduler activo, respuestas y DMs de la publicación se
+      encolan espaciados SURGE_ACTION_INTERVAL (nunca se duerme en el webhook).
+
+    Vuelve a modo normal cuando la tasa cae bajo SURGE_THRESHOLD * SURGE_EXIT_RATIO
+    (se revisa en cada llegada y en el job de mantenimiento 'oleadas'). El memo del
+    modo por publicación es un LRU acotado a MAX_ENTRADAS.
+    """
+
+    BUCKETS = 10
+    MAX_ENTRADAS = 2000
+
+    def __init__(self, enabled=SURGE_ENABLED, ventana=SURGE_WINDOW_SECONDS, umbral=SURGE_THRESHOLD,
+                 salida=SURGE_EXIT_RATIO, muestreo=SURGE_SAMPLE_EVERY, pool=SURGE_POOL_SIZE,
+                 intervalo_acciones=SURGE_ACTION_INTERVAL, lote_logs=SURGE_LOG_BATCH,
+                 intervalo_logs=SURGE_LOG_FLUSH_SECONDS, espera_max=30):
+        self.enabled = enabled
+        self.ventana = ventana
+        self.ancho = max(1, ventana // self.BUCKETS)
+        self.umbral = umbral
+        self.salida = salida
+        self.muestreo = max(1, muestreo)
+        self.pool = pool
+        self.intervalo_acciones = intervalo_acciones
+        self.lote_logs = lote_logs
+        self.intervalo_logs = intervalo_logs
+        self.espera_max = espera_max
+        self._memo = OrderedDict()
+        self._fijado = {}
+        self._pools = defaultdict(lambda: defaultdict(lambda: deque(maxlen=self.pool)))
+        self._contador = Counter()
+        self._logs = []
+        self._sheets = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._wake = threading.Event()
+        self._tabla_lista = False
+        atexit.register(self.flush_writes)
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        db = get_local_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS publicaciones_llegadas (
+                media_id TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (media_id, bucket)
+            ) WITHOUT ROWID
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS publicaciones_oleada (
+                media_id TEXT PRIMARY KEY,
+                brand_id TEXT NOT NULL,
+                desde REAL NOT NULL,
+                tasa REAL NOT NULL,
+                pico REAL NOT NULL,
+                proxima_accion REAL NOT NULL DEFAULT 0
+            )
+        """)
+        self._tabla_lista = True
+
+    def record(self, media_id, brand_id):
+        """Cuenta una llegada y actualiza el modo de la publicación"""
+        if not (self.enabled and media_id):
+            return False
+        self._init_table()
+        bucket = int(time.time() // self.ancho)
+        get_local_db().execute(
+            "INSERT INTO publicaciones_llegadas (media_id, bucket, n) VALUES (?, ?, 1) "
+            "ON CONFLICT (media_id, bucket) DO UPDATE SET n = n + 1",
+            (str(media_id), bucket)
+        )
+        return self._evaluar(str(media_id), brand_id)
+
+    def rate(self, media_id):
+        """Comentarios de la publicación dentro de la ventana"""
+        desde = int(time.time() // self.ancho) - self.BUCKETS
+        return get_local_db().execute(
+            "SELECT COALESCE(SUM(n), 0) FROM publicaciones_llegadas WHERE media_id = ? AND bucket > ?",
+            (str(media_id), desde)
+        ).fetchone()[0]
+
+    def _evaluar(self, media_id, brand_id=None):
+        db = get_local_db()
+        tasa = self.rate(media_id)
+        fila = db.execute("SELECT * FROM publicaciones_oleada WHERE media_id = ?", (media_id,)).fetchone()
+
+        if fila is None and tasa >= self.umbral and brand_id:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO publicaciones_oleada (media_id, brand_id, desde, tasa, pico) VALUES (?, ?, ?, ?, ?)",
+                (media_id, str(brand_id), time.time(), tasa, tasa)
+            )
+            if cursor.rowcount:
+                metrics.inc("comentarios_surge_transitions_total", hacia="oleada")
+                log.warning("OLEADA", "Publicación en modo oleada", media_id=media_id, brand=brand_id,
+                            comentarios_ventana=tasa, ventana_s=self.ventana)
+            activo = True
+        elif fila is not None and tasa < self.umbral * self.salida:
+            if db.execute("DELETE FROM publicaciones_oleada WHERE media_id = ?", (media_id,)).rowcount:
+                metrics.inc("comentarios_surge_transitions_total", hacia="normal")
+                log.info("OLEADA", "Publicación vuelve a modo normal", media_id=media_id, brand=fila['brand_id'],
+                         comentarios_ventana=tasa, duracion_s=round(time.time() - fila['desde']), pico=fila['pico'])
+            activo = False
+        else:
+            activo = fila is not None
+            if activo:
+                db.execute("UPDATE publicaciones_oleada SET tasa = ?, pico = MAX(pico, ?) WHERE media_id = ?",
+                           (tasa, tasa, media_id))
+
+        self._recordar(media_id, (time.time() + 2, activo))
+        if not activo:
+            self._liberar(media_id)
+        return activo
+
+    def _recordar(self, media_id, valor):
+        """Guarda el modo de la publicación en un memo LRU acotado a MAX_ENTRADAS"""
+        with self._lock:
+            self._memo[media_id] = valor
+            self._memo.move_to_end(media_id)
+            while len(self._memo) > self.MAX_ENTRADAS:
+                self._memo.popitem(last=False)
+
+    def is_active(self, media_id):
+        if not (self.enabled and media_id):
+            return False
+        media_id = str(media_id)
+        memo = self._memo.get(media_id)
+        if memo and memo[0] > time.time():
+            return memo[1]
+        self._init_table()
+        activo = get_local_db().execute(
+            "SELECT 1 FROM publicaciones_oleada WHERE media_id = ?", (media_id,)
+        ).fetchone() is not None
+        self._recordar(media_id, (time.time() + 2, activo))
+        if not activo:
+            self._liberar(media_id)
+        return activo
+
+    def _liberar(self, media_id):
+        if media_id in self._fijado or media_id in self._pools:
+            with self._lock:
+                self._fijado.pop(media_id, None)
+                self._pools.pop(media_id, None)
+                self._contador.pop(media_id, None)
+
+    def refresh(self):
+        """Reevalúa las publicaciones en oleada y purga buckets fuera de la ventana"""
+        self._init_table()
+        db = get_local_db()
+        cerradas = 0
+        for fila in db.execute("SELECT media_id FROM publicaciones_oleada").fetchall():
+            if not self._evaluar(fila['media_id']):
+                cerradas += 1
+        db.execute("DELETE FROM publicaciones_llegadas WHERE bucket <= ?",
+                   (int(time.time() // self.ancho) - self.BUCKETS,))
+        return cerradas
+
+    # ── Contexto fijado ──
+
+    def pinned_caption(self, media_id):
+        if not self.is_active(media_id):
+            return None
+        return self._fijado.get(str(media_id), {}).get("caption")
+
+    def pin_caption(self, media_id, caption):
+        if caption and self.is_active(media_id):
+            self._fijado.setdefault(str(media_id), {})["caption"] = caption
+
+    def pinned_brand_data(self, media_id, instagram_id):
+        """Datos de marca fijados para la oleada (None fuera de oleada)"""
+        if not self.is_active(media_id):
+            return None
+        fijado = self._fijado.setdefault(str(media_id), {})
+        if "datos" not in fijado:
+            contexto = brand_context_cache.get(instagram_id)
+            fijado["datos"] = contexto["datos"] if contexto else None
+        return fijado["datos"]
+
+    # ── Muestreo y rotación de respuestas ──
+
+    def _clave(self, comment_text):
+        """Intención con confianza suficiente; None si el comentario no se clasifica o es un reclamo"""
+        intencion, confianza = intent_templates.classify(comment_text)
+        return intencion if intencion and confianza >= INTENT_MIN_CONFIDENCE else None
+
+    def respond(self, media_id, comment_text):
+        """Respuesta rotada del pool de la publicación, o None si este comentario va al LLM"""
+        if not self.is_active(media_id):
+            return None
+        media_id = str(media_id)
+        clave = self._clave(comment_text)
+        if clave is None:
+            metrics.inc("comentarios_surge_replies_total", modo="llm")
+            return None
+        with self._lock:
+            pool = self._pools[media_id][clave]
+            self._contador[media_id] += 1
+            if len(pool) < min(3, self.pool) or self._contador[media_id] % self.muestreo == 0:
+                metrics.inc("comentarios_surge_replies_total", modo="llm")
+                return None
+            pool.rotate(-1)
+            respuesta = dict(pool[0])
+        metrics.inc("comentarios_surge_replies_total", modo="rotada")
+        respuesta["origen"] = "oleada"
+        return respuesta
+
+    def remember(self, media_id, comment_text, respuesta):
+        """Agrega una respuesta del LLM al pool de la intención (solo en oleada)"""
+        if not respuesta or respuesta.get("es_inapropiado") or not respuesta.get("respuesta_comentario"):
+            return
+        if not self.is_active(media_id):
+            return
+        clave = self._clave(comment_text)
+        if clave is None:
+            return
+        with self._lock:
+            self._pools[str(media_id)][clave].append({
+                "es_inapropiado": False,
+                "razon_inapropiado": None,
+                "respuesta_comentario": respuesta["respuesta_comentario"],
+                "mensaje_inbox": respuesta.get("mensaje_inbox", "")
+            })
+
+    # ── Ritmo de acciones salientes ──
+
+    def pace(self, media_id):
+        """
+        Reserva el turno de la publicación para escribir en Graph y retorna los
+        segundos que hay que diferir la escritura (0 = escribir ahora). No duerme:
+        el llamador encola la escritura en work_scheduler con esa espera. Sin
+        planificador no hay ritmo. Con la cola ya a espera_max la reserva no avanza.
+        """
+        if not (work_scheduler.enabled and self.is_active(media_id)):
+            return 0.0
+        db = get_local_db()
+        ahora = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            fila = db.execute("SELECT proxima_accion FROM publicaciones_oleada WHERE media_id = ?",
+                              (str(media_id),)).fetchone()
+            turno = max(ahora, fila['proxima_accion']) if fila else ahora
+            if fila and turno - ahora < self.espera_max:
+                db.execute("UPDATE publicaciones_oleada SET proxima_accion = ? WHERE media_id = ?",
+                           (turno + self.intervalo_acciones, str(media_id)))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return min(turno - ahora, self.espera_max)
+
+    # ── Escrituras por lotes ──
+
+    def buffer_log(self, media_id, fila):
+        """Acumula la fila de logs_comentarios si la publicación está en oleada"""
+        return self._acumular(self._logs, media_id, fila)
+
+    def buffer_sheet(self, media_id, valores):
+        """Acumula la fila de Sheets si la publicación está en oleada"""
+        return self._acumular(self._sheets, media_id, valores)
+
+    def _acumular(self, buffer, media_id, elemento):
+        if not self.is_active(media_id):
+            return False
+        with self._lock:
+            buffer.append(elemento)
+            lleno = len(buffer) >= self.lote_logs
+        self.ensure_worker()
+        if lleno:
+            self._wake.set()
+        return True
+
+    def ensure_worker(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="comentarios-oleadas", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.intervalo_logs)
+            self._wake.clear()
+            try:
+                self.flush_writes()
+            except Exception as e:
+                log.error("OLEADA", f"Error escribiendo lote: {e}")
+
+    def flush_writes(self):
+        """Escribe los logs y filas de Sheets acumulados en un insert/append por lote"""
+        with self._lock:
+            logs, self._logs = self._logs, []
+            filas, self._sheets = self._sheets, []
+        for i in range(0, len(logs), self.lote_logs):
+            lote = logs[i:i + self.lote_logs]
+            try:
+                with metrics.timer('log_write_batch'):
+                    supabase.table("logs_comentarios").insert(lote).execute()
+                metrics.inc("comentarios_surge_batched_writes_total", value=len(lote), destino="logs_comentarios")
+            except Exception as e:
+                log.error("SUPABASE", f"Error guardando lote de logs: {e}", filas=len(lote))
+                metrics.error('log_write')
+        if filas and sheet:
+            try:
+                with metrics.timer('sheets_write_batch'):
+                    sheet.values().append(
+                        spreadsheetId=SPREADSHEET_ID,
+                        range='COMENTARIOS INSTAGRAM Y FACEBOOK',
+                        valueInputOption='RAW',
+                        insertDataOption='INSERT_ROWS',
+                        body={'values': filas}
+                    ).execute()
+                metrics.inc("comentarios_surge_batched_writes_total", value=len(filas), destino="sheets")
+            except Exception as e:
+                log.error("SHEETS", f"Error guardando lote de comentarios: {e}", filas=len(filas))
+                metrics.error('sheets_write')
+        return len(logs) + len(filas)
+
+    def active_count(self):
+        if not self.enabled:
+            return 0
+        self._init_table()
+        return get_local_db().execute("SELECT COUNT(*) FROM publicaciones_oleada").fetchone()[0]
+
+    def get_stats(self):
+        self._init_table()
+        db = get_local_db()
+        desde = int(time.time() // self.ancho) - self.BUCKETS
+        return {
+            "habilitado": self.enabled,
+            "ventana_s": self.ventana,
+            "umbral": self.umbral,
+            "umbral_salida": self.umbral * self.salida,
+            "en_oleada": [dict(r, desde=datetime.fromtimestamp(r['desde']).isoformat()) for r in db.execute(
+                "SELECT media_id, brand_id, desde, tasa, pico FROM publicaciones_oleada ORDER BY tasa DESC"
+            )],
+            "mas_activas": [dict(r) for r in db.execute(
+                "SELECT media_id, SUM(n) AS comentarios_ventana FROM publicaciones_llegadas WHERE bucket > ? "
+                "GROUP BY media_id ORDER BY comentarios_ventana DESC LIMIT 10", (desde,)
+            )],
+            "escrituras_en_buffer": len(self._logs) + len(self._sheets)
+        }
+
+# Instancia global
+surge_detector = SurgeDetector()
+metrics.gauge("comentarios_surge_active_media", surge_detector.active_count)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Workflow persistente de aprobación de publicaciones
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class WorkflowStepError(Exception):
+    """Fallo transitorio de un paso del workflow (se reintenta con backoff)"""
+
+
+class PostApprovalWorkflow:
+    """
+    Máquina de estados persistente (SQLite local) para publicaciones nuevas.
+
+    Pasos: obtener_detalles → buscar_admin → guardar_publicacion → crear_tarea → enviar_whatsapp → precalentar_respuestas
+    Estados: en_curso, completado, omitido, fallido
+
+    El webhook solo registra la publicación; un hilo en segundo plano avanza
+    cada workflow y reintenta los pasos fallidos con backoff exponencial.
+    """
+
+    PASOS = ['obtener_detalles', 'buscar_admin', 'guardar_publicacion', 'crear_tarea', 'enviar_whatsapp', 'precalentar_respuestas']
+
+    def __init__(self, max_intentos=6, backoff_base=30, backoff_max=1800, intervalo=5, lease=120):
+        self.max_intentos = max_intentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.intervalo = intervalo
+        self.lease = lease
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._tabla_lista = False
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS workflow_publicaciones (
+                post_id TEXT PRIMARY KEY,
+                page_id TEXT NOT NULL,
+                item_type TEXT,
+                valor TEXT,
+                paso TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'en_curso',
+                contexto TEXT NOT NULL DEFAULT '{}',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                proximo_intento REAL NOT NULL,
+                bloqueado_hasta REAL,
+                ultimo_error TEXT,
+                creado_en TEXT NOT NULL,
+                actualizado_en TEXT NOT NULL
+            )
+        """)
+        get_local_db().execute(
+            "CREATE INDEX IF NOT EXISTS idx_workflow_pendientes ON workflow_publicaciones(estado, proximo_intento)"
+        )
+        self._tabla_lista = True
+
+    def enqueue(self, post_id, page_id, item_type, value):
+        """Registra una publicación nueva. Retorna False si ya estaba registrada"""
+        self._init_table()
+        ahora = datetime.now().isoformat()
+        cursor = get_local_db().execute(
+            "INSERT OR IGNORE INTO workflow_publicaciones "
+            "(post_id, page_id, item_type, valor, paso, proximo_intento, creado_en, actualizado_en) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(post_id), str(page_id), item_type, json.dumps(value or {}),
+             self.PASOS[0], time.time(), ahora, ahora)
+        )
+        self.ensure_worker()
+        self._wake.set()
+        return cursor.rowcount == 1
+
+    def ensure_worker(self):
+        """Inicia el hilo de procesamiento (una vez por proceso)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="workflow-publicaciones", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pending()
+            except Exception as e:
+                log.error("WORKFLOW", f"Error en ciclo: {e}")
+            self._wake.wait(self.intervalo)
+            self._wake.clear()
+
+    def run_pending(self, limite=20):
+        """Avanza los workflows cuyo próximo intento ya venció"""
+        self._init_table()
+        rows = get_local_db().execute(
+            "SELECT * FROM workflow_publicaciones WHERE estado = 'en_curso' AND proximo_intento <= ? "
+            "ORDER BY proximo_intento LIMIT ?",
+            (time.time(), limite)
+        ).fetchall()
+        for row in rows:
+            lease = self._claim(row['post_id'])
+            if lease:
+                self._advance(dict(row), lease)
+
+    def _claim(self, post_id):
+        """Toma el workflow por `lease` segundos (evita doble ejecución entre workers). Retorna el lease o None"""
+        ahora = time.time()
+        cursor = get_local_db().execute(
+            "UPDATE workflow_publicaciones SET bloqueado_hasta = ? "
+            "WHERE post_id = ? AND estado = 'en_curso' AND (bloqueado_hasta IS NULL OR bloqueado_hasta < ?)",
+            (ahora + self.lease, post_id, ahora)
+        )
+        return ahora + self.lease if cursor.rowcount == 1 else None
+
+    def _renew(self, post_id, lease):
+        """Extiende el lease antes de cada paso. Retorna el nuevo lease o None si otro worker lo tomó"""
+        nuevo = time.time() + self.lease
+        cursor = get_local_db().execute(
+            "UPDATE workflow_publicaciones SET bloqueado_hasta = ? WHERE post_id = ? AND bloqueado_hasta = ?",
+            (nuevo, post_id, lease)
+        )
+        return nuevo if cursor.rowcount == 1 else None
+
+    def _advance(self, row, lease):
+        """Ejecuta pasos hasta terminar o fallar, persistiendo el avance tras cada uno"""
+        post_id = row['post_id']
+        paso = row['paso']
+        intentos = row['intentos']
+        ctx = json.loads(row['contexto'] or '{}')
+        ctx.setdefault('post_id', post_id)
+        ctx.setdefault('page_id', row['page_id'])
+        ctx.setdefault('item_type', row['item_type'])
+        ctx.setdefault('value', json.loads(row['valor'] or '{}'))
+
+        while True:
+            lease = self._renew(post_id, lease)
+            if not lease:
+                log.warning("WORKFLOW", f"{post_id} perdió el lease antes de '{paso}'")
+                return
+            try:
+                with tracer.trace('workflow', paso=paso, post_id=post_id):
+                    siguiente = self._ejecutar_paso(paso, ctx)
+            except Exception as e:
+                intentos += 1
+                if intentos >= self.max_intentos:
+                    log.error("WORKFLOW", f"{post_id} falló en '{paso}' tras {intentos} intentos: {e}")
+                    self._save(post_id, paso, 'fallido', ctx, intentos, time.time(), str(e))
+                else:
+                    espera = min(self.backoff_max, self.backoff_base * 2 ** (intentos - 1)) * random.uniform(0.8, 1.2)
+                    log.warning("WORKFLOW", f"{post_id} paso '{paso}' falló ({e}), reintento {intentos} en {espera:.0f}s")
+                    self._save(post_id, paso, 'en_curso', ctx, intentos, time.time() + espera, str(e))
+                return
+
+            if siguiente in ('completado', 'omitido'):
+                log.info("WORKFLOW", f"{post_id} {siguiente}")
+                self._save(post_id, paso, siguiente, ctx, 0, time.time(), None)
+                return
+
+            paso, intentos = siguiente, 0
+            self._save(post_id, paso, 'en_curso', ctx, 0, time.time(), None, liberar=False)
+
+    def _save(self, post_id, paso, estado, ctx, intentos, proximo_intento, error, liberar=True):
+        get_local_db().execute(
+            "UPDATE workflow_publicaciones SET paso = ?, estado = ?, contexto = ?, intentos = ?, "
+            "proximo_intento = ?, ultimo_error = ?, actualizado_en = ?"
+            + (", bloqueado_hasta = NULL" if liberar else "") +
+            " WHERE post_id = ?",
+            (paso, estado, json.dumps(ctx), intentos, proximo_intento, error,
+             datetime.now().isoformat(), post_id)
+        )
+
+    def _save_context(self, post_id, ctx):
+        get_local_db().execute(
+            "UPDATE workflow_publicaciones SET contexto = ?, actualizado_en = ? WHERE post_id = ?",
+            (json.dumps(ctx), datetime.now().isoformat(), post_id)
+        )
+
+    def _ejecutar_paso(self, paso, ctx):
+        """Ejecuta un paso y retorna el siguiente (o 'completado'/'omitido')"""
+        if paso == 'obtener_detalles':
+            account = get_account_by_page_id(ctx['page_id'])
+            if not account:
+                raise WorkflowStepError(f"Cuenta no encontrada para page_id: {ctx['page_id']}")
+            ctx['page_name'] = account.get('page_name', 'Marca')
+            ctx['instagram_id'] = account.get('instagram_id') or ctx['page_id']
+
+            post_details = get_post_details(ctx['post_id'], account.get('page_access_token'))
+            if not post_details:
+                # Si no podemos obtener detalles, crear datos básicos
+                value = ctx['value']
+                post_details = {
+                    'post_id': ctx['post_id'],
+                    'caption': value.get('message', '') or value.get('story', ''),
+                    'media_type': ctx['item_type'],
+                    'permalink': value.get('link', ''),
+                    'timestamp': datetime.now().isoformat()
+                }
+            ctx['post_details'] = post_details
+            return 'buscar_admin'
+
+        if paso == 'buscar_admin':
+            ctx['admin_info'] = get_admin_phone_by_marca(ctx['instagram_id'])
+            return 'guardar_publicacion'
+
+        if paso == 'guardar_publicacion':
+            estado_aprobacion = 'pendiente' if ctx.get('admin_info') else 'activo'
+            if not ctx.get('guardado_propio'):
+                if self._publicacion_existe(ctx['instagram_id'], ctx['post_id']):
+                    # Ya existía antes de este workflow: nada que notificar
+                    log.info("WORKFLOW", f"Publicación ya existía: {ctx['post_id']}")
+                    return 'omitido'
+                # Se persiste antes del insert: si el proceso muere justo después,
+                # al reanudar la fila existente es de este workflow y se sigue con la tarea
+                ctx['guardado_propio'] = True
+                self._save_context(ctx['post_id'], ctx)
+            saved = save_post_to_base_cuentas(ctx['instagram_id'], ctx['page_name'], ctx['post_details'], estado_aprobacion)
+            if not saved and not self._publicacion_existe(ctx['instagram_id'], ctx['post_id']):
+                raise WorkflowStepError("No se pudo guardar la publicación")
+            log.info("WORKFLOW", f"Publicación guardada ({estado_aprobacion}): {ctx['post_id']}")
+            return 'crear_tarea' if ctx.get('admin_info') else 'precalentar_respuestas'
+
+        if paso == 'crear_tarea':
+            tarea = create_approval_task(ctx['instagram_id'], ctx['page_name'], ctx['post_details'], ctx['admin_info'])
+            if not tarea:
+                raise WorkflowStepError("No se pudo crear la tarea de aprobación")
+            ctx['tarea_id'] = tarea['id']
+            return 'enviar_whatsapp'
+
+        if paso == 'enviar_whatsapp':
+            if not send_whatsapp_approval_request(ctx['admin_info'], ctx['post_details'], ctx['page_name'], ctx['tarea_id']):
+                raise WorkflowStepError("WhatsApp falló")
+            return 'precalentar_respuestas'
+
+        if paso == 'precalentar_respuestas':
+            # Último paso y opcional: la completion no retrasa la aprobación y si falla el workflow termina igual
+            if speculative_replies.enabled:
+                try:
+                    speculative_replies.warm(ctx['post_id'], ctx['instagram_id'], ctx['post_details'].get('caption', ''))
+                except Exception as e:
+                    log.warning("ANTICIPADAS", f"No se pudo precalentar {ctx['post_id']}: {e}")
+            return 'completado'
+
+        raise ValueError(f"Paso desconocido: {paso}")
+
+    def run_inline(self, post_id, page_id, item_type, value):
+        """Ejecuta todos los pasos en el hilo actual, sin persistencia ni reintentos"""
+        ctx = {'post_id': post_id, 'page_id': page_id, 'item_type': item_type, 'value': value or {}}
+        paso = self.PASOS[0]
+        try:
+            while paso not in ('completado', 'omitido'):
+                paso = self._ejecutar_paso(paso, ctx)
+            return paso == 'completado'
+        except Exception as e:
+            log.warning("WORKFLOW", f"Flujo en línea incompleto en '{paso}': {e}")
+            return False
+
+    def _publicacion_existe(self, instagram_id, post_id):
+        if not supabase:
+            return False
+        existing = supabase.table("base_cuentas")\
+            .select("id")\
+            .eq("ID marca", str(instagram_id))\
+            .eq("categoria", "publicacion")\
+            .eq("clave", str(post_id))\
+            .execute()
+        return bool(existing.data)
+
+    def pending_count(self):
+        self._init_table()
+        return get_local_db().execute(
+            "SELECT COUNT(*) FROM workflow_publicaciones WHERE estado = 'en_curso'"
+        ).fetchone()[0]
+
+    def get_stats(self, limite=20):
+        """Resumen de estados y últimos workflows (para diagnóstico)"""
+        self._init_table()
+        db = get_local_db()
+        por_estado = {r['estado']: r['total'] for r in db.execute(
+            "SELECT estado, COUNT(*) AS total FROM workflow_publicaciones GROUP BY estado"
+        )}
+        recientes = [dict(r) for r in db.execute(
+            "SELECT post_id, page_id, paso, estado, intentos, ultimo_error, creado_en, actualizado_en "
+            "FROM workflow_publicaciones ORDER BY actualizado_en DESC LIMIT ?", (limite,)
+        )]
+        return {"por_estado": por_estado, "recientes": recientes}
+
+# Instancia global
+post_workflow = PostApprovalWorkflow()
+metrics.gauge("comentarios_queue_depth", post_workflow.pending_count, queue="workflow_publicaciones")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Scheduler de mantenimiento
+# ═══════════════════════════════════════════════════════════════════════════════
+
+MAINTENANCE_ENABLED = os.getenv('MAINTENANCE_ENABLED', 'true').lower() != 'false'
+LOGS_RETENTION_DAYS = int(os.getenv('LOGS_RETENTION_DAYS', '0'))  # 0 = conservar logs_comentarios
+LOCAL_STATE_RETENTION_DAYS = int(os.getenv('LOCAL_STATE_RETENTION_DAYS', '14'))
+
+
+class MaintenanceScheduler:
+    """
+    Ejecuta tareas de mantenimiento periódicas en un hilo en segundo plano.
+
+    Solo un worker por máquina (el líder, elegido con un lease en la base SQLite local)
+    ejecuta los jobs; con varias máquinas cada una tiene su líder, así que los jobs
+    sobre Supabase deben tolerar ejecutarse en paralelo. El lease se renueva antes de
+    cada job y cada lease/3 mientras un job corre; si se pierde, el ciclo se detiene.
+    La próxima ejecución y la duración de cada job quedan en la tabla
+    mantenimiento_jobs, así sobreviven a reinicios y cambios de líder.
+    """
+
+    def __init__(self, tick=30, lease=90):
+        self.tick = tick
+        self.lease = lease
+        self.jobs = {}
+        self.owner = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._tabla_lista = False
+
+    def register(self, nombre, funcion, intervalo):
+        """Registra un job que se ejecuta cada `intervalo` segundos"""
+        self.jobs[nombre] = {"funcion": funcion, "intervalo": intervalo}
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        db = get_local_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS scheduler_lider (
+                nombre TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expira REAL NOT NULL
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS mantenimiento_jobs (
+                nombre TEXT PRIMARY KEY,
+                proxima_ejecucion REAL NOT NULL,
+                ultima_ejecucion TEXT,
+                duracion_ms REAL,
+                resultado TEXT,
+                error TEXT,
+                ejecuciones INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._tabla_lista = True
+
+    def ensure_worker(self):
+        """Inicia el hilo del scheduler (una vez por proceso)"""
+        if not MAINTENANCE_ENABLED:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = f"{self.owner.rsplit(':', 1)[0]}:{os.getpid()}"
+            self._thread = threading.Thread(target=self._run, name="mantenimiento", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.is_leader():
+                    self.run_due_jobs()
+            except Exception as e:
+                log.error("MANTENIMIENTO", f"Error en ciclo: {e}")
+            time.sleep(self.tick)
+
+    def is_leader(self):
+        """Adquiere o renueva el lease de líder"""
+        self._init_table()
+        db = get_local_db()
+        ahora = time.time()
+        db.execute(
+            "INSERT OR IGNORE INTO scheduler_lider (nombre, owner, expira) VALUES ('mantenimiento', ?, ?)",
+            (self.owner, ahora + self.lease)
+        )
+        cursor = db.execute(
+            "UPDATE scheduler_lider SET owner = ?, expira = ? "
+            "WHERE nombre = 'mantenimiento' AND (owner = ? OR expira < ?)",
+            (self.owner, ahora + self.lease, self.owner, ahora)
+        )
+        return cursor.rowcount == 1
+
+    def _renovar(self):
+        """Extiende el lease solo si este worker sigue siendo el líder"""
+        cursor = get_local_db().execute(
+            "UPDATE scheduler_lider SET expira = ? WHERE nombre = 'mantenimiento' AND owner = ?",
+            (time.time() + self.lease, self.owner)
+        )
+        return cursor.rowcount == 1
+
+    def _latido(self, terminado):
+        while not terminado.wait(self.lease / 3):
+            if not self._renovar():
+                return
+
+    def run_due_jobs(self):
+        db = get_local_db()
+        ahora = time.time()
+        for nombre, job in self.jobs.items():
+            db.execute(
+                "INSERT OR IGNORE INTO mantenimiento_jobs (nombre, proxima_ejecucion) VALUES (?, ?)",
+                (nombre, ahora)
+            )
+            fila = db.execute(
+                "SELECT proxima_ejecucion FROM mantenimiento_jobs WHERE nombre = ?", (nombre,)
+            ).fetchone()
+            if fila['proxima_ejecucion'] > ahora:
+                continue
+            if not self._renovar():
+                log.warning("MANTENIMIENTO", "Lease de líder perdido, se detiene el ciclo", worker=self.owner)
+                return
+            terminado = threading.Event()
+            latido = threading.Thread(target=self._latido, args=(terminado,), name="mantenimiento-lease", daemon=True)
+            latido.start()
+            try:
+                self.run_job(nombre)
+            finally:
+                terminado.set()
+
+    def run_job(self, nombre):
+        """Ejecuta un job y registra duración, resultado y error"""
+        job = self.jobs[nombre]
+        inicio = time.perf_counter()
+        resultado, error = None, None
+        try:
+            resultado = job["funcion"]()
+        except Exception as e:
+            error = str(e)
+        duracion_ms = (time.perf_counter() - inicio) * 1000
+
+        get_local_db().execute(
+            "UPDATE mantenimiento_jobs SET proxima_ejecucion = ?, ultima_ejecucion = ?, duracion_ms = ?, "
+            "resultado = ?, error = ?, ejecuciones = ejecuciones + 1 WHERE nombre = ?",
+            (time.time() + job["intervalo"], datetime.now().isoformat(), duracion_ms,
+             json.dumps(resultado), error, nombre)
+        )
+        if error:
+            log.error("MANTENIMIENTO", f"{nombre} falló en {duracion_ms:.0f}ms: {error}")
+        else:
+            log.info("MANTENIMIENTO", f"{nombre}: {resultado} ({duracion_ms:.0f}ms)")
+        return resultado
+
+    def get_stats(self):
+        """Estado de los jobs y del líder (para diagnóstico)"""
+        self._init_table()
+        db = get_local_db()
+        lider = db.execute("SELECT owner, expira FROM scheduler_lider WHERE nombre = 'mantenimiento'").fetchone()
+        return {
+            "activo": MAINTENANCE_ENABLED,
+            "worker": self.owner,
+            "lider": dict(lider) if lider else None,
+            "jobs": [dict(r) for r in db.execute("SELECT * FROM mantenimiento_jobs ORDER BY nombre")]
+        }
+
+
+def cleanup_local_state(dias=LOCAL_STATE_RETENTION_DAYS):
+    """Elimina workflows terminados, mensajes WhatsApp, ráfagas y trabajos ya procesados de la base local"""
+    if dias <= 0:
+        return 0
+    limite = (datetime.now() - timedelta(days=dias)).isoformat()
+    db = get_local_db()
+    post_workflow._init_table()
+    whatsapp_outbox._init_table()
+    eliminados = db.execute(
+        "DELETE FROM workflow_publicaciones WHERE estado != 'en_curso' AND actualizado_en < ?", (limite,)
+    ).rowcount
+    eliminados += db.execute(
+        "DELETE FROM whatsapp_outbox WHERE estado NOT IN ('pendiente', 'enviando') AND creado_en < ?", (limite,)
+    ).rowcount
+    eliminados += speculative_replies.cleanup()
+    comment_debouncer._init_table()
+    eliminados += db.execute(
+        "DELETE FROM comentarios_rafagas WHERE estado IN ('procesado', 'error') AND creado_en < ?", (limite,)
+    ).rowcount
+    page_onboarding.expire_stale()
+    eliminados += db.execute(
+        "DELETE FROM conexiones_paginas WHERE estado != 'en_curso' AND creado_en < ?", (limite,)
+    ).rowcount
+    token_health._init_table()
+    eliminados += db.execute(
+        "DELETE FROM tokens_salud WHERE verificado_en < ?", (time.time() - dias * 86400,)
+    ).rowcount
+    work_scheduler._init_table()
+    eliminados += db.execute(
+        "DELETE FROM cola_trabajo WHERE estado IN ('hecho', 'fallido') AND creado_en < ?", (limite,)
+    ).rowcount
+    return eliminados
+
+
+# Instancia global
+maintenance_scheduler = MaintenanceScheduler()
+maintenance_scheduler.register('locks_expirados', cleanup_old_locks, 3600)
+maintenance_scheduler.register('base_cuentas_caducadas', deactivate_expired_base_cuentas, 6 * 3600)
+maintenance_scheduler.register('logs_comentarios_retencion', lambda: cleanup_old_comment_logs(LOGS_RETENTION_DAYS), 24 * 3600)
+maintenance_scheduler.register('estado_local_retencion', cleanup_local_state, 24 * 3600)
+maintenance_scheduler.register('antibucle_expirados', lambda: anti_loop.cleanup(), 600)
+maintenance_scheduler.register('escrituras_diferidas', lambda: load_shedder.replay_deferred(), 60)
+maintenance_scheduler.register('oleadas', lambda: surge_detector.refresh(), 60)
+maintenance_scheduler.register('tokens_salud', lambda: token_health.check_all(), TOKEN_CHECK_INTERVAL)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PROCESADORES DE EVENTOS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def send_comment_reply(platform, comment_id, message, token):
+    """Responde públicamente un comentario una sola vez (también si se reintenta o se difirió)"""
+    if anti_loop.action_done('respuesta', comment_id):
+        return True
+    reply = reply_to_instagram_comment if platform == "instagram" else reply_to_facebook_comment
+    enviada = 'id' in reply(comment_id, message, token)
+    if enviada:
+        anti_loop.mark_action_done('respuesta', comment_id)
+    return enviada
+
+
+def send_comment_dm(comment_id, recipient_id, message, token):
+    """Envía el DM de un comentario una sola vez (también si se reintenta o se difirió)"""
+    if anti_loop.action_done('dm', comment_id):
+        return True
+    enviado = 'message_id' in send_direct_message(recipient_id, message, token)
+    if enviado:
+        anti_loop.mark_action_done('dm', comment_id)
+    return enviado
+
+
+def process_comments(platform, brand_id, media_id, sender_id, sender_name, comentarios, token):
+    """
+    Flujo común de comentarios de Instagram y Facebook: uno solo o una ráfaga del
+    mismo usuario en la misma publicación (lista de (comment_id, texto)).
+
+    Una generación sobre el texto combinado, ocultar si es inapropiado, una
+    respuesta pública (al comentario más reciente), un DM y el registro de cada
+    comentario en logs_comentarios y Sheets.
+    """
+    inicio = time.perf_counter()
+    categoria = "IG_COMMENT" if platform == "instagram" else "FB_COMMENT"
+    plataforma = "Instagram" if platform == "instagram" else "Facebook"
+    ultimo_id = comentarios[-1][0]
+
+    # Verificaciones anti-bucle
+    if anti_loop.is_own_account(sender_id):
+        log.warning(categoria, "Cuenta propia, ignorando", comment_id=ultimo_id)
+        return None
+
+    comentarios = [(cid, text) for cid, text in comentarios if not is_unwanted_message(text)]
+    if not comentarios:
+        log.info(categoria, "Mensaje indeseado, ignorando", comment_id=ultimo_id)
+        return None
+    ultimo_id = comentarios[-1][0]
+
+    # Obtener cuenta
+    account = get_account_by_instagram_id(brand_id) if platform == "instagram" else get_account_by_page_id(brand_id)
+    if not account:
+        log.error(categoria, "Cuenta no encontrada", comment_id=ultimo_id, brand=brand_id)
+        return None
+
+    page_name = account.get('page_name', 'Marca')
+    instagram_id = brand_id if platform == "instagram" else (account.get('instagram_id') or brand_id)
+
+    # Verificar que no es la propia página
+    if platform == "facebook" and sender_name == page_name:
+        log.warning(categoria, "Comentario de la propia página, ignorando", comment_id=ultimo_id)
+        return None
+
+    # Obtener descripción del post y generar respuestas
+    post_description = get_post_description(media_id, token)
+    texto = "\n".join(text for _, text in comentarios)
+    respuestas = generate_responses(instagram_id, post_description, texto, ultimo_id, media_id)
+
+    respuesta_publica = respuestas.get("respuesta_comentario", "")
+    mensaje_inbox = respuestas.get("mensaje_inbox", "")
+
+    # Ocultar si es inapropiado
+    if respuestas.get("es_inapropiado", False):
+        log.info(categoria, "Ocultando comentario inapropiado", comment_id=ultimo_id, comentarios=len(comentarios))
+        for comment_id, _ in comentarios:
+            hide_comment(comment_id, token)
+
+    # Enviar respuesta pública (una sola, al comentario más reciente). Las escrituras
+    # en Graph quedan registradas: si el trabajo falla después y se reintenta, no se repiten
+    # En oleada la escritura se encola con la espera del turno de la publicación
+    respuesta_enviada = False
+    if respuesta_publica:
+        if anti_loop.action_done('respuesta', ultimo_id):
+            respuesta_enviada = True
+        else:
+            espera = surge_detector.pace(media_id)
+            if espera > 0:
+                work_scheduler.submit('comentario', brand_id, 'respuesta_comentario',
+                                      {"platform": platform, "comment_id": ultimo_id, "message": respuesta_publica},
+                                      espera=espera)
+            else:
+                respuesta_enviada = send_comment_reply(platform, ultimo_id, respuesta_publica, token)
+
+    # Enviar DM
+    dm_enviado = False
+    if mensaje_inbox and anti_loop.action_done('dm', ultimo_id):
+        dm_enviado = True
+    elif mensaje_inbox and not load_shedder.shed_dm(brand_id, sender_id, mensaje_inbox, token):
+        espera = surge_detector.pace(media_id)
+        if espera > 0:
+            work_scheduler.submit('comentario', brand_id, 'dm_comentario',
+                                  {"comment_id": ultimo_id, "recipient_id": sender_id, "message": mensaje_inbox},
+                                  espera=espera)
+        else:
+            dm_enviado = send_comment_dm(ultimo_id, sender_id, mensaje_inbox, token)
+
+    # Guardar log en Supabase (las acciones se registran en el comentario respondido)
+    for comment_id, text in comentarios:
+        es_ultimo = comment_id == ultimo_id
+        save_comment_log(
+            instagram_id=instagram_id,
+            nombre_marca=page_name,
+            post_description=post_description,
+            comment_text=text,
+            respuestas=respuestas,
+            platform=plataforma,
+            comment_id=comment_id,
+            sender_id=sender_id,
+            media_id=media_id,
+            respuesta_enviada=respuesta_enviada and es_ultimo,
+            dm_enviado=dm_enviado and es_ultimo
+        )
+
+    # Guardar en Sheets (fallback)
+    save_comment_to_sheets(
+        sender_name=sender_name or "Usuario",
+        sender_id=sender_id,
+        message=texto,
+        post_id=media_id or "",
+        comment_id=ultimo_id,
+        platform=plataforma,
+        user_id_owner=instagram_id,
+        reply_message=respuesta_publica,
+        inbox_message=mensaje_inbox
+    )
+
+    log.info(categoria, "Procesado", comment_id=ultimo_id, brand=instagram_id, stage="process",
+             comentarios=len(comentarios), ms=round((time.perf_counter() - inicio) * 1000),
+             respuesta=respuesta_enviada, dm=dm_enviado)
+    return respuestas
+
+
+def process_instagram_comment(comment_id, media_id, instagram_id, text, sender_id, token):
+    """Procesa un comentario de Instagram"""
+    log.info("IG_COMMENT", "Comentario recibido", comment_id=comment_id, sender_id=sender_id,
+             brand=instagram_id, texto=text[:80])
+    return process_comments("instagram", instagram_id, media_id, sender_id, "", [(comment_id, text)], token)
+
+
+def process_facebook_comment(comment_id, post_id, page_id, text, sender_id, sender_name, token):
+    """Procesa un comentario de Facebook"""
+    log.info("FB_COMMENT", "Comentario recibido", comment_id=comment_id, sender_id=sender_id,
+             brand=page_id, texto=text[:80])
+    return process_comments("facebook", page_id, post_id, sender_id, sender_name, [(comment_id, text)], token)
+
+
+def process_new_post(post_id, page_id, item_type, value, token):
+    """
+    Registra una nueva publicación en el workflow persistente de aprobación.
+    Los pasos (detalles, admin, guardado, tarea, WhatsApp) corren en segundo
+    plano con reintentos; ver PostApprovalWorkflow.
+
+    item_type puede ser: status, photo, video, share
+    """
+    log.info("NEW_POST", "Publicación detectada", post_id=post_id, brand=page_id, tipo=item_type)
+
+    try:
+        registrado = post_workflow.enqueue(post_id, page_id, item_type, value)
+    except Exception as e:
+        # Sin base local: ejecutar el workflow en línea (comportamiento anterior, sin reintentos)
+        log.warning("NEW_POST", f"No se pudo registrar en workflow local ({e}), procesando en línea")
+        return post_workflow.run_inline(post_id, page_id, item_type, value)
+
+    if registrado:
+        log.info("NEW_POST", "Publicación registrada en workflow", post_id=post_id)
+    else:
+        log.info("NEW_POST", "Publicación ya registrada", post_id=post_id)
+    return registrado
+
+
+def process_messenger_message(sender_id, page_id, message_text, token):
+    """Procesa un mensaje de Messenger"""
+    log.info("MESSENGER", "Mensaje recibido", sender_id=sender_id, brand=page_id, texto=message_text[:50])
+
+    if anti_loop.is_own_account(sender_id):
+        return None
+
+    if is_unwanted_message(message_text):
+        return None
+
+    account = get_account_by_page_id(page_id)
+    if not account:
+        log.error("MESSENGER", "Cuenta no encontrada", brand=page_id)
+        return None
+
+    instagram_id = account.get('instagram_id') or page_id
+
+    respuesta = generate_dm_response(instagram_id, message_text, sender_id)
+    if respuesta:
+        send_direct_message(sender_id, respuesta, token)
+
+    return respuesta
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Agrupación de ráfagas de comentarios
+# ═══════════════════════════════════════════════════════════════════════════════
+
+COMMENT_DEBOUNCE_SECONDS = float(os.getenv('COMMENT_DEBOUNCE_SECONDS', '0'))  # 0 = procesar al instante
+COMMENT_DEBOUNCE_MAX_SECONDS = float(os.getenv('COMMENT_DEBOUNCE_MAX_SECONDS', str(COMMENT_DEBOUNCE_SECONDS * 3)))
+COMMENT_DEBOUNCE_WORKERS = int(os.getenv('COMMENT_DEBOUNCE_WORKERS', '4'))  # grupos procesados a la vez por proceso
+
+
+class CommentDebouncer:
+    """
+    Agrupa los comentarios de un mismo usuario en la misma publicación que llegan
+    dentro de una ventana (COMMENT_DEBOUNCE_SECONDS, deslizante hasta
+    COMMENT_DEBOUNCE_MAX_SECONDS desde el primero). Cada grupo se procesa con una
+    sola llamada a OpenAI, un DM y una respuesta pública (ver process_comments).
+
+    Los comentarios esperan en la base SQLite local, así que una ráfaga repartida
+    entre workers se agrupa igual; cada grupo lo procesa un solo worker (lease,
+    renovado mientras el grupo está en curso). Los grupos vencidos se reparten en
+    un pool de COMMENT_DEBOUNCE_WORKERS hilos por proceso.
+    """
+
+    def __init__(self, ventana=COMMENT_DEBOUNCE_SECONDS, ventana_max=COMMENT_DEBOUNCE_MAX_SECONDS,
+                 workers=COMMENT_DEBOUNCE_WORKERS, lease=120, intervalo=0.5):
+        self.ventana = ventana
+        self.ventana_max = max(ventana_max, ventana)
+        self.workers = max(1, workers)
+        self.lease = lease
+        self.intervalo = intervalo
+        self._pool = None
+        self._en_curso = set()  # lotes de este proceso en el pool
+        self._ultima_renovacion = 0.0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._tabla_lista = False
+
+    @property
+    def enabled(self):
+        return self.ventana > 0
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        db = get_local_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS comentarios_rafagas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                grupo TEXT NOT NULL,
+                platform TEXT NOT NULL,
+                brand_id TEXT NOT NULL,
+                media_id TEXT,
+                sender_id TEXT NOT NULL,
+                sender_name TEXT,
+                comment_id TEXT NOT NULL,
+                texto TEXT NOT NULL,
+                recibido REAL NOT NULL,
+                procesar_en REAL NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                lote TEXT,
+                bloqueado_hasta REAL,
+                creado_en TEXT NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_rafagas_pendientes ON comentarios_rafagas(estado, procesar_en)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_rafagas_grupo ON comentarios_rafagas(grupo, estado)")
+        self._tabla_lista = True
+
+    def submit(self, platform, brand_id, media_id, sender_id, comment_id, text, sender_name=""):
+        """Agrega un comentario a la ráfaga de (usuario, publicación) y extiende la ventana"""
+        self._init_table()
+        db = get_local_db()
+        ahora = time.time()
+        grupo = f"{platform}:{sender_id}:{media_id or ''}"
+        primero = db.execute(
+            "SELECT MIN(recibido) FROM comentarios_rafagas WHERE grupo = ? AND estado = 'pendiente'", (grupo,)
+        ).fetchone()[0] or ahora
+        procesar_en = min(ahora + self.ventana, primero + self.ventana_max)
+
+        db.execute(
+            "INSERT INTO comentarios_rafagas (grupo, platform, brand_id, media_id, sender_id, sender_name, "
+            "comment_id, texto, recibido, procesar_en, creado_en) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (grupo, platform, str(brand_id), media_id, str(sender_id), sender_name, str(comment_id), text,
+             ahora, procesar_en, datetime.now().isoformat())
+        )
+        db.execute(
+            "UPDATE comentarios_rafagas SET procesar_en = ? WHERE grupo = ? AND estado = 'pendiente'",
+            (procesar_en, grupo)
+        )
+        log.info("RAFAGA", "Comentario en espera", comment_id=comment_id, grupo=grupo,
+                 espera_s=round(procesar_en - ahora, 1))
+        self.ensure_worker()
+        return True
+
+    def ensure_worker(self):
+        """Inicia el hilo que procesa las ráfagas vencidas (una vez por proceso)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="comentarios-rafaga")
+            self._en_curso = set()
+            self._thread = threading.Thread(target=self._run, name="comentarios-rafagas", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("RAFAGA", f"Error procesando ráfagas: {e}")
+            self._wake.wait(self.intervalo)
+            self._wake.clear()
+
+    def flush(self):
+        """Reparte en el pool los grupos cuya ventana ya cerró (sin pool: los procesa en este hilo)"""
+        self._init_table()
+        self._renovar()
+        db = get_local_db()
+        ahora = time.time()
+        with self._lock:
+            libres = self.workers - len(self._en_curso) if self._pool else -1
+        if libres == 0:
+            return 0
+        grupos = [r['grupo'] for r in db.execute(
+            "SELECT DISTINCT grupo FROM comentarios_rafagas WHERE (estado = 'pendiente' AND procesar_en <= ?) "
+            "OR (estado = 'procesando' AND bloqueado_hasta < ?) LIMIT ?",
+            (ahora, ahora, libres)
+        )]
+        procesados = 0
+        for grupo in grupos:
+            filas = self._claim(grupo, ahora)
+            if not filas:
+                continue
+            if self._pool:
+                with self._lock:
+                    self._en_curso.add(filas[0]['lote'])
+                self._pool.submit(self._procesar, filas)
+            else:
+                self._procesar(filas)
+            procesados += 1
+        return procesados
+
+    def _renovar(self):
+        """Extiende el lease de los grupos en curso en este proceso (cada lease/3 segundos)"""
+        ahora = time.time()
+        with self._lock:
+            lotes = list(self._en_curso)
+        if not lotes or ahora - self._ultima_renovacion < self.lease / 3:
+            return
+        self._ultima_renovacion = ahora
+        get_local_db().execute(
+            f"UPDATE comentarios_rafagas SET bloqueado_hasta = ? "
+            f"WHERE estado = 'procesando' AND lote IN ({','.join('?' * len(lotes))})",
+            [ahora + self.lease] + lotes
+        )
+
+    def _claim(self, grupo, ahora):
+        db = get_local_db()
+        lote = uuid.uuid4().hex
+        cursor = db.execute(
+            "UPDATE comentarios_rafagas SET estado = 'procesando', lote = ?, bloqueado_hasta = ? "
+            "WHERE grupo = ? AND ((estado = 'pendiente' AND procesar_en <= ?) "
+            "OR (estado = 'procesando' AND bloqueado_hasta < ?))",
+            (lote, ahora + self.lease, grupo, ahora, ahora)
+        )
+        if cursor.rowcount == 0:
+            return []
+        return [dict(r) for r in db.execute("SELECT * FROM comentarios_rafagas WHERE lote = ? ORDER BY id", (lote,))]
+
+    def _procesar(self, filas):
+        primera = filas[0]
+        estado = 'procesado'
+        metrics.inc("comentarios_debounce_groups_total", tipo="agrupado" if len(filas) > 1 else "individual")
+        try:
+            with tracer.trace('rafaga', platform=primera['platform'], brand=primera['brand_id'], comentarios=len(filas)):
+                dispatch_work('comentario', primera['brand_id'], 'rafaga', {
+                    "platform": primera['platform'], "brand_id": primera['brand_id'], "media_id": primera['media_id'],
+                    "sender_id": primera['sender_id'], "sender_name": primera['sender_name'],
+                    "comentarios": [(f['comment_id'], f['texto']) for f in filas]
+                })
+        except Exception as e:
+            estado = 'error'
+            log.error("RAFAGA", f"Error procesando grupo: {e}", grupo=primera['grupo'], exc_info=True)
+        try:
+            get_local_db().execute(
+                "UPDATE comentarios_rafagas SET estado = ?, bloqueado_hasta = NULL WHERE lote = ?",
+                (estado, primera['lote'])
+            )
+        finally:
+            with self._lock:
+                self._en_curso.discard(primera['lote'])
+            self._wake.set()
+
+    def pending_count(self):
+        if not self.enabled:
+            return 0
+        self._init_table()
+        return get_local_db().execute(
+            "SELECT COUNT(*) FROM comentarios_rafagas WHERE estado = 'pendiente'"
+        ).fetchone()[0]
+
+    def get_stats(self):
+        self._init_table()
+        db = get_local_db()
+        with self._lock:
+            en_curso = len(self._en_curso)
+        return {
+            "ventana_s": self.ventana,
+            "ventana_max_s": self.ventana_max,
+            "grupos_en_curso": en_curso,
+            "por_estado": {r['estado']: r['n'] for r in db.execute(
+                "SELECT estado, COUNT(*) AS n FROM comentarios_rafagas GROUP BY estado"
+            )},
+            "grupos_recientes": [dict(r) for r in db.execute(
+                "SELECT grupo, COUNT(*) AS comentarios, MAX(estado) AS estado, MAX(creado_en) AS ultimo "
+                "FROM comentarios_rafagas GROUP BY COALESCE(lote, grupo) ORDER BY ultimo DESC LIMIT 20"
+            )]
+        }
+
+
+def process_comment_burst(platform, brand_id, media_id, sender_id, sender_name, comentarios):
+    """Procesa una ráfaga de comentarios del mismo usuario en la misma publicación (ver process_comments)"""
+    token = get_entry_token(brand_id, {})
+    if not token:
+        return None
+    if len(comentarios) > 1:
+        log.info("IG_COMMENT" if platform == "instagram" else "FB_COMMENT", "Ráfaga recibida",
+                 brand=brand_id, sender_id=sender_id, comentarios=len(comentarios))
+    return process_comments(platform, brand_id, media_id, sender_id, sender_name,
+                            [tuple(c) for c in comentarios], token)
+
+
+# Instancia global
+comment_debouncer = CommentDebouncer()
+metrics.gauge("comentarios_queue_depth", comment_debouncer.pending_count, queue="comentarios_rafagas")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Planificador de trabajo por marca
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def process_instagram_comment(comment_id, media_id, instagram_id, text, sender_id, token):
-    """Procesa un comentario de Instagram"""
-    print(f"\n[IG_COMMENT] ═══════════════════════════════════════")
-    print(f"[IG_COMMENT] Comment: {comment_id}")
-    print(f"[IG_COMMENT] Sender: {sender_id}")
-    print(f"[IG_COMMENT] Texto: {text[:80]}...")
-
-    # Verificaciones anti-bucle
-    if anti_loop.is_own_account(sender_id):
-        print(f"[IG_COMMENT] ⚠️ Cuenta propia, ignorando")
-        return None
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '0'))  # 0 = procesar en el hilo de la request
+SCHEDULER_BRAND_CONCURRENCY = int(os.getenv('SCHEDULER_BRAND_CONCURRENCY', '2'))  # trabajos simultáneos por marca
+SCHEDULER_CLASS_WEIGHTS = os.getenv('SCHEDULER_CLASS_WEIGHTS', 'dm:16,comentario:8,publicacion:4,reintento:2,backfill:1')
+SCHEDULER_BRAND_WEIGHTS = os.getenv('SCHEDULER_BRAND_WEIGHTS', '')  # "instagram_id:peso,..." (por defecto 1)
+SCHEDULER_MAX_RETRIES = int(os.getenv('SCHEDULER_MAX_RETRIES', '3'))
 
-    if is_unwanted_message(text):
-        print(f"[IG_COMMENT] ⚠️ Mensaje indeseado, ignorando")
-        return None
 
-    # Obtener cuenta
-    account = get_account_by_instagram_id(instagram_id)
-    if not account:
-        print(f"[IG_COMMENT] ❌ Cuenta no encontrada")
-        return None
+def parse_weights(texto):
+    """'a:2,b:1' -> {'a': 2.0, 'b': 1.0} (ignora entradas mal formadas)"""
+    pesos = {}
+    for parte in (texto or '').split(','):
+        clave, _, valor = parte.strip().rpartition(':')
+        try:
+            if clave and float(valor) > 0:
+                pesos[clave] = float(valor)
+        except ValueError:
+            continue
+    return pesos
 
-    page_name = account.get('page_name', 'Marca')
 
-    # Obtener descripción del post
-    post_description = get_post_description(media_id, token)
+class WorkScheduler:
+    """
+    Cola persistente (SQLite local) del trabajo de procesamiento, compartida entre
+    workers. Reparte los hilos con start-time fair queuing en dos niveles:
+
+    - Entre clases de prioridad (dm, comentario, publicacion, reintento, backfill)
+      según SCHEDULER_CLASS_WEIGHTS: un DM pasa antes que una publicación nueva,
+      pero el backfill nunca queda sin turno.
+    - Dentro de la clase, entre marcas (instagram_id / page_id): cada marca avanza
+      su reloj virtual por trabajo despachado, así una marca con miles de
+      comentarios no retrasa a las demás más de un turno.
+
+    Cada marca tiene como máximo SCHEDULER_BRAND_CONCURRENCY trabajos en curso
+    (leases en la tabla, válidos entre procesos, renovados mientras el trabajo
+    corre). Los trabajos que fallan vuelven a la cola en la clase 'reintento' con
+    backoff exponencial; las respuestas y DMs ya enviados no se repiten
+    (ver AntiLoopSystem.action_done).
+    """
 
-    # Generar respuestas
-    respuestas = generate_responses(instagram_id, post_description, text)
+    CLASES = ('dm', 'comentario', 'publicacion', 'reintento', 'backfill')
+
+    def __init__(self, workers=SCHEDULER_WORKERS, por_marca=SCHEDULER_BRAND_CONCURRENCY,
+                 pesos_clase=SCHEDULER_CLASS_WEIGHTS, pesos_marca=SCHEDULER_BRAND_WEIGHTS,
+                 max_intentos=SCHEDULER_MAX_RETRIES, lease=300, backoff_base=15, intervalo=0.5):
+        self.workers = workers
+        self.por_marca = max(1, por_marca)
+        self.pesos_clase = {c: 1.0 for c in self.CLASES}
+        self.pesos_clase.update(parse_weights(pesos_clase))
+        self.pesos_marca = parse_weights(pesos_marca)
+        self.max_intentos = max_intentos
+        self.lease = lease
+        self.backoff_base = backoff_base
+        self.intervalo = intervalo
+        self._threads = []
+        self._en_curso = set()  # ids de trabajos en ejecución en este proceso
+        self._renovador = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._tabla_lista = False
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        db = get_local_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS cola_trabajo (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                brand_id TEXT NOT NULL,
+                clase TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                recibido REAL NOT NULL,
+                disponible_en REAL NOT NULL,
+                bloqueado_hasta REAL,
+                ultimo_error TEXT,
+                creado_en TEXT NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_cola_pendientes ON cola_trabajo(estado, disponible_en)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_cola_marca ON cola_trabajo(brand_id, estado)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS cola_turnos (
+                flujo TEXT PRIMARY KEY,
+                fin REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self._tabla_lista = True
+
+    def submit(self, clase, brand_id, tipo, payload, espera=0):
+        """Encola un trabajo (ver run_work para los tipos)"""
+        if clase not in self.pesos_clase:
+            raise ValueError(f"Clase de trabajo desconocida: {clase}")
+        self._init_table()
+        ahora = time.time()
+        get_local_db().execute(
+            "INSERT INTO cola_trabajo (brand_id, clase, tipo, payload, recibido, disponible_en, creado_en) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(brand_id), clase, tipo, json.dumps(payload, ensure_ascii=False), ahora, ahora + espera,
+             datetime.now().isoformat())
+        )
+        log.debug("COLA", "Trabajo encolado", brand=brand_id, clase=clase, tipo=tipo)
+        self.ensure_worker()
+        self._wake.set()
+        return True
 
-    respuesta_publica = respuestas.get("respuesta_comentario", "")
-    mensaje_inbox = respuestas.get("mensaje_inbox", "")
-    es_inapropiado = respuestas.get("es_inapropiado", False)
+    def ensure_worker(self):
+        """Inicia los hilos de trabajo (SCHEDULER_WORKERS por proceso)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            if self._pid != os.getpid():
+                self._threads = []
+                self._renovador = None
+                self._en_curso = set()
+            self._pid = os.getpid()
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if not (self._renovador and self._renovador.is_alive()):
+                self._renovador = threading.Thread(target=self._renovar, name="comentarios-cola-leases", daemon=True)
+                self._renovador.start()
+            for i in range(len(self._threads), self.workers):
+                hilo = threading.Thread(target=self._run, name=f"comentarios-cola-{i}", daemon=True)
+                hilo.start()
+                self._threads.append(hilo)
+
+    def _run(self):
+        while True:
+            try:
+                if self.run_next():
+                    continue
+            except Exception as e:
+                log.error("COLA", f"Error en el planificador: {e}")
+            self._wake.wait(self.intervalo)
+            self._wake.clear()
+
+    def _renovar(self):
+        """Extiende cada lease/3 segundos el lease de los trabajos en curso en este proceso"""
+        while True:
+            time.sleep(self.lease / 3)
+            ids = list(self._en_curso)
+            if not ids:
+                continue
+            try:
+                get_local_db().execute(
+                    f"UPDATE cola_trabajo SET bloqueado_hasta = ? "
+                    f"WHERE estado = 'procesando' AND id IN ({','.join('?' * len(ids))})",
+                    [time.time() + self.lease] + ids
+                )
+            except Exception as e:
+                log.error("COLA", f"Error renovando leases: {e}")
+
+    def run_next(self):
+        """Reclama y ejecuta el siguiente trabajo; False si no hay nada elegible"""
+        trabajo = self._claim()
+        if not trabajo:
+            return False
+        self._ejecutar(trabajo)
+        return True
 
-    # Ocultar si es inapropiado
-    if es_inapropiado:
-        print(f"[IG_COMMENT] Ocultando comentario inapropiado...")
-        hide_comment(comment_id, token)
+    def _claim(self):
+        self._init_table()
+        db = get_local_db()
+        ahora = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            ocupadas = {r['brand_id'] for r in db.execute(
+                "SELECT brand_id FROM cola_trabajo WHERE estado = 'procesando' AND bloqueado_hasta > ? "
+                "GROUP BY brand_id HAVING COUNT(*) >= ?",
+                (ahora, self.por_marca)
+            )}
+            candidatos = [r for r in db.execute(
+                "SELECT clase, brand_id, MIN(id) AS id FROM cola_trabajo "
+                "WHERE (estado = 'pendiente' AND disponible_en <= ?) OR (estado = 'procesando' AND bloqueado_hasta <= ?) "
+                "GROUP BY clase, brand_id",
+                (ahora, ahora)
+            ) if r['brand_id'] not in ocupadas]
+            if not candidatos:
+                db.execute("COMMIT")
+                return None
+
+            clase = self._turno(db, 'clase', {r['clase'] for r in candidatos}, self.pesos_clase,
+                                orden=self.CLASES.index)
+            por_marca = {r['brand_id']: r['id'] for r in candidatos if r['clase'] == clase}
+            marca = self._turno(db, 'marca', set(por_marca), self.pesos_marca, orden=por_marca.get)
+
+            db.execute(
+                "UPDATE cola_trabajo SET estado = 'procesando', bloqueado_hasta = ? WHERE id = ?",
+                (ahora + self.lease, por_marca[marca])
+            )
+            trabajo = dict(db.execute("SELECT * FROM cola_trabajo WHERE id = ?", (por_marca[marca],)).fetchone())
+            db.execute("COMMIT")
+            return trabajo
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def _turno(self, db, nivel, activos, pesos, orden):
+        """
+        Elige el flujo activo con menor etiqueta de inicio max(fin_flujo, reloj) y
+        avanza su fin en 1/peso. Un flujo que estuvo inactivo arranca en el reloj
+        actual, sin crédito acumulado.
+        """
+        claves = [f"{nivel}:{f}" for f in activos] + [f"reloj:{nivel}"]
+        fines = {r['flujo']: r['fin'] for r in db.execute(
+            f"SELECT flujo, fin FROM cola_turnos WHERE flujo IN ({','.join('?' * len(claves))})", claves
+        )}
+        reloj = fines.get(f"reloj:{nivel}", 0.0)
+        inicio = {f: max(fines.get(f"{nivel}:{f}", 0.0), reloj) for f in activos}
+        elegido = min(activos, key=lambda f: (inicio[f], orden(f)))
+        db.executemany(
+            "INSERT INTO cola_turnos (flujo, fin) VALUES (?, ?) ON CONFLICT (flujo) DO UPDATE SET fin = excluded.fin",
+            [(f"{nivel}:{elegido}", inicio[elegido] + 1.0 / pesos.get(elegido, 1.0)),
+             (f"reloj:{nivel}", inicio[elegido])]
+        )
+        return elegido
 
-    # Enviar respuesta pública
-    respuesta_enviada = False
-    if respuesta_publica:
-        reply_result = reply_to_instagram_comment(comment_id, respuesta_publica, token)
-        if 'id' in reply_result:
-            respuesta_enviada = True
+    def _ejecutar(self, trabajo):
+        metrics.observe("comentarios_scheduler_wait_seconds", time.time() - trabajo['disponible_en'],
+                        clase=trabajo['clase'])
+        db = get_local_db()
+        self._en_curso.add(trabajo['id'])
+        try:
+            with tracer.trace('trabajo', tipo=trabajo['tipo'], clase=trabajo['clase'], brand=trabajo['brand_id']):
+                run_work(trabajo['tipo'], trabajo['brand_id'], json.loads(trabajo['payload']))
+        except Exception as e:
+            self._en_curso.discard(trabajo['id'])
+            intentos = trabajo['intentos'] + 1
+            if intentos >= self.max_intentos:
+                db.execute(
+                    "UPDATE cola_trabajo SET estado = 'fallido', intentos = ?, ultimo_error = ?, "
+                    "bloqueado_hasta = NULL WHERE id = ?",
+                    (intentos, str(e), trabajo['id'])
+                )
+                log.error("COLA", f"Trabajo descartado tras {intentos} intentos: {e}", brand=trabajo['brand_id'],
+                          tipo=trabajo['tipo'], exc_info=True)
+            else:
+                espera = self.backoff_base * 2 ** (intentos - 1) * random.uniform(0.8, 1.2)
+                db.execute(
+                    "UPDATE cola_trabajo SET estado = 'pendiente', clase = 'reintento', intentos = ?, "
+                    "ultimo_error = ?, disponible_en = ?, bloqueado_hasta = NULL WHERE id = ?",
+                    (intentos, str(e), time.time() + espera, trabajo['id'])
+                )
+                log.warning("COLA", f"Trabajo falló ({e}), reintento en {espera:.0f}s", brand=trabajo['brand_id'],
+                            tipo=trabajo['tipo'])
+            metrics.inc("comentarios_scheduler_jobs_total", clase=trabajo['clase'], resultado="error")
+            return False
+        self._en_curso.discard(trabajo['id'])
+        db.execute(
+            "UPDATE cola_trabajo SET estado = 'hecho', bloqueado_hasta = NULL WHERE id = ?", (trabajo['id'],)
+        )
+        metrics.inc("comentarios_scheduler_jobs_total", clase=trabajo['clase'], resultado="ok")
+        self._wake.set()  # un lease liberado puede habilitar otra marca
+        return True
 
-    # Enviar DM
-    dm_enviado = False
-    if mensaje_inbox:
-        dm_result = send_direct_message(sender_id, mensaje_inbox, token)
-        if 'message_id' in dm_result:
-            dm_enviado = True
-
-    # Guardar log en Supabase
-    save_comment_log(
-        instagram_id=instagram_id,
-        nombre_marca=page_name,
-        post_description=post_description,
-        comment_text=text,
-        respuestas=respuestas,
-        platform="Instagram",
-        comment_id=comment_id,
-        sender_id=sender_id,
-        media_id=media_id,
-        respuesta_enviada=respuesta_enviada,
-        dm_enviado=dm_enviado
-    )
+    def pending_count(self):
+        if not self.enabled:
+            return 0
+        self._init_table()
+        return get_local_db().execute(
+            "SELECT COUNT(*) FROM cola_trabajo WHERE estado = 'pendiente'"
+        ).fetchone()[0]
+
+    def backlog(self):
+        """(pendientes, segundos de espera del más antiguo) de los trabajos ya disponibles"""
+        self._init_table()
+        ahora = time.time()
+        fila = get_local_db().execute(
+            "SELECT COUNT(*) AS n, MIN(disponible_en) AS primero FROM cola_trabajo "
+            "WHERE estado = 'pendiente' AND disponible_en <= ?", (ahora,)
+        ).fetchone()
+        return fila['n'], (ahora - fila['primero']) if fila['primero'] else 0.0
+
+    def depth_by_brand(self):
+        """Profundidad de cola por marca y clase: [({'brand': .., 'clase': ..}, n), ...]"""
+        if not self.enabled:
+            return []
+        self._init_table()
+        return [({"brand": r['brand_id'], "clase": r['clase']}, r['n']) for r in get_local_db().execute(
+            "SELECT brand_id, clase, COUNT(*) AS n FROM cola_trabajo WHERE estado = 'pendiente' GROUP BY brand_id, clase"
+        )]
+
+    def get_stats(self):
+        self._init_table()
+        db = get_local_db()
+        ahora = time.time()
+        marcas = defaultdict(lambda: {"pendientes": {}, "en_curso": 0, "espera_max_s": 0.0})
+        for r in db.execute(
+            "SELECT brand_id, clase, COUNT(*) AS n, MIN(disponible_en) AS primero FROM cola_trabajo "
+            "WHERE estado = 'pendiente' GROUP BY brand_id, clase"
+        ):
+            marca = marcas[r['brand_id']]
+            marca["pendientes"][r['clase']] = r['n']
+            marca["espera_max_s"] = max(marca["espera_max_s"], round(max(0.0, ahora - r['primero']), 1))
+        for r in db.execute(
+            "SELECT brand_id, COUNT(*) AS n FROM cola_trabajo WHERE estado = 'procesando' AND bloqueado_hasta > ? "
+            "GROUP BY brand_id",
+            (ahora,)
+        ):
+            marcas[r['brand_id']]["en_curso"] = r['n']
+        return {
+            "hilos_por_proceso": self.workers,
+            "maximo_por_marca": self.por_marca,
+            "pesos_clase": self.pesos_clase,
+            "por_estado": {r['estado']: r['n'] for r in db.execute(
+                "SELECT estado, COUNT(*) AS n FROM cola_trabajo GROUP BY estado"
+            )},
+            "marcas": dict(sorted(marcas.items(), key=lambda m: -sum(m[1]["pendientes"].values())))
+        }
 
-    # Guardar en Sheets (fallback)
-    save_comment_to_sheets(
-        sender_name="Usuario",
-        sender_id=sender_id,
-        message=text,
-        post_id=media_id or "",
-        comment_id=comment_id,
-        platform="Instagram",
-        user_id_owner=instagram_id,
-        reply_message=respuesta_publica,
-        inbox_message=mensaje_inbox
-    )
 
-    print(f"[IG_COMMENT] ✅ Procesado (respuesta={respuesta_enviada}, dm={dm_enviado})")
-    return respuestas
+def run_work(tipo, brand_id, payload, token=None):
+    """Ejecuta un trabajo del planificador (o en línea si está desactivado)"""
+    load_shedder.begin()
+    try:
+        if tipo == 'rafaga':
+            return process_comment_burst(**payload)
 
+        token = token or get_entry_token(brand_id, {})
+        if not token:
+            return None
+        if tipo == 'comentario_instagram':
+            return process_instagram_comment(token=token, **payload)
+        if tipo == 'comentario_facebook':
+            return process_facebook_comment(token=token, **payload)
+        if tipo == 'publicacion':
+            return process_new_post(token=token, **payload)
+        if tipo == 'mensaje':
+            return process_messenger_message(token=token, **payload)
+        if tipo == 'dm_diferido':
+            return send_direct_message(token=token, **payload)
+        if tipo == 'respuesta_comentario':
+            return send_comment_reply(token=token, **payload)
+        if tipo == 'dm_comentario':
+            return send_comment_dm(token=token, **payload)
+        raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+    finally:
+        load_shedder.end()
+
+
+def dispatch_work(clase, brand_id, tipo, payload, token=None):
+    """Encola el trabajo en el planificador; si está desactivado o falla, lo procesa en línea"""
+    if work_scheduler.enabled:
+        try:
+            return work_scheduler.submit(clase, brand_id, tipo, payload)
+        except Exception as e:
+            log.warning("COLA", f"No se pudo encolar ({e}), procesando en línea", brand=brand_id, tipo=tipo)
+    return run_work(tipo, brand_id, payload, token)
 
-def process_facebook_comment(comment_id, post_id, page_id, text, sender_id, sender_name, token):
-    """Procesa un comentario de Facebook"""
-    print(f"\n[FB_COMMENT] ═══════════════════════════════════════")
-    print(f"[FB_COMMENT] Comment: {comment_id}")
-    print(f"[FB_COMMENT] Sender: {sender_name} ({sender_id})")
-    print(f"[FB_COMMENT] Texto: {text[:80]}...")
 
-    # Verificaciones anti-bucle
-    if anti_loop.is_own_account(sender_id):
-        print(f"[FB_COMMENT] ⚠️ Cuenta propia, ignorando")
-        return None
+# Instancia global
+work_scheduler = WorkScheduler()
+metrics.gauge("comentarios_queue_depth", work_scheduler.pending_count, queue="cola_trabajo")
+metrics.gauge_family("comentarios_scheduler_queue_depth", work_scheduler.depth_by_brand)
 
-    if is_unwanted_message(text):
-        print(f"[FB_COMMENT] ⚠️ Mensaje indeseado, ignorando")
-        return None
 
-    # Obtener cuenta
-    account = get_account_by_page_id(page_id)
-    if not account:
-        print(f"[FB_COMMENT] ❌ Cuenta no encontrada")
-        return None
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLASE: Degradación bajo carga
+# ═══════════════════════════════════════════════════════════════════════════════
 
-    page_name = account.get('page_name', 'Marca')
-    instagram_id = account.get('instagram_id') or page_id
+SHED_ENABLED = os.getenv('SHED_ENABLED', 'true').lower() != 'false'
+SHED_DEPTH_LEVELS = os.getenv('SHED_DEPTH_LEVELS', '100,300,1000')  # trabajos pendientes por nivel 1,2,3
+SHED_AGE_LEVELS = os.getenv('SHED_AGE_LEVELS', '60,180,600')  # segundos del trabajo más antiguo por nivel
+SHED_RECOVERY = float(os.getenv('SHED_RECOVERY', '0.5'))  # para bajar de nivel hay que caer bajo umbral * factor
 
-    # Verificar que no es la propia página
-    if sender_name == page_name:
-        print(f"[FB_COMMENT] ⚠️ Comentario de la propia página, ignorando")
-        return None
 
-    # Obtener descripción del post
-    post_description = get_post_description(post_id, token)
+class LoadShedder:
+    """
+    Niveles de degradación según el backlog (trabajos pendientes o antigüedad del
+    más viejo, lo que sea peor). Cada nivel incluye a los anteriores:
+
+    1. sin_dm: los DMs tras un comentario se difieren a la clase 'backfill' del
+       planificador (o se omiten si no está activo).
+    2. sin_llm: los comentarios sin plantilla ni respuesta anticipada reciben
+       fallback_response() en vez de una completion.
+    3. escrituras_diferidas: logs_comentarios y Sheets se guardan en la base local
+       y se replican al volver bajo el nivel 3.
+
+    Para bajar de nivel el backlog debe caer bajo umbral * SHED_RECOVERY (histéresis).
+    Cada cambio de nivel queda en el log, en métricas y en /diagnostico_cola.
+    """
 
-    # Generar respuestas
-    respuestas = generate_responses(instagram_id, post_description, text)
+    NIVELES = ('normal', 'sin_dm', 'sin_llm', 'escrituras_diferidas')
+
+    def __init__(self, enabled=SHED_ENABLED, umbrales_cola=SHED_DEPTH_LEVELS, umbrales_edad=SHED_AGE_LEVELS,
+                 recuperacion=SHED_RECOVERY, intervalo=1.0):
+        self.enabled = enabled
+        self.umbrales_cola = [float(x) for x in umbrales_cola.split(',')][:3]
+        self.umbrales_edad = [float(x) for x in umbrales_edad.split(',')][:3]
+        self.recuperacion = recuperacion
+        self.intervalo = intervalo
+        self.nivel = 0
+        self.cambios = deque(maxlen=20)
+        self._en_curso = 0
+        self._revisado = 0.0
+        self._backlog = (0, 0.0)
+        self._lock = threading.Lock()
+        self._tabla_lista = False
+
+    def _init_table(self):
+        if self._tabla_lista:
+            return
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS escrituras_diferidas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tipo TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                creado_en TEXT NOT NULL
+            )
+        """)
+        self._tabla_lista = True
+
+    def begin(self):
+        with self._lock:
+            self._en_curso += 1
+
+    def end(self):
+        with self._lock:
+            self._en_curso -= 1
+
+    def _nivel_para(self, profundidad, edad, factor=1.0):
+        nivel = 0
+        for i, (umbral_cola, umbral_edad) in enumerate(zip(self.umbrales_cola, self.umbrales_edad), 1):
+            if profundidad >= umbral_cola * factor or edad >= umbral_edad * factor:
+                nivel = i
+        return nivel
+
+    def level(self):
+        """Nivel actual (recalculado como máximo una vez por intervalo y proceso)"""
+        if not self.enabled:
+            return 0
+        ahora = time.time()
+        if ahora - self._revisado < self.intervalo:
+            return self.nivel
+        with self._lock:
+            if ahora - self._revisado < self.intervalo:
+                return self.nivel
+            self._revisado = ahora
+            try:
+                pendientes, edad = work_scheduler.backlog() if work_scheduler.enabled else (0, 0.0)
+            except Exception as e:
+                log.warning("DEGRADACION", f"No se pudo medir el backlog: {e}")
+                return self.nivel
+            profundidad = pendientes + self._en_curso
+            self._backlog = (profundidad, edad)
+
+            nuevo = self._nivel_para(profundidad, edad)
+            if nuevo < self.nivel:
+                nuevo = max(nuevo, min(self.nivel, self._nivel_para(profundidad, edad, self.recuperacion)))
+            anterior = self.nivel
+            if nuevo == anterior:
+                return anterior
+            self.nivel = nuevo
+
+        self.cambios.append({"fecha": datetime.now().isoformat(), "desde": self.NIVELES[anterior],
+                             "hacia": self.NIVELES[nuevo], "pendientes": profundidad, "espera_s": round(edad, 1)})
+        metrics.inc("comentarios_load_shedding_transitions_total", hacia=self.NIVELES[nuevo])
+        registrar = log.warning if nuevo > anterior else log.info
+        registrar("DEGRADACION", f"Nivel {self.NIVELES[anterior]} → {self.NIVELES[nuevo]}",
+                  pendientes=profundidad, espera_s=round(edad, 1))
+        if anterior >= 3 > nuevo:
+            threading.Thread(target=self.replay_deferred, name="comentarios-escrituras-diferidas", daemon=True).start()
+        return nuevo
+
+    def shed_dm(self, brand_id, sender_id, mensaje, token):
+        """True si el DM se difirió u omitió por carga (nivel >= 1)"""
+        if self.level() < 1:
+            return False
+        if work_scheduler.enabled:
+            work_scheduler.submit('backfill', brand_id, 'dm_diferido', {"recipient_id": sender_id, "message": mensaje})
+            metrics.inc("comentarios_load_shedding_actions_total", accion="dm_diferido")
+        else:
+            metrics.inc("comentarios_load_shedding_actions_total", accion="dm_omitido")
+        return True
 
-    respuesta_publica = respuestas.get("respuesta_comentario", "")
-    mensaje_inbox = respuestas.get("mensaje_inbox", "")
-    es_inapropiado = respuestas.get("es_inapropiado", False)
+    def shed_llm(self):
+        """Respuesta de fallback si el nivel no permite llamar al LLM, si no None"""
+        if self.level() < 2:
+            return None
+        metrics.inc("comentarios_load_shedding_actions_total", accion="fallback")
+        return dict(fallback_response(), origen="degradacion")
 
-    # Ocultar si es inapropiado
-    if es_inapropiado:
-        hide_comment(comment_id, token)
+    def defer_write(self, tipo, payload):
+        """Guarda la escritura en la base local si el nivel es 3; True si quedó diferida"""
+        if self.level() < 3:
+            return False
+        self._init_table()
+        get_local_db().execute(
+            "INSERT INTO escrituras_diferidas (tipo, payload, creado_en) VALUES (?, ?, ?)",
+            (tipo, json.dumps(payload, ensure_ascii=False, default=str), datetime.now().isoformat())
+        )
+        metrics.inc("comentarios_load_shedding_actions_total", accion="escritura_diferida")
+        return True
 
-    # Enviar respuesta pública
-    respuesta_enviada = False
-    if respuesta_publica:
-        reply_result = reply_to_facebook_comment(comment_id, respuesta_publica, token)
-        if 'id' in reply_result:
-            respuesta_enviada = True
+    def replay_deferred(self, lote=200, max_lotes=50):
+        """Replica las escrituras diferidas (logs_comentarios, Sheets) mientras el nivel sea < 3"""
+        self._init_table()
+        db = get_local_db()
+        escritores = {"logs_comentarios": save_comment_log, "sheets": save_comment_to_sheets}
+        total = 0
+        for _ in range(max_lotes):
+            if self.level() >= 3:
+                break
+            filas = db.execute("SELECT * FROM escrituras_diferidas ORDER BY id LIMIT ?", (lote,)).fetchall()
+            if not filas:
+                break
+            for fila in filas:
+                # Se borra antes de escribir: con varios workers, cada fila la replica uno solo
+                if db.execute("DELETE FROM escrituras_diferidas WHERE id = ?", (fila['id'],)).rowcount == 0:
+                    continue
+                try:
+                    escritores[fila['tipo']](**json.loads(fila['payload']))
+                    total += 1
+                except Exception as e:
+                    log.error("DEGRADACION", f"No se pudo replicar escritura diferida: {e}", tipo=fila['tipo'])
+        if total:
+            log.info("DEGRADACION", "Escrituras diferidas replicadas", total=total)
+        return total
 
-    # Enviar DM
-    dm_enviado = False
-    if mensaje_inbox:
-        dm_result = send_direct_message(sender_id, mensaje_inbox, token)
-        if 'message_id' in dm_result:
-            dm_enviado = True
-
-    # Guardar log en Supabase
-    save_comment_log(
-        instagram_id=instagram_id,
-        nombre_marca=page_name,
-        post_description=post_description,
-        comment_text=text,
-        respuestas=respuestas,
-        platform="Facebook",
-        comment_id=comment_id,
-        sender_id=sender_id,
-        media_id=post_id,
-        respuesta_enviada=respuesta_enviada,
-        dm_enviado=dm_enviado
-    )
+    def deferred_count(self):
+        self._init_table()
+        return get_local_db().execute("SELECT COUNT(*) FROM escrituras_diferidas").fetchone()[0]
 
-    # Guardar en Sheets (fallback)
-    save_comment_to_sheets(
-        sender_name=sender_name,
-        sender_id=sender_id,
-        message=text,
-        post_id=post_id or "",
-        comment_id=comment_id,
-        platform="Facebook",
-        user_id_owner=instagram_id,
-        reply_message=respuesta_publica,
-        inbox_message=mensaje_inbox
-    )
+    def get_stats(self):
+        return {
+            "habilitado": self.enabled,
+            "nivel": self.NIVELES[self.level()],
+            "backlog": {"pendientes": self._backlog[0], "espera_s": round(self._backlog[1], 1)},
+            "umbrales_pendientes": self.umbrales_cola,
+            "umbrales_espera_s": self.umbrales_edad,
+            "escrituras_diferidas": self.deferred_count(),
+            "cambios_recientes": list(self.cambios)
+        }
 
-    print(f"[FB_COMMENT] ✅ Procesado (respuesta={respuesta_enviada}, dm={dm_enviado})")
-    return respuestas
+# Instancia global
+load_shedder = LoadShedder()
+metrics.gauge("comentarios_load_shedding_level", lambda: load_shedder.nivel)
+metrics.gauge("comentarios_queue_depth", load_shedder.deferred_count, queue="escrituras_diferidas")
 
 
-def process_new_post(post_id, page_id, item_type, value, token):
-    """
-    Procesa una nueva publicación:
-    1. Busca admin de la marca
-    2. Si hay admin con teléfono: guarda como 'pendiente' + crea tarea + envía WhatsApp
-    3. Si no hay admin: guarda como 'activo' (comportamiento anterior)
+# ═══════════════════════════════════════════════════════════════════════════════
+# RUTAS - WEBHOOK
+# ═══════════════════════════════════════════════════════════════════════════════
 
-    item_type puede ser: status, photo, video, share
-    """
-    print(f"\n[NEW_POST] ═══════════════════════════════════════")
-    print(f"[NEW_POST] Post ID: {post_id}")
-    print(f"[NEW_POST] Page ID: {page_id}")
-    print(f"[NEW_POST] Tipo: {item_type}")
+@comentarios_bp.before_request
+def ensure_background_workers():
+    """Reinicia los hilos de fondo en procesos hijos (p. ej. workers de gunicorn tras fork)"""
+    try:
+        maintenance_scheduler.ensure_worker()
+    except Exception as e:
+        log.error("MANTENIMIENTO", f"No se pudo iniciar: {e}")
 
-    # Obtener cuenta
-    account = get_account_by_page_id(page_id)
-    if not account:
-        print(f"[NEW_POST] ❌ Cuenta no encontrada para page_id: {page_id}")
-        return False
 
-    page_name = account.get('page_name', 'Marca')
-    instagram_id = account.get('instagram_id') or page_id
+@comentarios_bp.before_request
+def start_request_profile():
+    """Inicia el profiler si la request lo pide (header) o cae en la muestra aleatoria"""
+    if profiler.should_profile(request):
+        g.comentarios_profile = profiler.start()
 
-    # Obtener detalles del post
-    post_details = get_post_details(post_id, token)
-
-    if not post_details:
-        # Si no podemos obtener detalles, crear datos básicos
-        post_details = {
-            'post_id': post_id,
-            'caption': value.get('message', '') or value.get('story', ''),
-            'media_type': item_type,
-            'permalink': value.get('link', ''),
-            'timestamp': datetime.now().isoformat()
-        }
 
-    # ══════════════════════════════════════════════════════════
-    # NUEVO FLUJO: Aprobación de reglas
-    # ══════════════════════════════════════════════════════════
+@comentarios_bp.teardown_request
+def stop_request_profile(exc=None):
+    captura = g.pop('comentarios_profile', None)
+    if captura is not None:
+        profiler.stop(captura, (request.endpoint or '').split('.')[-1])
 
-    # 1. Buscar admin de la marca
-    admin_info = get_admin_phone_by_marca(instagram_id)
 
-    if not admin_info:
-        # Si no hay admin con teléfono, guardar como activo (comportamiento anterior)
-        print(f"[NEW_POST] ⚠️ No hay admin con teléfono, guardando como ACTIVO")
-        saved = save_post_to_base_cuentas(instagram_id, page_name, post_details, 'activo')
-        if saved:
-            print(f"[NEW_POST] ✅ Publicación guardada (activa)")
-        return saved
+_WEBHOOK_SECRET = APP_SECRET.encode() if (APP_SECRET and WEBHOOK_SIGNATURE_REQUIRED) else None
 
-    # 2. Guardar publicación como PENDIENTE
-    saved = save_post_to_base_cuentas(instagram_id, page_name, post_details, 'pendiente')
 
-    if not saved:
-        print(f"[NEW_POST] ⚠️ Publicación no guardada (ya existía o error)")
+def verify_webhook_signature(body, firma):
+    """Valida X-Hub-Signature-256 (HMAC-SHA256 del body crudo con APP_SECRET) en tiempo constante"""
+    if not firma or not firma.startswith('sha256='):
         return False
+    esperado = hmac.new(_WEBHOOK_SECRET, body, hashlib.sha256).hexdigest()
+    # En bytes: compare_digest lanza TypeError con str no ASCII
+    return hmac.compare_digest(esperado.encode(), firma[7:].encode('utf-8', 'ignore'))
 
-    print(f"[NEW_POST] ✅ Publicación guardada como PENDIENTE")
-
-    # 3. Crear tarea de aprobación
-    tarea = create_approval_task(instagram_id, page_name, post_details, admin_info)
 
-    if not tarea:
-        print(f"[NEW_POST] ⚠️ Error creando tarea, regla queda pendiente sin notificación")
-        return True  # La regla se guardó, aunque sin tarea
+def submit_to_debouncer(platform, entry_id, media_id, sender_id, comment_id, text, sender_name=""):
+    """Deja el comentario en espera de su ráfaga; False si hay que procesarlo en línea"""
+    try:
+        return comment_debouncer.submit(platform, entry_id, media_id, sender_id, comment_id, text, sender_name)
+    except Exception as e:
+        log.warning("RAFAGA", f"No se pudo encolar ({e}), procesando en línea", comment_id=comment_id)
+        return False
 
-    # 4. Enviar WhatsApp al admin
-    whatsapp_sent = send_whatsapp_approval_request(
-        admin_info,
-        post_details,
-        page_name,
-        tarea['id']
-    )
 
-    if whatsapp_sent:
-        print(f"[NEW_POST] ✅ Flujo completo: pendiente + tarea #{tarea['id']} + WhatsApp enviado")
-    else:
-        print(f"[NEW_POST] ⚠️ Regla pendiente + tarea creada (WhatsApp falló)")
+def get_entry_token(entry_id, cuentas):
+    """Busca cuenta y token de un entry del webhook (una vez por entry, cacheado en `cuentas`)"""
+    if entry_id not in cuentas:
+        account = get_account_by_page_id(entry_id) or get_account_by_instagram_id(entry_id)
+        token = account.get('page_access_token') if account else None
+        if not account:
+            log.warning("WEBHOOK", "Cuenta no encontrada", brand=entry_id)
+        elif not token:
+            log.warning("WEBHOOK", "Token no encontrado", brand=entry_id)
+        elif not token_health.is_usable(token):
+            # Token vencido o revocado: no gastar OpenAI en respuestas que Graph va a rechazar
+            log.warning("WEBHOOK", "Token inválido, evento descartado", brand=entry_id)
+            metrics.inc("comentarios_token_health_total", resultado="descartado")
+            token = None
+        cuentas[entry_id] = token
+    return cuentas[entry_id]
+
+
+def handle_change(entry_id, change, cuentas):
+    """Procesa un change del webhook (Instagram comments, Facebook feed)"""
+    field = change.get('field')
+    value = change.get('value', {})
+
+    metrics.inc("comentarios_webhook_events_total", field=field or "desconocido")
+
+    # Eco de una respuesta del propio bot: se descarta antes de cualquier consulta
+    comment_id = value.get('id') if field == 'comments' else value.get('comment_id')
+    if comment_id:
+        es_respuesta_bot = anti_loop.is_bot_reply(comment_id)
+        metrics.cache('bot_reply', es_respuesta_bot)
+        if es_respuesta_bot:
+            log.debug("WEBHOOK", "Respuesta propia ignorada", brand=entry_id, comment_id=comment_id)
+            return
 
-    return True
+    token = get_entry_token(entry_id, cuentas)
+    if not token:
+        return
 
+    # ─────────────────────────────────────────────────────────────
+    # INSTAGRAM COMMENTS
+    # ─────────────────────────────────────────────────────────────
+    if field == 'comments':
+        comment_id = value.get('id')
+        text = value.get('text', '')
+        sender_id = value.get('from', {}).get('id')
+        media_id = value.get('media', {}).get('id') if isinstance(value.get('media'), dict) else value.get('media_id')
+
+        if not all([comment_id, text, sender_id]):
+            log.warning("WEBHOOK", "Datos incompletos para comentario IG")
+            return
 
-def process_messenger_message(sender_id, page_id, message_text, token):
-    """Procesa un mensaje de Messenger"""
-    print(f"\n[MESSENGER] De: {sender_id} | Texto: {message_text[:50]}...")
+        # Verificar duplicado (compartido entre workers)
+        es_duplicado = not anti_loop.claim_comment(comment_id)
+        metrics.cache('dedupe_local', es_duplicado)
+        if es_duplicado:
+            return
 
-    if anti_loop.is_own_account(sender_id):
-        return None
+        # Adquirir lock
+        if not acquire_comment_lock(comment_id, entry_id, "instagram"):
+            return
 
-    if is_unwanted_message(message_text):
-        return None
+        surge_detector.record(media_id, entry_id)
 
-    account = get_account_by_page_id(page_id)
-    if not account:
-        print(f"[MESSENGER] ❌ Cuenta no encontrada")
-        return None
+        if comment_debouncer.enabled and submit_to_debouncer("instagram", entry_id, media_id, sender_id, comment_id, text):
+            return
+        dispatch_work('comentario', entry_id, 'comentario_instagram', {
+            "comment_id": comment_id, "media_id": media_id, "instagram_id": entry_id,
+            "text": text, "sender_id": sender_id
+        }, token)
+
+    # ─────────────────────────────────────────────────────────────
+    # FACEBOOK FEED (comments + posts)
+    # ─────────────────────────────────────────────────────────────
+    elif field == 'feed':
+        item_type = value.get('item')
+        verb = value.get('verb', 'add')
+
+        log.info("WEBHOOK", "Feed item", brand=entry_id, item=item_type, verb=verb)
+
+        # Comentarios de Facebook
+        if item_type == 'comment' and verb == 'add':
+            comment_id = value.get('comment_id')
+            post_id = value.get('post_id')
+            message = value.get('message', '')
+            sender_info = value.get('from', {})
+            sender_id = sender_info.get('id')
+            sender_name = sender_info.get('name', '')
+
+            if not all([comment_id, message, sender_id]):
+                log.warning("WEBHOOK", "Datos incompletos para comentario FB")
+                return
+
+            # Verificar duplicado (compartido entre workers)
+            es_duplicado = not anti_loop.claim_comment(comment_id)
+            metrics.cache('dedupe_local', es_duplicado)
+            if es_duplicado:
+                return
+
+            # Adquirir lock
+            if not acquire_comment_lock(comment_id, entry_id, "facebook"):
+                return
+
+            surge_detector.record(post_id, entry_id)
+
+            if comment_debouncer.enabled and submit_to_debouncer(
+                    "facebook", entry_id, post_id, sender_id, comment_id, message, sender_name):
+                return
+            dispatch_work('comentario', entry_id, 'comentario_facebook', {
+                "comment_id": comment_id, "post_id": post_id, "page_id": entry_id, "text": message,
+                "sender_id": sender_id, "sender_name": sender_name
+            }, token)
+
+        # Nuevas publicaciones
+        elif item_type in ['status', 'photo', 'video', 'share'] and verb == 'add':
+            post_id = value.get('post_id')
+
+            if post_id:
+                dispatch_work('publicacion', entry_id, 'publicacion', {
+                    "post_id": post_id, "page_id": entry_id, "item_type": item_type, "value": value
+                }, token)
+
+        # Otros eventos de feed
+        elif item_type == 'reaction':
+            log.info("WEBHOOK", "Reacción recibida (ignorando)")
+        else:
+            log.info("WEBHOOK", f"Feed item no manejado: {item_type}")
 
-    instagram_id = account.get('instagram_id') or page_id
 
-    respuesta = generate_dm_response(instagram_id, message_text, sender_id)
-    if respuesta:
-        send_direct_message(sender_id, respuesta, token)
+def handle_messaging(entry_id, messaging, cuentas):
+    """Procesa un evento de messaging del webhook (Messenger DMs)"""
+    metrics.inc("comentarios_webhook_events_total", field="messaging")
+    if 'message' not in messaging:
+        return
 
-    return respuesta
+    sender_id = messaging.get('sender', {}).get('id')
+    message_text = messaging.get('message', {}).get('text', '')
+    page_id = messaging.get('recipient', {}).get('id')
 
+    if sender_id and message_text:
+        token = get_entry_token(entry_id, cuentas)
+        if token:
+            dispatch_work('dm', entry_id, 'mensaje', {
+                "sender_id": sender_id, "page_id": page_id, "message_text": message_text
+            }, token)
 
-# ═══════════════════════════════════════════════════════════════════════════════
-# RUTAS - WEBHOOK
-# ═══════════════════════════════════════════════════════════════════════════════
 
 @comentarios_bp.route('/webhook', methods=['GET', 'POST'])
+@metrics.timed('webhook')
 def webhook():
     """Endpoint principal de webhook para Meta"""
 
@@ -1666,140 +6089,52 @@ def webhook():
         mode = request.args.get('hub.mode')
 
         if mode == 'subscribe' and verify_token == VERIFY_TOKEN:
-            print("[WEBHOOK] ✅ Verificación exitosa")
+            log.info("WEBHOOK", "Verificación exitosa")
             return challenge, 200
         else:
-            print(f"[WEBHOOK] ❌ Verificación fallida. Token recibido: {verify_token}")
+            log.warning("WEBHOOK", "Verificación fallida", mode=mode)
             return 'Forbidden', 403
 
     elif request.method == 'POST':
-        data = request.get_json()
+        body = request.get_data()
+
+        # Firma antes de parsear: payloads sin firmar o falsificados no llegan al pipeline
+        if _WEBHOOK_SECRET:
+            firma = request.headers.get('X-Hub-Signature-256')
+            if not verify_webhook_signature(body, firma):
+                motivo = "ausente" if not firma else "invalida"
+                metrics.inc("comentarios_webhook_signature_failures_total", motivo=motivo)
+                log.warning("WEBHOOK", "Firma rechazada", motivo=motivo, bytes=len(body))
+                return 'Forbidden', 403
+
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            log.warning("WEBHOOK", "Body no es JSON válido", bytes=len(body))
+            return 'Bad Request', 400
 
         if not data:
             return 'OK', 200
 
-        print(f"\n{'='*70}")
-        print(f"[WEBHOOK] EVENTO RECIBIDO")
-        print(f"{'='*70}")
-        print(f"[WEBHOOK] Object: {data.get('object')}")
+        log.info("WEBHOOK", "Evento recibido", object=data.get('object'), entries=len(data.get('entry', [])))
 
         try:
             for entry in data.get('entry', []):
                 entry_id = entry.get('id')
-                print(f"[WEBHOOK] Entry ID: {entry_id}")
-
-                # Buscar cuenta y token
-                account = get_account_by_page_id(entry_id) or get_account_by_instagram_id(entry_id)
-                if not account:
-                    print(f"[WEBHOOK] ⚠️ Cuenta no encontrada para: {entry_id}")
-                    continue
+                cuentas = {}
 
-                token = account.get('page_access_token')
-                if not token:
-                    print(f"[WEBHOOK] ⚠️ Token no encontrado")
-                    continue
-
-                # ═══════════════════════════════════════════════════════════════
-                # PROCESAR CHANGES (Instagram comments, Facebook feed)
-                # ═══════════════════════════════════════════════════════════════
+                # Cada change / mensaje es una traza independiente
                 for change in entry.get('changes', []):
-                    field = change.get('field')
-                    value = change.get('value', {})
-
-                    print(f"[WEBHOOK] Field: {field}")
-
-                    # ─────────────────────────────────────────────────────────────
-                    # INSTAGRAM COMMENTS
-                    # ─────────────────────────────────────────────────────────────
-                    if field == 'comments':
-                        comment_id = value.get('id')
-                        text = value.get('text', '')
-                        sender_id = value.get('from', {}).get('id')
-                        media_id = value.get('media', {}).get('id') if isinstance(value.get('media'), dict) else value.get('media_id')
-
-                        if not all([comment_id, text, sender_id]):
-                            print(f"[WEBHOOK] ⚠️ Datos incompletos para comentario IG")
-                            continue
-
-                        # Adquirir lock
-                        if not acquire_comment_lock(comment_id, entry_id, "instagram"):
-                            continue
-
-                        # Verificar duplicado local
-                        if anti_loop.is_comment_duplicate(comment_id):
-                            continue
-                        anti_loop.mark_comment_processed(comment_id)
-
-                        process_instagram_comment(comment_id, media_id, entry_id, text, sender_id, token)
-
-                    # ─────────────────────────────────────────────────────────────
-                    # FACEBOOK FEED (comments + posts)
-                    # ─────────────────────────────────────────────────────────────
-                    elif field == 'feed':
-                        item_type = value.get('item')
-                        verb = value.get('verb', 'add')
-
-                        print(f"[WEBHOOK] Feed item: {item_type}, verb: {verb}")
-
-                        # ─────────────────────────────────────────────────────────
-                        # COMENTARIOS DE FACEBOOK
-                        # ─────────────────────────────────────────────────────────
-                        if item_type == 'comment' and verb == 'add':
-                            comment_id = value.get('comment_id')
-                            post_id = value.get('post_id')
-                            message = value.get('message', '')
-                            sender_info = value.get('from', {})
-                            sender_id = sender_info.get('id')
-                            sender_name = sender_info.get('name', '')
-
-                            if not all([comment_id, message, sender_id]):
-                                print(f"[WEBHOOK] ⚠️ Datos incompletos para comentario FB")
-                                continue
-
-                            # Adquirir lock
-                            if not acquire_comment_lock(comment_id, entry_id, "facebook"):
-                                continue
-
-                            # Verificar duplicado local
-                            if anti_loop.is_comment_duplicate(comment_id):
-                                continue
-                            anti_loop.mark_comment_processed(comment_id)
-
-                            process_facebook_comment(comment_id, post_id, entry_id, message, sender_id, sender_name, token)
-
-                        # ─────────────────────────────────────────────────────────
-                        # NUEVAS PUBLICACIONES
-                        # ─────────────────────────────────────────────────────────
-                        elif item_type in ['status', 'photo', 'video', 'share'] and verb == 'add':
-                            post_id = value.get('post_id')
-
-                            if post_id:
-                                process_new_post(post_id, entry_id, item_type, value, token)
-
-                        # ─────────────────────────────────────────────────────────
-                        # OTROS EVENTOS DE FEED
-                        # ─────────────────────────────────────────────────────────
-                        elif item_type == 'reaction':
-                            print(f"[WEBHOOK] Reacción recibida (ignorando)")
-                        else:
-                            print(f"[WEBHOOK] Feed item no manejado: {item_type}")
-
-                # ═══════════════════════════════════════════════════════════════
-                # PROCESAR MESSAGING (Messenger DMs)
-                # ═══════════════════════════════════════════════════════════════
-                for messaging in entry.get('messaging', []):
-                    if 'message' in messaging:
-                        sender_id = messaging.get('sender', {}).get('id')
-                        message_text = messaging.get('message', {}).get('text', '')
-                        page_id = messaging.get('recipient', {}).get('id')
+                    with tracer.trace('change', field=change.get('field'), brand=entry_id):
+                        handle_change(entry_id, change, cuentas)
 
-                        if sender_id and message_text:
-                            process_messenger_message(sender_id, page_id, message_text, token)
+                for messaging in entry.get('messaging', []):
+                    with tracer.trace('messaging', brand=entry_id):
+                        handle_messaging(entry_id, messaging, cuentas)
 
         except Exception as e:
-            print(f"[WEBHOOK] ❌ Error procesando: {e}")
-            import traceback
-            traceback.print_exc()
+            log.error("WEBHOOK", f"Error procesando: {e}", exc_info=True)
+            metrics.error('webhook')
 
         return 'OK', 200
 
@@ -1876,11 +6211,19 @@ def dashboard():
     if not accounts:
         accounts = get_user_accounts_sheets(user_id)
 
+    # Avance de la última conexión de páginas (OAuth en segundo plano)
+    conexion = None
+    if session.get('conexion_paginas'):
+        conexion = page_onboarding.get(session['conexion_paginas'])
+        if conexion and conexion['user_id'] != str(user_id):
+            conexion = None
+
     return render_template(
         'dashboard.html',
         username=session.get('username'),
         nombre_marca=session.get('nombre_marca', ''),
-        accounts=accounts
+        accounts=accounts,
+        conexion=conexion
     )
 
 
@@ -1922,6 +6265,7 @@ def comentarios_prompts():
                         "creado_en": datetime.now().isoformat()
                     }).execute()
 
+                    brand_context_cache.invalidate(instagram_id)
                     success_message = "¡Prompt actualizado con éxito!"
 
     # Obtener prompts
@@ -1984,7 +6328,7 @@ def registro_comentarios():
                             'date': fecha
                         })
                 except Exception as e:
-                    print(f"[REGISTRO] Error obteniendo comentarios: {e}")
+                    log.error("REGISTRO", f"Error obteniendo comentarios: {e}")
 
     # Preparar datos para gráfico
     comment_dates = [c['date'].strftime('%Y-%m-%d') for c in comments if isinstance(c.get('date'), datetime)]
@@ -2033,7 +6377,7 @@ def reportes():
                             'date': fecha
                         })
                 except Exception as e:
-                    print(f"[REPORTES] Error: {e}")
+                    log.error("REPORTES", f"Error: {e}")
 
     # Comentarios por publicación
     comentarios_por_publicacion = defaultdict(int)
@@ -2074,6 +6418,152 @@ def reportes():
     )
 
 
+@comentarios_bp.route('/exportar_comentarios')
+def exportar_comentarios():
+    """
+    Exporta logs_comentarios en streaming.
+    Parámetros: formato=csv|ndjson, desde/hasta=YYYY-MM-DD (hasta inclusive), marca=instagram_id
+    """
+    if not session.get('logged_in'):
+        return redirect(url_for('comentarios.login'))
+    if not supabase:
+        return jsonify({"error": "Supabase no disponible"}), 503
+
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({"error": "formato debe ser csv o ndjson"}), 400
+
+    try:
+        desde = request.args.get('desde')
+        desde = datetime.strptime(desde, '%Y-%m-%d').isoformat() if desde else None
+        hasta = request.args.get('hasta')
+        hasta = (datetime.strptime(hasta, '%Y-%m-%d') + timedelta(days=1)).isoformat() if hasta else None
+    except ValueError:
+        return jsonify({"error": "Fechas en formato YYYY-MM-DD"}), 400
+
+    accounts = get_user_accounts_supabase(session.get('user_id'), session.get('id_marca'))
+    marcas = {str(a['instagram_id']) for a in accounts if a.get('instagram_id')}
+    marca = request.args.get('marca')
+    if marca:
+        if marca not in marcas:
+            return jsonify({"error": "Marca no autorizada"}), 403
+        marcas = {marca}
+    if not marcas:
+        return jsonify({"error": "Sin cuentas conectadas"}), 404
+
+    total = 0
+
+    def contar(filas):
+        nonlocal total
+        for fila in filas:
+            total += 1
+            yield fila
+
+    def generar():
+        inicio = time.perf_counter()
+        try:
+            yield from stream_comment_logs(contar(iter_comment_logs(sorted(marcas), desde, hasta)), formato)
+        except Exception as e:
+            # Con la respuesta ya iniciada no se puede cambiar el status: se corta y se registra
+            log.error("EXPORTAR", f"Exportación interrumpida: {e}", filas=total, exc_info=True)
+            metrics.error('export')
+        finally:
+            metrics.inc("comentarios_export_rows_total", value=total, formato=formato)
+            log.info("EXPORTAR", "Exportación terminada", formato=formato, marcas=len(marcas), filas=total,
+                     ms=round((time.perf_counter() - inicio) * 1000))
+
+    nombre = f"comentarios_{marca or 'marcas'}_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    mimetype = 'text/csv; charset=utf-8' if formato == 'csv' else 'application/x-ndjson'
+    return Response(generar(), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={nombre}",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@comentarios_bp.route('/buscar_comentarios')
+def buscar_comentarios():
+    """
+    Búsqueda rankeada en comentarios y respuestas (JSON).
+    Parámetros: q (sintaxis web: "frase exacta", -excluir, or), marca, plataforma,
+    inapropiado=true|false, pagina, por_pagina (máx. 100)
+    """
+    if not session.get('logged_in'):
+        return redirect(url_for('comentarios.login'))
+    if not supabase:
+        return jsonify({"error": "Supabase no disponible"}), 503
+
+    consulta = (request.args.get('q') or '').strip()
+    if not consulta:
+        return jsonify({"error": "Falta el parámetro q"}), 400
+    try:
+        pagina = max(1, int(request.args.get('pagina', 1)))
+        por_pagina = min(100, max(1, int(request.args.get('por_pagina', 20))))
+    except ValueError:
+        return jsonify({"error": "pagina y por_pagina deben ser números"}), 400
+    if pagina * por_pagina > 10000:
+        return jsonify({"error": "Refina la búsqueda: máximo 10.000 resultados"}), 400
+    inapropiado = request.args.get('inapropiado')
+    inapropiado = None if inapropiado is None else inapropiado.lower() in ('true', '1', 'si')
+
+    accounts = get_user_accounts_supabase(session.get('user_id'), session.get('id_marca'))
+    marcas = {str(a['instagram_id']) for a in accounts if a.get('instagram_id')}
+    marca = request.args.get('marca')
+    if marca:
+        if marca not in marcas:
+            return jsonify({"error": "Marca no autorizada"}), 403
+        marcas = {marca}
+    if not marcas:
+        return jsonify({"error": "Sin cuentas conectadas"}), 404
+
+    try:
+        filas, hay_mas = search_comment_logs(consulta, sorted(marcas), request.args.get('plataforma'),
+                                             inapropiado, pagina, por_pagina)
+    except Exception as e:
+        log.error("BUSQUEDA", f"Error buscando comentarios: {e}", consulta=consulta[:80])
+        return jsonify({"error": "Búsqueda no disponible (¿migración sql/logs_comentarios_busqueda.sql aplicada?)"}), 503
+
+    return jsonify({
+        "consulta": consulta,
+        "pagina": pagina,
+        "por_pagina": por_pagina,
+        "hay_mas": hay_mas,
+        "resultados": filas
+    })
+
+
+@comentarios_bp.route('/analitica')
+def analitica():
+    """
+    Métricas de interacción por marca (JSON, cacheado).
+    Parámetros: dias (período actual, se compara con el anterior), marca=instagram_id
+    """
+    if not session.get('logged_in'):
+        return redirect(url_for('comentarios.login'))
+    try:
+        dias = min(365, max(1, int(request.args.get('dias', ANALYTICS_DAYS))))
+    except ValueError:
+        return jsonify({"error": "dias debe ser un número"}), 400
+
+    accounts = (get_user_accounts_supabase(session.get('user_id'), session.get('id_marca'))
+                or get_user_accounts_sheets(session.get('user_id')))
+    marcas = {str(a['instagram_id']) for a in accounts if a.get('instagram_id')}
+    marca = request.args.get('marca')
+    if marca:
+        if marca not in marcas:
+            return jsonify({"error": "Marca no autorizada"}), 403
+        marcas = {marca}
+    if not marcas:
+        return jsonify({"error": "Sin cuentas conectadas"}), 404
+
+    try:
+        return jsonify(engagement_analytics.report(marcas, dias))
+    except ImportError as e:
+        return jsonify({"error": f"La analítica requiere numpy y pandas: {e}"}), 503
+    except Exception as e:
+        log.error("ANALITICA", f"Error calculando métricas: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # RUTAS - CONEXIÓN FACEBOOK/INSTAGRAM
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -2151,74 +6641,31 @@ def facebook_callback():
         # Token de larga duración
         long_token = get_long_lived_token(short_token) or short_token
 
-        # Obtener páginas
-        pages_url = f"{GRAPH_API_URL}/me/accounts"
-        pages_params = {'fields': 'id,name,access_token,instagram_business_account', 'access_token': long_token}
-        pages_response = requests.get(pages_url, params=pages_params)
-        pages_data = pages_response.json()
-
-        if 'error' in pages_data:
-            return render_template('error.html', error=f"Error obteniendo páginas: {pages_data}")
-
-        user_id = session.get('user_id')
-        connected_count = 0
-
-        for page in pages_data.get('data', []):
-            page_id = page.get('id')
-            page_name = page.get('name')
-            page_token = page.get('access_token')
-
-            # Token de larga duración para la página
-            page_long_token = get_long_lived_token(page_token) or page_token
-
-            print(f"\n[OAUTH] Procesando: {page_name} ({page_id})")
+        # Páginas, suscripciones y guardado en segundo plano (agencias con cientos de páginas)
+        conexion_id = page_onboarding.start(session.get('user_id'), long_token)
+        session['conexion_paginas'] = conexion_id
 
-            # Suscribir a webhooks
-            subscribe_page_to_webhooks(page_id, page_long_token)
-
-            # Obtener cuenta de Instagram
-            instagram_account = page.get('instagram_business_account')
-            instagram_id = None
-            instagram_name = ""
-
-            if isinstance(instagram_account, dict):
-                instagram_id = instagram_account.get('id')
-            elif isinstance(instagram_account, str):
-                instagram_id = instagram_account
-
-            if instagram_id:
-                # Obtener nombre de Instagram
-                ig_info_url = f"{GRAPH_API_URL}/{instagram_id}"
-                ig_info_params = {'fields': 'username', 'access_token': page_long_token}
-                ig_info_response = requests.get(ig_info_url, params=ig_info_params)
-                ig_info_data = ig_info_response.json()
-                instagram_name = ig_info_data.get('username', '')
-
-                print(f"[OAUTH] Instagram: {instagram_name} ({instagram_id})")
-
-            # Guardar en Supabase
-            save_account_to_supabase(user_id, page_id, page_name, instagram_id, page_long_token, instagram_name)
-
-            # Guardar en Sheets (fallback)
-            save_to_sheets_user_accounts(user_id, page_id, page_name, instagram_id or '', page_long_token)
-
-            # Añadir a anti-loop
-            if instagram_id:
-                anti_loop.add_own_account(instagram_id)
-            anti_loop.add_own_account(page_id)
-
-            connected_count += 1
-
-        flash(f'Se conectaron {connected_count} cuenta(s) exitosamente.', 'success')
+        flash('Estamos conectando tus páginas. Puedes seguir el avance en el dashboard o en '
+              f"{url_for('comentarios.conexion_progreso', id=conexion_id)}.", 'success')
         return redirect(url_for('comentarios.dashboard'))
 
     except Exception as e:
-        print(f"[OAUTH] Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("OAUTH", f"Error: {e}", exc_info=True)
         return render_template('error.html', error=str(e))
 
 
+@comentarios_bp.route('/conexion_progreso')
+def conexion_progreso():
+    """Avance de la última conexión de páginas del usuario (JSON)"""
+    if not session.get('logged_in'):
+        return redirect(url_for('comentarios.login'))
+    conexion_id = request.args.get('id') or session.get('conexion_paginas')
+    conexion = page_onboarding.get(conexion_id) if conexion_id else None
+    if not conexion or conexion['user_id'] != str(session.get('user_id')):
+        return jsonify({"error": "Sin conexiones recientes"}), 404
+    return jsonify(conexion)
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # RUTAS - DIAGNÓSTICO
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -2253,11 +6700,95 @@ def diagnostico_antibucle():
     return jsonify({
         "cuentas_propias": list(anti_loop.own_account_ids),
         "total_cuentas": len(anti_loop.own_account_ids),
-        "comentarios_procesados": len(anti_loop.processed_comments),
-        "respuestas_bot": len(anti_loop.bot_sent_replies)
+        **anti_loop.get_stats(),
+        "rafagas": comment_debouncer.get_stats()
+    })
+
+
+@comentarios_bp.route('/diagnostico_publicaciones')
+def diagnostico_publicaciones():
+    """Diagnóstico del workflow de aprobación de publicaciones"""
+    try:
+        stats = post_workflow.get_stats()
+        stats["whatsapp_outbox"] = whatsapp_outbox.get_stats()
+        return jsonify(stats)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@comentarios_bp.route('/metrics')
+def metrics_endpoint():
+    """Métricas del proceso en formato Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@comentarios_bp.route('/diagnostico_mantenimiento')
+def diagnostico_mantenimiento():
+    """Diagnóstico de los jobs de mantenimiento"""
+    try:
+        return jsonify(maintenance_scheduler.get_stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@comentarios_bp.route('/diagnostico_perfiles')
+def diagnostico_perfiles():
+    """Capturas recientes del profiler"""
+    return jsonify({
+        "header_habilitado": bool(PROFILE_TOKEN),
+        "sample_rate_webhook": PROFILE_SAMPLE_RATE,
+        "formato": profiler.formato,
+        "capturas": profiler.list_captures()
     })
 
 
+@comentarios_bp.route('/diagnostico_perfiles/<archivo>')
+def descargar_perfil(archivo):
+    """Descarga una captura (requiere el header del profiler o sesión iniciada)"""
+    if not (profiler.is_authorized(request) or session.get('logged_in')):
+        return 'Forbidden', 403
+    ruta = profiler.path_for(archivo)
+    if not ruta:
+        return 'Not found', 404
+    with open(ruta, 'rb') as f:
+        contenido = f.read()
+    mimetype = 'application/json' if archivo.endswith('.json') else 'application/octet-stream'
+    return Response(contenido, mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename={archivo}"})
+
+
+@comentarios_bp.route('/diagnostico_cola')
+def diagnostico_cola():
+    """Profundidad de cola, trabajos en curso y espera máxima por marca, y nivel de degradación"""
+    try:
+        return jsonify({**work_scheduler.get_stats(), "degradacion": load_shedder.get_stats()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@comentarios_bp.route('/diagnostico_oleadas')
+def diagnostico_oleadas():
+    """Publicaciones en modo oleada y las más comentadas en la ventana"""
+    try:
+        return jsonify(surge_detector.get_stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@comentarios_bp.route('/diagnostico_tokens')
+def diagnostico_tokens():
+    """Estado de los tokens de página (sin exponer los tokens)"""
+    try:
+        return jsonify(token_health.get_stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@comentarios_bp.route('/diagnostico_plantillas')
+def diagnostico_plantillas():
+    """Tasa de respuestas por plantilla (sin LLM) por marca"""
+    return jsonify(intent_templates.get_stats())
+
+
 @comentarios_bp.route('/test_webhook', methods=['POST'])
 def test_webhook():
     """Endpoint para probar webhooks manualmente"""
@@ -2296,6 +6827,7 @@ def init_comentarios():
     print(f"[CONFIG] VERIFY_TOKEN: {'✅' if VERIFY_TOKEN else '❌'}")
     print(f"[CONFIG] APP_ID: {'✅' if APP_ID else '❌'}")
     print(f"[CONFIG] APP_SECRET: {'✅' if APP_SECRET else '❌'}")
+    print(f"[CONFIG] FIRMA WEBHOOK: {'✅' if _WEBHOOK_SECRET else '❌ (sin verificar)'}")
     print(f"[CONFIG] OPENAI: {'✅' if OPENAI_API_KEY else '❌'}")
     print(f"[CONFIG] SUPABASE: {'✅' if supabase else '❌'}")
     print(f"[CONFIG] SHEETS: {'✅' if sheet else '❌'}")
@@ -2306,6 +6838,16 @@ def init_comentarios():
     # Limpiar locks viejos
     cleanup_old_locks()
 
+    # Reanudar workflows de publicaciones y mensajes WhatsApp pendientes
+    try:
+        post_workflow.ensure_worker()
+        whatsapp_outbox.ensure_worker()
+        comment_debouncer.ensure_worker()
+        work_scheduler.ensure_worker()
+        maintenance_scheduler.ensure_worker()
+    except Exception as e:
+        print(f"[WORKFLOW] ❌ No se pudo iniciar: {e}")
+
     print("="*70)
     print("✅ BP_COMENTARIOS inicializado")
     print(f"   Webhook: /comentarios/webhook")
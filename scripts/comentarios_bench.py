@@ -0,0 +1,556 @@
+"""
+Benchmark en proceso del webhook de BP_COMENTARIOS
+==================================================
+
+Envía payloads de Meta (sintéticos o grabados) a webhook() mediante el test
+client de Flask, con fakes en memoria para supabase, Graph/WhatsApp (requests),
+openai_client y sheet, cada uno con latencia configurable.
+
+Reporta por escenario: eventos/segundo, latencia p50/p95/p99 del webhook y de
+cada etapa (a partir de los spans del tracer) y asignaciones de memoria por evento.
+
+Uso:
+    python scripts/comentarios_bench.py                       # todos los escenarios
+    python scripts/comentarios_bench.py --scenario viral_post --openai-ms 300
+    python scripts/comentarios_bench.py --replay payloads.jsonl   # un body de webhook por línea
+    python scripts/comentarios_bench.py --json resultados.json
+"""
+
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FAKES
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class Latency:
+    """Latencia simulada en milisegundos (media ± jitter)"""
+
+    def __init__(self, ms=0.0, jitter=0.2):
+        self.ms = ms
+        self.jitter = jitter
+
+    def sleep(self):
+        if self.ms > 0:
+            time.sleep(self.ms / 1000 * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class FakeResponse:
+    def __init__(self, data=None, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+
+def orden(valor):
+    """Clave de comparación: números como números (ids), el resto como texto"""
+    return (0, valor, '') if isinstance(valor, (int, float)) else (1, 0, str(valor or ''))
+
+
+class FakeQuery:
+    """Subconjunto del query builder de supabase-py usado por basedepy"""
+
+    def __init__(self, db, tabla):
+        self.db = db
+        self.tabla = tabla
+        self.filtros = []
+        self.op = 'select'
+        self.payload = None
+        self._limit = None
+        self._order = []
+        self._conflicto = None
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def insert(self, data):
+        self.op, self.payload = 'insert', data
+        return self
+
+    def update(self, data):
+        self.op, self.payload = 'update', data
+        return self
+
+    def upsert(self, data, on_conflict=None, **kwargs):
+        self.op, self.payload, self._conflicto = 'upsert', data, on_conflict
+        return self
+
+    def delete(self):
+        self.op = 'delete'
+        return self
+
+    def eq(self, col, val):
+        self.filtros.append(lambda r: str(r.get(col)) == str(val))
+        return self
+
+    def neq(self, col, val):
+        self.filtros.append(lambda r: str(r.get(col)) != str(val))
+        return self
+
+    def in_(self, col, vals):
+        vals = {str(v) for v in vals}
+        self.filtros.append(lambda r: str(r.get(col)) in vals)
+        return self
+
+    def lt(self, col, val):
+        self.filtros.append(lambda r: r.get(col) is not None and orden(r.get(col)) < orden(val))
+        return self
+
+    def gte(self, col, val):
+        self.filtros.append(lambda r: r.get(col) is not None and orden(r.get(col)) >= orden(val))
+        return self
+
+    def gt(self, col, val):
+        self.filtros.append(lambda r: r.get(col) is not None and orden(r.get(col)) > orden(val))
+        return self
+
+    def lte(self, col, val):
+        self.filtros.append(lambda r: r.get(col) is not None and orden(r.get(col)) <= orden(val))
+        return self
+
+    def or_(self, expr):
+        condiciones = [c.split('.', 2) for c in expr.split(',')]
+        self.filtros.append(lambda r: any(str(r.get(col)) == val for col, _, val in condiciones))
+        return self
+
+    def order(self, col, desc=False):
+        self._order.append((col, desc))
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def range(self, inicio, fin):
+        self._limit = fin + 1
+        return self
+
+    def execute(self):
+        self.db.latency.sleep()
+        with self.db.lock:
+            filas = self.db.tablas[self.tabla]
+            if self.op in ('insert', 'upsert'):
+                # Como PostgREST: se retornan las filas guardadas, con su id
+                guardadas = []
+                for nueva in self.payload if isinstance(self.payload, list) else [self.payload]:
+                    existente = next((f for f in filas if self._conflicto and
+                                      str(f.get(self._conflicto)) == str(nueva.get(self._conflicto))), None)
+                    if existente is not None:
+                        existente.update(nueva)
+                    else:
+                        existente = dict(nueva, id=next(self.db.ids))
+                        filas.append(existente)
+                    guardadas.append(dict(existente))
+                return FakeResponse(guardadas)
+
+            seleccion = [f for f in filas if all(filtro(f) for filtro in self.filtros)]
+            if self.op == 'update':
+                for fila in seleccion:
+                    fila.update(self.payload)
+            elif self.op == 'delete':
+                self.db.tablas[self.tabla] = [f for f in filas if f not in seleccion]
+            for col, desc in reversed(self._order):
+                seleccion.sort(key=lambda f: orden(f.get(col)), reverse=desc)
+            if self._limit is not None:
+                seleccion = seleccion[:self._limit]
+            return FakeResponse([dict(f) for f in seleccion])
+
+
+class FakeSupabase:
+    def __init__(self, latency):
+        self.latency = latency
+        self.tablas = defaultdict(list)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def table(self, nombre):
+        return FakeQuery(self, nombre)
+
+
+class FakeRequests:
+    """Reemplaza el módulo requests para Graph API y WhatsApp"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.contador = itertools.count(1)
+        self.llamadas = defaultdict(int)
+
+    def _responder(self, metodo, url, params=None, json_body=None):
+        self.latency.sleep()
+        n = next(self.contador)
+        ruta = url.split('/v18.0/', 1)[-1]
+        self.llamadas[f"{metodo} {ruta.split('/')[-1] if '/' in ruta else 'objeto'}"] += 1
+
+        if ruta.endswith('/replies') or ruta.endswith('/comments'):
+            return FakeResponse({'id': f"reply_{n}"})
+        if ruta.endswith('me/messages'):
+            return FakeResponse({'recipient_id': (json_body or {}).get('recipient', {}).get('id'), 'message_id': f"mid.{n}"})
+        if ruta.endswith('/messages'):
+            return FakeResponse({'messages': [{'id': f"wamid.{n}"}]})
+        if ruta.endswith('subscribed_apps'):
+            return FakeResponse({'success': True})
+        if 'oauth/access_token' in ruta:
+            return FakeResponse({'access_token': f"token_{n}"})
+        if metodo == 'POST':
+            return FakeResponse({'success': True})
+        return FakeResponse({
+            'id': ruta.split('?')[0],
+            'caption': "Nueva colección de invierno, envíos a todo Chile. Consulta precios por DM.",
+            'media_type': 'IMAGE',
+            'permalink': f"https://www.instagram.com/p/{n}/",
+            'timestamp': '2026-01-01T12:00:00+0000'
+        })
+
+    def get(self, url, params=None, **kwargs):
+        return self._responder('GET', url, params=params)
+
+    def post(self, url, params=None, json=None, **kwargs):
+        return self._responder('POST', url, params=params, json_body=json)
+
+
+class FakeSession(FakeRequests):
+    def mount(self, *args, **kwargs):
+        pass
+
+
+RESPUESTA_OPENAI = json.dumps({
+    "es_inapropiado": False,
+    "razon_inapropiado": None,
+    "respuesta_comentario": "¡Gracias por escribirnos! Te enviamos los detalles por DM 😊",
+    "mensaje_inbox": "¡Hola! El precio y la disponibilidad te los contamos por aquí."
+}, ensure_ascii=False)
+
+
+class _FakeCompletions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, model=None, messages=None, **kwargs):
+        self.latency.sleep()
+        contenido = RESPUESTA_OPENAI
+        mensaje = type('Mensaje', (), {'content': contenido})()
+        eleccion = type('Eleccion', (), {'message': mensaje})()
+        return type('Respuesta', (), {'choices': [eleccion]})()
+
+
+class FakeOpenAI:
+    def __init__(self, latency):
+        self.chat = type('Chat', (), {'completions': _FakeCompletions(latency)})()
+
+
+class FakeSheet:
+    """sheet.values().append(...).execute() / .get(...).execute()"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def values(self):
+        return self
+
+    def append(self, **kwargs):
+        return self
+
+    def get(self, **kwargs):
+        return self
+
+    def execute(self):
+        self.latency.sleep()
+        return {'values': []}
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PAYLOADS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+TEXTOS = [
+    "Hola! cuál es el precio?", "Tienen stock en talla M?", "Dónde están ubicados?",
+    "Info por favor", "Me pasan el link?", "Hacen envíos a regiones?", "Qué lindo!! lo quiero",
+    "Cuánto cuesta el envío a Valparaíso?", "Aceptan transferencia?", "Está disponible en negro?"
+]
+
+_ids = itertools.count(1)
+
+
+def brand(i):
+    return {"page_id": str(100000 + i), "instagram_id": str(17841400000 + i), "page_name": f"Marca {i}"}
+
+
+def ig_comment(b, media_id=None, sender=None):
+    n = next(_ids)
+    return {"object": "instagram", "entry": [{"id": b["instagram_id"], "time": int(time.time()), "changes": [{
+        "field": "comments",
+        "value": {
+            "id": f"179{n:012d}",
+            "text": random.choice(TEXTOS),
+            "from": {"id": sender or f"9{n:010d}", "username": f"user{n}"},
+            "media": {"id": media_id or f"18{n:012d}", "media_product_type": "FEED"}
+        }
+    }]}]}
+
+
+def fb_comment(b, post_id=None):
+    n = next(_ids)
+    post_id = post_id or f"{b['page_id']}_{n}"
+    return {"object": "page", "entry": [{"id": b["page_id"], "time": int(time.time()), "changes": [{
+        "field": "feed",
+        "value": {
+            "item": "comment", "verb": "add",
+            "comment_id": f"{post_id}_{n}", "post_id": post_id,
+            "message": random.choice(TEXTOS),
+            "from": {"id": f"8{n:010d}", "name": f"Usuario {n}"}
+        }
+    }]}]}
+
+
+def new_post(b):
+    n = next(_ids)
+    return {"object": "page", "entry": [{"id": b["page_id"], "time": int(time.time()), "changes": [{
+        "field": "feed",
+        "value": {"item": "photo", "verb": "add", "post_id": f"{b['page_id']}_{n}", "message": "Nuevo producto 🎉"}
+    }]}]}
+
+
+def messenger(b):
+    n = next(_ids)
+    return {"object": "page", "entry": [{"id": b["page_id"], "time": int(time.time()), "messaging": [{
+        "sender": {"id": f"7{n:010d}"}, "recipient": {"id": b["page_id"]},
+        "timestamp": int(time.time() * 1000),
+        "message": {"mid": f"m_{n}", "text": random.choice(TEXTOS)}
+    }]}]}
+
+
+def escenarios(n_override=None):
+    """Escenarios fijos: (nombre, cantidad de marcas, generador de payloads)"""
+    def n(defecto):
+        return n_override or defecto
+
+    return {
+        "ig_comments": (20, lambda marcas: (ig_comment(random.choice(marcas)) for _ in range(n(1000)))),
+        "fb_comments": (20, lambda marcas: (fb_comment(random.choice(marcas)) for _ in range(n(1000)))),
+        "new_posts": (20, lambda marcas: (new_post(random.choice(marcas)) for _ in range(n(200)))),
+        "messenger": (20, lambda marcas: (messenger(random.choice(marcas)) for _ in range(n(1000)))),
+        "viral_post": (1, lambda marcas: (ig_comment(marcas[0], media_id="18000000000001") for _ in range(n(5000)))),
+        "many_brands": (200, lambda marcas: (ig_comment(marcas[i % len(marcas)]) for i in range(n(2000)))),
+        "mixed": (50, lambda marcas: (
+            random.choices([ig_comment, fb_comment, messenger, new_post], weights=[60, 25, 10, 5])[0](random.choice(marcas))
+            for _ in range(n(2000))
+        )),
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# EJECUCIÓN
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))]
+
+
+def preparar_modulo(args):
+    # Configuración antes de importar: sin credenciales reales, estado local temporal
+    tmp_dir = tempfile.mkdtemp(prefix='comentarios_bench_')
+    os.environ.setdefault('COMENTARIOS_LOCAL_DB', os.path.join(tmp_dir, 'local.db'))
+    os.environ.setdefault('TRACE_FILE', os.path.join(tmp_dir, 'traces.jsonl'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('MAINTENANCE_ENABLED', 'false')
+    for var in ('SUPABASE_URL', 'SUPABASE_KEY', 'OPENAI_API_KEY', 'SERVICE_ACCOUNT_KEY'):
+        os.environ.pop(var, None)
+
+    sys.path.insert(0, REPO_DIR)
+    import basedepy
+
+    fake_db = FakeSupabase(Latency(args.supabase_ms))
+    basedepy.supabase = fake_db
+    basedepy.requests = FakeRequests(Latency(args.graph_ms))
+    basedepy.whatsapp_session = FakeSession(Latency(args.graph_ms))
+    basedepy.openai_client = FakeOpenAI(Latency(args.openai_ms))
+    basedepy.sheet = FakeSheet(Latency(args.sheets_ms))
+    basedepy.WHATSAPP_ACCESS_TOKEN = 'bench'
+    basedepy.WHATSAPP_PHONE_NUMBER_ID = 'bench'
+    basedepy.WHATSAPP_API_URL = 'https://graph.facebook.com/v18.0/bench/messages'
+
+    # Spans en memoria en vez del archivo de trazas
+    trazas = []
+    basedepy.tracer.export = lambda traza, error=False: trazas.append(traza)
+
+    from flask import Flask
+    app = Flask('comentarios_bench')
+    app.secret_key = 'bench'
+    app.register_blueprint(basedepy.comentarios_bp)
+    return basedepy, fake_db, app.test_client(), trazas
+
+
+def sembrar_marcas(fake_db, cantidad):
+    fake_db.tablas.clear()
+    marcas = [brand(i) for i in range(cantidad)]
+    for i, b in enumerate(marcas):
+        fake_db.tablas["cuentas_instagram"].append(dict(
+            b, id=next(fake_db.ids), user_id=str(i + 1), page_access_token=f"EAAB{i}", activo=True,
+            instagram_name=f"marca{i}", fecha_actualizacion="2026-01-01T00:00:00"
+        ))
+        fake_db.tablas["usuarios"].append({
+            "id": i + 1, "nombre": f"Admin {i}", "telefono": f"5690000{i:04d}", "id_marca": b["instagram_id"],
+            "nombre_marca": b["page_name"], "tipo_usuario": "adm", "activo": True
+        })
+        for j, (categoria, clave, valor, prioridad) in enumerate([
+            ("prompt", "prompt_principal", f"Somos {b['page_name']}, respondemos con cariño.", 1),
+            ("info", "horario", "Lunes a viernes de 9 a 18 hrs", 1),
+            ("info", "ubicacion", "Av. Providencia 1234, Santiago", 2),
+            ("precios", "envio", "Envío gratis sobre $30.000", 3),
+            ("promocion", "cyber", "20% de descuento esta semana", 2),
+        ]):
+            fake_db.tablas["base_cuentas"].append({
+                "id": next(fake_db.ids), "ID marca": b["instagram_id"], "Nombre marca": b["page_name"],
+                "Estado": True, "categoria": categoria, "clave": clave, "valor": valor, "prioridad": prioridad
+            })
+    return marcas
+
+
+def firmar_payload(body, secret):
+    """Firma X-Hub-Signature-256 como la envía Meta"""
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def enviar(modulo, client, payload):
+    """POST al webhook (firmado si el módulo tiene APP_SECRET)"""
+    body = json.dumps(payload).encode()
+    headers = {'Content-Type': 'application/json'}
+    if getattr(modulo, 'APP_SECRET', None):
+        headers['X-Hub-Signature-256'] = firmar_payload(body, modulo.APP_SECRET)
+    return client.post('/comentarios/webhook', data=body, headers=headers)
+
+
+def ejecutar(nombre, payloads, modulo, client, trazas, medir_memoria=0):
+    payloads = list(payloads)
+    trazas.clear()
+    latencias = []
+    inicio = time.perf_counter()
+    for payload in payloads:
+        t0 = time.perf_counter()
+        enviar(modulo, client, payload)
+        latencias.append((time.perf_counter() - t0) * 1000)
+    total = time.perf_counter() - inicio
+
+    etapas = defaultdict(list)
+    for traza in trazas:
+        for stage, _, duracion, _ in traza.spans:
+            etapas[stage].append(duracion * 1000)
+
+    resultado = {
+        "escenario": nombre,
+        "eventos": len(payloads),
+        "segundos": round(total, 3),
+        "eventos_por_segundo": round(len(payloads) / total, 1) if total else 0,
+        "webhook_ms": {p: round(percentil(latencias, p), 2) for p in (50, 95, 99)},
+        "etapas_ms": {
+            stage: {"n": len(v), **{f"p{p}": round(percentil(v, p), 2) for p in (50, 95, 99)}}
+            for stage, v in sorted(etapas.items())
+        }
+    }
+
+    if medir_memoria:
+        # Pasada separada con tracemalloc (lo hace más lento, no afecta la medición de tiempo)
+        muestra = payloads[:medir_memoria]
+        for payload in muestra:
+            for entry in payload.get('entry', []):
+                for change in entry.get('changes', []):
+                    valor = change.get('value', {})
+                    for clave in ('id', 'comment_id', 'post_id'):
+                        if clave in valor:
+                            valor[clave] = f"{valor[clave]}_mem"
+        tracemalloc.start()
+        bloques_antes = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        for payload in muestra:
+            enviar(modulo, client, payload)
+        actual, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        resultado["memoria"] = {
+            "eventos_medidos": len(muestra),
+            "kb_retenidos_por_evento": round((actual - base) / 1024 / max(len(muestra), 1), 2),
+            "kb_pico": round((pico - base) / 1024, 1),
+            "bloques_netos_por_evento": round((sys.getallocatedblocks() - bloques_antes) / max(len(muestra), 1), 1)
+        }
+    return resultado
+
+
+def imprimir(resultado):
+    print(f"\n═══ {resultado['escenario']} ═══")
+    print(f"  eventos: {resultado['eventos']}  |  {resultado['eventos_por_segundo']} ev/s  |  "
+          f"webhook p50 {resultado['webhook_ms'][50]}ms p95 {resultado['webhook_ms'][95]}ms p99 {resultado['webhook_ms'][99]}ms")
+    for stage, datos in resultado["etapas_ms"].items():
+        print(f"    {stage:<24} n={datos['n']:<7} p50 {datos['p50']:>8.2f}  p95 {datos['p95']:>8.2f}  p99 {datos['p99']:>8.2f}")
+    if "memoria" in resultado:
+        m = resultado["memoria"]
+        print(f"  memoria: {m['kb_retenidos_por_evento']} KB retenidos/evento, pico {m['kb_pico']} KB, "
+              f"{m['bloques_netos_por_evento']} bloques netos/evento ({m['eventos_medidos']} eventos)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark en proceso del webhook de comentarios")
+    parser.add_argument('--scenario', default='all', help="Escenario a ejecutar (o 'all')")
+    parser.add_argument('--events', type=int, help="Sobrescribe la cantidad de eventos de cada escenario")
+    parser.add_argument('--replay', help="Archivo JSONL con bodies de webhook grabados")
+    parser.add_argument('--brands', type=int, default=20, help="Marcas a sembrar para --replay")
+    parser.add_argument('--supabase-ms', type=float, default=0.0)
+    parser.add_argument('--graph-ms', type=float, default=0.0)
+    parser.add_argument('--openai-ms', type=float, default=0.0)
+    parser.add_argument('--sheets-ms', type=float, default=0.0)
+    parser.add_argument('--memory-sample', type=int, default=200, help="Eventos para la pasada de memoria (0 = omitir)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help="Guarda los resultados en este archivo")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    modulo, fake_db, client, trazas = preparar_modulo(args)
+    resultados = []
+
+    if args.replay:
+        with open(args.replay, encoding='utf-8') as f:
+            payloads = [json.loads(linea) for linea in f if linea.strip()]
+        sembrar_marcas(fake_db, args.brands)
+        resultados.append(ejecutar(f"replay:{os.path.basename(args.replay)}", payloads, modulo, client, trazas,
+                                   args.memory_sample))
+    else:
+        todos = escenarios(args.events)
+        nombres = list(todos) if args.scenario == 'all' else [args.scenario]
+        for nombre in nombres:
+            if nombre not in todos:
+                parser.error(f"Escenario desconocido: {nombre} (disponibles: {', '.join(todos)})")
+            cantidad_marcas, generador = todos[nombre]
+            marcas = sembrar_marcas(fake_db, cantidad_marcas)
+            resultados.append(ejecutar(nombre, generador(marcas), modulo, client, trazas, args.memory_sample))
+
+    for resultado in resultados:
+        imprimir(resultado)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False, default=str)
+        print(f"\nResultados guardados en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Kit de carga para /comentarios/webhook
+======================================
+
+Dos subcomandos:
+
+  stubs  Servidor HTTP local que reemplaza a graph.facebook.com (respuestas,
+         DMs, ocultar, WhatsApp) y a la API de chat completions de OpenAI,
+         con latencia y errores inyectados.
+
+  fire   Generador de payloads de webhook firmados (X-Hub-Signature-256) a una
+         tasa fija, con distribución configurable de marcas y publicaciones.
+
+Uso típico:
+    python scripts/comentarios_loadgen.py stubs --port 8089 --graph-ms 120 --openai-ms 700 --error-rate 0.02
+
+    # En el servidor bajo prueba:
+    GRAPH_API_URL=http://127.0.0.1:8089/v18.0
+    WHATSAPP_API_URL=http://127.0.0.1:8089/v18.0/000000/messages
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1
+
+    python scripts/comentarios_loadgen.py fire --url http://127.0.0.1:5000/comentarios/webhook \\
+        --rate 50 --duration 60 --brands 200 --brand-skew 1.1 --secret "$APP_SECRET_COMENTARIOS"
+
+Las marcas sintéticas son las mismas de comentarios_bench.py; para usar marcas
+reales pasar --brands-file con un JSON [{"instagram_id": ..., "page_id": ...}, ...].
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comentarios_bench import (  # noqa: E402
+    RESPUESTA_OPENAI, FakeRequests, Latency, brand, fb_comment, firmar_payload, ig_comment, messenger, new_post,
+    percentil
+)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# STAND-INS HTTP
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class StubConfig:
+    def __init__(self, args):
+        self.graph = Latency(args.graph_ms, args.jitter)
+        self.openai = Latency(args.openai_ms, args.jitter)
+        self.graph_error_rate = args.graph_error_rate if args.graph_error_rate is not None else args.error_rate
+        self.openai_error_rate = args.openai_error_rate if args.openai_error_rate is not None else args.error_rate
+        self.cuerpos = FakeRequests(Latency(0))
+        self.contadores = Counter()
+        self.lock = threading.Lock()
+
+    def contar(self, clave):
+        with self.lock:
+            self.contadores[clave] += 1
+
+
+def _tipo_graph(metodo, ruta):
+    if ruta.endswith('/replies') or ruta.endswith('/comments'):
+        return 'reply'
+    if ruta.endswith('me/messages'):
+        return 'dm'
+    if ruta.endswith('/messages'):
+        return 'whatsapp'
+    if metodo == 'POST' and ruta.count('/') == 2:
+        return 'hide'
+    return f"{metodo.lower()}_other"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    config = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _leer_body(self):
+        largo = int(self.headers.get('Content-Length') or 0)
+        crudo = self.rfile.read(largo) if largo else b''
+        try:
+            return json.loads(crudo) if crudo else {}
+        except ValueError:
+            return {}
+
+    def _responder(self, status, data):
+        cuerpo = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_GET(self):
+        if self.path.startswith('/_stats'):
+            with self.config.lock:
+                return self._responder(200, dict(self.config.contadores))
+        self._graph('GET', {})
+
+    def do_POST(self):
+        body = self._leer_body()
+        if self.path.split('?')[0].endswith('/chat/completions'):
+            return self._openai(body)
+        self._graph('POST', body)
+
+    def _graph(self, metodo, body):
+        ruta = self.path.split('?')[0]
+        tipo = _tipo_graph(metodo, ruta)
+        self.config.graph.sleep()
+        if random.random() < self.config.graph_error_rate:
+            self.config.contar(f"graph_{tipo}_error")
+            codigo = random.choice([(500, 2, 'OAuthException'), (400, 4, 'OAuthException'), (400, 190, 'OAuthException')])
+            return self._responder(codigo[0], {"error": {
+                "message": "(stub) Error inyectado", "type": codigo[2], "code": codigo[1], "fbtrace_id": "stub"
+            }})
+        self.config.contar(f"graph_{tipo}")
+        respuesta = self.config.cuerpos._responder(metodo, f"/v18.0{ruta.split('/v18.0', 1)[-1]}", json_body=body)
+        self._responder(200, respuesta.data)
+
+    def _openai(self, body):
+        self.config.openai.sleep()
+        if random.random() < self.config.openai_error_rate:
+            self.config.contar('openai_error')
+            return self._responder(random.choice([429, 500, 503]), {"error": {
+                "message": "(stub) Error inyectado", "type": "server_error", "code": None
+            }})
+        self.config.contar('openai')
+        self._responder(200, {
+            "id": f"chatcmpl-stub{random.getrandbits(32):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'gpt-4o-mini'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": RESPUESTA_OPENAI},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 600, "completion_tokens": 80, "total_tokens": 680}
+        })
+
+
+def run_stubs(args):
+    StubHandler.config = StubConfig(args)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"Stand-ins escuchando en http://{args.host}:{args.port}")
+    print(f"  GRAPH_API_URL=http://{args.host}:{args.port}/v18.0")
+    print(f"  WHATSAPP_API_URL=http://{args.host}:{args.port}/v18.0/000000/messages")
+    print(f"  OPENAI_BASE_URL=http://{args.host}:{args.port}/v1")
+    print(f"  Contadores: GET http://{args.host}:{args.port}/_stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(dict(StubHandler.config.contadores), indent=2))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# GENERADOR DE CARGA
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def pesos_zipf(n, s):
+    """Pesos 1/rank^s (s=0 → uniforme)"""
+    return [1 / (rango ** s) for rango in range(1, n + 1)]
+
+
+class PayloadGenerator:
+    GENERADORES = {"ig": ig_comment, "fb": fb_comment, "dm": messenger, "post": new_post}
+
+    def __init__(self, marcas, brand_skew, posts_per_brand, post_skew, mezcla):
+        self.marcas = marcas
+        self.pesos_marca = pesos_zipf(len(marcas), brand_skew)
+        self.pesos_post = pesos_zipf(posts_per_brand, post_skew)
+        self.posts_per_brand = posts_per_brand
+        self.tipos = list(mezcla)
+        self.pesos_tipo = [mezcla[t] for t in self.tipos]
+
+    def siguiente(self):
+        b = random.choices(self.marcas, weights=self.pesos_marca)[0]
+        tipo = random.choices(self.tipos, weights=self.pesos_tipo)[0]
+        post = random.choices(range(self.posts_per_brand), weights=self.pesos_post)[0]
+        if tipo == 'ig':
+            return tipo, ig_comment(b, media_id=f"18{b['instagram_id'][-6:]}{post:06d}")
+        if tipo == 'fb':
+            return tipo, fb_comment(b, post_id=f"{b['page_id']}_{post}")
+        return tipo, self.GENERADORES[tipo](b)
+
+
+def cargar_marcas(args):
+    if args.brands_file:
+        with open(args.brands_file, encoding='utf-8') as f:
+            return [{"instagram_id": str(m["instagram_id"]), "page_id": str(m["page_id"])} for m in json.load(f)]
+    return [brand(i) for i in range(args.brands)]
+
+
+def parse_mix(texto):
+    mezcla = {}
+    for par in texto.split(','):
+        tipo, peso = par.split('=')
+        if tipo not in PayloadGenerator.GENERADORES:
+            raise argparse.ArgumentTypeError(f"Tipo desconocido en --mix: {tipo}")
+        mezcla[tipo] = float(peso)
+    return mezcla
+
+
+class Resultados:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = []
+        self.por_estado = Counter()
+        self.por_tipo = defaultdict(int)
+        self.enviados = 0
+
+    def registrar(self, tipo, estado, ms):
+        with self.lock:
+            self.latencias.append(ms)
+            self.por_estado[estado] += 1
+            self.por_tipo[tipo] += 1
+
+    def resumen(self, segundos):
+        with self.lock:
+            lat = list(self.latencias)
+            estados = dict(self.por_estado)
+        return (f"{len(lat)}/{self.enviados} completados | {len(lat) / segundos:.1f} req/s | "
+                f"p50 {percentil(lat, 50):.1f}ms p95 {percentil(lat, 95):.1f}ms p99 {percentil(lat, 99):.1f}ms | "
+                f"estados {estados}")
+
+
+def run_fire(args):
+    generador = PayloadGenerator(cargar_marcas(args), args.brand_skew, args.posts_per_brand, args.post_skew, args.mix)
+    resultados = Resultados()
+    local = threading.local()
+
+    def enviar(tipo, payload):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        body = json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json'}
+        if args.secret:
+            headers['X-Hub-Signature-256'] = firmar_payload(body, args.secret)
+        t0 = time.perf_counter()
+        try:
+            estado = local.session.post(args.url, data=body, headers=headers, timeout=args.timeout).status_code
+        except requests.RequestException as e:
+            estado = type(e).__name__
+        resultados.registrar(tipo, estado, (time.perf_counter() - t0) * 1000)
+
+    total = int(args.rate * args.duration)
+    print(f"Enviando {total} eventos a {args.rate}/s hacia {args.url} "
+          f"({len(generador.marcas)} marcas, mezcla {args.mix}, firmados={'sí' if args.secret else 'no'})")
+
+    inicio = time.perf_counter()
+    ultimo_reporte = inicio
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for i in range(total):
+            # Lazo abierto: la tasa no depende de la latencia del servidor
+            espera = inicio + i / args.rate - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            pool.submit(enviar, *generador.siguiente())
+            resultados.enviados += 1
+            ahora = time.perf_counter()
+            if ahora - ultimo_reporte >= args.report_every:
+                print(f"[{ahora - inicio:6.1f}s] {resultados.resumen(ahora - inicio)}")
+                ultimo_reporte = ahora
+
+    duracion = time.perf_counter() - inicio
+    print(f"\nFinal ({duracion:.1f}s): {resultados.resumen(duracion)}")
+    print(f"Por tipo: {dict(resultados.por_tipo)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kit de carga para el webhook de comentarios")
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    stubs = sub.add_parser('stubs', help="Stand-ins HTTP de Graph/WhatsApp/OpenAI")
+    stubs.add_argument('--host', default='127.0.0.1')
+    stubs.add_argument('--port', type=int, default=8089)
+    stubs.add_argument('--graph-ms', type=float, default=100.0, help="Latencia media de Graph/WhatsApp")
+    stubs.add_argument('--openai-ms', type=float, default=800.0, help="Latencia media de chat completions")
+    stubs.add_argument('--jitter', type=float, default=0.3, help="Variación relativa de la latencia")
+    stubs.add_argument('--error-rate', type=float, default=0.0, help="Fracción de respuestas con error")
+    stubs.add_argument('--graph-error-rate', type=float, help="Sobrescribe --error-rate para Graph")
+    stubs.add_argument('--openai-error-rate', type=float, help="Sobrescribe --error-rate para OpenAI")
+
+    fire = sub.add_parser('fire', help="Envía payloads firmados al webhook")
+    fire.add_argument('--url', required=True)
+    fire.add_argument('--rate', type=float, default=20.0, help="Eventos por segundo")
+    fire.add_argument('--duration', type=float, default=30.0, help="Segundos")
+    fire.add_argument('--brands', type=int, default=20)
+    fire.add_argument('--brands-file', help="JSON con marcas reales (instagram_id, page_id)")
+    fire.add_argument('--brand-skew', type=float, default=1.0, help="Exponente Zipf entre marcas (0 = uniforme)")
+    fire.add_argument('--posts-per-brand', type=int, default=10)
+    fire.add_argument('--post-skew', type=float, default=1.2, help="Exponente Zipf entre publicaciones")
+    fire.add_argument('--mix', type=parse_mix, default=parse_mix('ig=60,fb=25,dm=10,post=5'))
+    fire.add_argument('--secret', default=os.getenv('APP_SECRET_COMENTARIOS'), help="APP_SECRET para firmar")
+    fire.add_argument('--concurrency', type=int, default=32)
+    fire.add_argument('--timeout', type=float, default=30.0)
+    fire.add_argument('--report-every', type=float, default=5.0)
+    fire.add_argument('--seed', type=int)
+
+    args = parser.parse_args()
+    if getattr(args, 'seed', None) is not None:
+        random.seed(args.seed)
+    if args.comando == 'stubs':
+        run_stubs(args)
+    else:
+        run_fire(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Visor de trazas de BP_COMENTARIOS
+=================================
+
+Lee el archivo JSONL de trazas (TRACE_FILE, por defecto comentarios_traces.jsonl
+junto a basedepy.py, más sus rotaciones .1, .2, ...) y muestra:
+
+- Resumen por etapa: llamadas, p50/p95/p99/máx y % del tiempo total
+- Las trazas más lentas con el desglose de sus spans
+
+Uso:
+    python scripts/comentarios_traces.py [archivo] [--top 10] [--name change] [--since 2026-01-31T00:00]
+"""
+
+import argparse
+import glob
+import json
+import os
+from collections import defaultdict
+
+DEFAULT_FILE = os.getenv(
+    'TRACE_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'comentarios_traces.jsonl')
+)
+
+
+def leer_trazas(archivo, name=None, since=None):
+    """Lee el archivo y sus rotaciones, filtrando por nombre y fecha de inicio"""
+    archivos = [archivo] + sorted(glob.glob(f"{archivo}.*"), reverse=True)
+    for ruta in archivos:
+        if not os.path.exists(ruta):
+            continue
+        with open(ruta, encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    traza = json.loads(linea)
+                except ValueError:
+                    continue
+                if name and traza.get('name') != name:
+                    continue
+                if since and traza.get('start', '') < since:
+                    continue
+                yield traza
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    idx = min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))
+    return valores[idx]
+
+
+def resumen_por_etapa(trazas):
+    etapas = defaultdict(list)
+    errores = defaultdict(int)
+    for traza in trazas:
+        for span in traza.get('spans', []):
+            etapas[span['stage']].append(span['ms'])
+            if span.get('error'):
+                errores[span['stage']] += 1
+    total = sum(sum(v) for v in etapas.values()) or 1.0
+
+    filas = []
+    for etapa, valores in etapas.items():
+        valores.sort()
+        filas.append({
+            "etapa": etapa,
+            "n": len(valores),
+            "p50": percentil(valores, 50),
+            "p95": percentil(valores, 95),
+            "p99": percentil(valores, 99),
+            "max": valores[-1],
+            "pct": sum(valores) / total * 100,
+            "errores": errores[etapa]
+        })
+    filas.sort(key=lambda f: f['pct'], reverse=True)
+    return filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resume trazas de BP_COMENTARIOS")
+    parser.add_argument('archivo', nargs='?', default=DEFAULT_FILE)
+    parser.add_argument('--top', type=int, default=10, help="Cantidad de trazas lentas a mostrar")
+    parser.add_argument('--name', help="Filtrar por nombre de traza (change, messaging, workflow)")
+    parser.add_argument('--since', help="Solo trazas desde esta fecha ISO")
+    args = parser.parse_args()
+
+    trazas = list(leer_trazas(args.archivo, args.name, args.since))
+    if not trazas:
+        print(f"Sin trazas en {args.archivo}")
+        return
+
+    duraciones = sorted(t['duration_ms'] for t in trazas)
+    print(f"Trazas: {len(trazas)}  |  p50 {percentil(duraciones, 50):.1f}ms  "
+          f"p95 {percentil(duraciones, 95):.1f}ms  p99 {percentil(duraciones, 99):.1f}ms  "
+          f"máx {duraciones[-1]:.1f}ms")
+
+    print(f"\n{'ETAPA':<24}{'N':>8}{'P50':>10}{'P95':>10}{'P99':>10}{'MÁX':>10}{'% TIEMPO':>10}{'ERR':>6}")
+    for fila in resumen_por_etapa(trazas):
+        print(f"{fila['etapa']:<24}{fila['n']:>8}{fila['p50']:>10.1f}{fila['p95']:>10.1f}"
+              f"{fila['p99']:>10.1f}{fila['max']:>10.1f}{fila['pct']:>9.1f}%{fila['errores']:>6}")
+
+    print("\nTrazas más lentas:")
+    for traza in sorted(trazas, key=lambda t: t['duration_ms'], reverse=True)[:args.top]:
+        attrs = ' '.join(f"{k}={v}" for k, v in traza.get('attrs', {}).items())
+        print(f"\n  {traza['trace_id']}  {traza['name']}  {traza['duration_ms']:.1f}ms  {traza['start']}  {attrs}")
+        for span in sorted(traza.get('spans', []), key=lambda s: s['ms'], reverse=True):
+            marca = ' ERROR' if span.get('error') else ''
+            print(f"      {span['stage']:<24}{span['ms']:>10.1f}ms  (+{span['offset_ms']:.1f}ms){marca}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+-- ============================================
+-- Índice único de page_id en cuentas_instagram (BP_COMENTARIOS)
+-- Ejecutar en Supabase SQL Editor
+-- ============================================
+--
+-- La conexión de páginas (facebook_callback) guarda todas las cuentas con un
+-- solo upsert ON CONFLICT (page_id). Sin este índice el upsert falla y el
+-- backend vuelve a guardar cuenta por cuenta.
+
+-- 1. Eliminar duplicados, conservando la fila más reciente por página
+DELETE FROM cuentas_instagram a
+  USING cuentas_instagram b
+  WHERE a.page_id = b.page_id
+    AND a.id < b.id;
+
+-- 2. Índice único
+CREATE UNIQUE INDEX IF NOT EXISTS cuentas_instagram_page_id_key
+  ON cuentas_instagram (page_id);
@@ -0,0 +1,74 @@
+-- ============================================
+-- Búsqueda de texto completo en logs_comentarios (BP_COMENTARIOS)
+-- Ejecutar en Supabase SQL Editor
+-- ============================================
+--
+-- Columna tsvector generada (comentario_original con peso A, respuesta_comentario
+-- con peso B), índice GIN y función buscar_comentarios() que usa la ruta
+-- /comentarios/buscar_comentarios. La columna es GENERATED STORED: Postgres la
+-- recalcula en cada INSERT/UPDATE, así que el índice se mantiene solo.
+-- Sin tildes: "envio" encuentra "envío" y viceversa.
+
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+-- unaccent() no es IMMUTABLE; este envoltorio sí, para poder indexarlo
+CREATE OR REPLACE FUNCTION f_unaccent(texto TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, texto) $$;
+
+-- 1. Columna de búsqueda (reescribe la tabla una vez; ejecutar fuera de horario punta)
+ALTER TABLE logs_comentarios
+  ADD COLUMN IF NOT EXISTS busqueda tsvector
+  GENERATED ALWAYS AS (
+    setweight(to_tsvector('spanish'::regconfig, f_unaccent(coalesce(comentario_original, ''))), 'A') ||
+    setweight(to_tsvector('spanish'::regconfig, f_unaccent(coalesce(respuesta_comentario, ''))), 'B')
+  ) STORED;
+
+-- 2. Índice GIN. En tablas grandes, para no bloquear escrituras, ejecutar esta
+--    sentencia sola y con CREATE INDEX CONCURRENTLY (no admite transacción).
+CREATE INDEX IF NOT EXISTS idx_logs_comentarios_busqueda
+  ON logs_comentarios USING GIN (busqueda);
+
+-- 3. Búsqueda rankeada y paginada. Devuelve limite + 1 filas como máximo para
+--    saber si hay otra página sin contar todas las coincidencias.
+CREATE OR REPLACE FUNCTION buscar_comentarios(
+  p_consulta    TEXT,
+  p_marcas      TEXT[],
+  p_plataforma  TEXT DEFAULT NULL,
+  p_inapropiado BOOLEAN DEFAULT NULL,
+  p_limite      INTEGER DEFAULT 20,
+  p_offset      INTEGER DEFAULT 0
+)
+RETURNS TABLE (
+  id                   BIGINT,
+  creado_en            TIMESTAMPTZ,
+  id_marca             TEXT,
+  nombre_marca         TEXT,
+  plataforma           TEXT,
+  media_id             TEXT,
+  comment_id           TEXT,
+  comentario_original  TEXT,
+  respuesta_comentario TEXT,
+  es_inapropiado       BOOLEAN,
+  rank                 REAL
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT l.id::BIGINT, l.creado_en::TIMESTAMPTZ, l.id_marca::TEXT, l.nombre_marca::TEXT, l.plataforma::TEXT,
+         l.media_id::TEXT, l.comment_id::TEXT, l.comentario_original::TEXT, l.respuesta_comentario::TEXT,
+         l.es_inapropiado, ts_rank_cd(l.busqueda, q) AS rank
+  FROM logs_comentarios l,
+       websearch_to_tsquery('spanish'::regconfig, f_unaccent(p_consulta)) AS q
+  WHERE l.busqueda @@ q
+    AND l.id_marca::TEXT = ANY (p_marcas)
+    AND (p_plataforma IS NULL OR l.plataforma ILIKE p_plataforma)
+    AND (p_inapropiado IS NULL OR l.es_inapropiado = p_inapropiado)
+  ORDER BY rank DESC, l.id DESC
+  LIMIT LEAST(p_limite, 100) + 1
+  OFFSET p_offset;
+$$;
+
+-- Mantenimiento: tras cargas masivas o purgas (LOGS_RETENTION_DAYS) actualizar
+-- estadísticas para que el planificador siga eligiendo el índice GIN.
+-- ANALYZE logs_comentarios;
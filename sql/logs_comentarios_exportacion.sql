@@ -0,0 +1,11 @@
+-- ============================================
+-- Índice para exportar logs_comentarios (BP_COMENTARIOS)
+-- Ejecutar en Supabase SQL Editor
+-- ============================================
+--
+-- /comentarios/exportar_comentarios lee por keyset: id_marca IN (...) AND id > último
+-- ORDER BY id LIMIT n, con filtro opcional por creado_en. Con este índice cada
+-- bloque es un range scan y no un recorrido de la tabla completa.
+
+CREATE INDEX IF NOT EXISTS idx_logs_comentarios_marca_id
+  ON logs_comentarios (id_marca, id);
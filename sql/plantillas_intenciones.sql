@@ -0,0 +1,36 @@
+-- ============================================
+-- Plantillas de respuesta por intención (BP_COMENTARIOS)
+-- Ejecutar en Supabase SQL Editor
+-- ============================================
+--
+-- Las plantillas viven en base_cuentas con categorías nuevas:
+--
+--   plantilla_publica   clave = intención, valor = respuesta pública
+--   plantilla_inbox     clave = intención, valor = mensaje privado (opcional)
+--   intencion_palabras  clave = intención, valor = palabras clave separadas por coma
+--
+-- Intenciones incluidas: precio, disponibilidad, ubicacion, horario, envio, link, info.
+-- Con intencion_palabras una marca puede ampliar esas intenciones o crear otras.
+--
+-- En el texto se puede usar {marca} y {clave} de cualquier dato activo de la
+-- marca (p. ej. {ubicacion} si existe un dato con clave 'ubicacion'). Si falta
+-- un dato, esa plantilla se salta. Varias filas de la misma intención se usan
+-- en rotación. Ver tasa de uso en /comentarios/diagnostico_plantillas.
+
+-- Índice para leer los datos de una marca por categoría
+CREATE INDEX IF NOT EXISTS idx_base_cuentas_marca_categoria
+  ON base_cuentas ("ID marca", categoria)
+  WHERE "Estado" = true;
+
+-- Ejemplo (reemplazar 'ID_MARCA' y 'Nombre Marca'):
+-- INSERT INTO base_cuentas ("ID marca", "Nombre marca", "Estado", categoria, clave, valor, prioridad) VALUES
+--   ('ID_MARCA', 'Nombre Marca', true, 'plantilla_publica', 'precio',
+--    '¡Hola! Te enviamos los precios por DM 😊', 5),
+--   ('ID_MARCA', 'Nombre Marca', true, 'plantilla_publica', 'precio',
+--    '¡Gracias por tu interés! Revisa tu inbox, ahí va el detalle 💌', 5),
+--   ('ID_MARCA', 'Nombre Marca', true, 'plantilla_inbox', 'precio',
+--    '¡Hola! En {marca} los precios están en {link}. ¿Te ayudo con algo más?', 5),
+--   ('ID_MARCA', 'Nombre Marca', true, 'plantilla_publica', 'ubicacion',
+--    'Estamos en {ubicacion} ✨ ¡Te esperamos!', 5),
+--   ('ID_MARCA', 'Nombre Marca', true, 'intencion_palabras', 'precio',
+--    'valen, en cuanto, precio mayorista', 5);